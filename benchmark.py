@@ -0,0 +1,278 @@
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, timedelta
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from gerador import GeradorDados
+from index import (Codec, DAO, Instrumentacao, Progresso, Venda, VendaDAO, ControllerAfiliado, ControllerProduto,
+                   ControllerVenda, ControllerPagamento, ControllerRelatorio)
+
+
+class TelaSilenciosa:
+    def __init__(self, dados=None):
+        self.__dados = dados
+        self.resultado = None
+
+    def init_components(self):
+        pass
+
+    def close(self):
+        pass
+
+    def ler_dados(self):
+        return self.__dados
+
+    def ler_dados_ranking(self):
+        return self.__dados
+
+    def acompanhar(self, titulo, operacao):
+        return operacao(Progresso())
+
+    def popup(self, mensagem):
+        if mensagem.startswith("Erro"):
+            raise RuntimeError(mensagem)
+
+    def mostrar_mensagem_popup(self, mensagem):
+        self.popup(mensagem)
+
+    def mostrar_relatorio_vendas(self, vendas):
+        self.resultado = vendas
+
+    def mostrar_relatorio_financeiro(self, pagamentos):
+        self.resultado = pagamentos
+
+    def mostrar_relatorio_rede(self, linhas):
+        self.resultado = linhas
+
+    def mostrar_rankings(self, rankings):
+        self.resultado = rankings
+
+
+def gerar_dados(tamanho, semente=42):
+    gerador = GeradorDados(semente)
+    afiliados = gerador.afiliados(max(10, tamanho // 10), raizes=max(1, tamanho // 1000))
+    produtos = gerador.produtos(max(5, tamanho // 20))
+    vendas = list(gerador.vendas(tamanho, afiliados, produtos, date.today() - timedelta(days=365), date.today()))
+    return afiliados, produtos, vendas
+
+
+def percentis(amostras):
+    ordenadas = sorted(amostras)
+    if not ordenadas:
+        return {}
+
+    def percentil(p):
+        return ordenadas[min(len(ordenadas) - 1, int(round(p / 100 * (len(ordenadas) - 1))))]
+
+    return {
+        'p50_ms': percentil(50) * 1000,
+        'p90_ms': percentil(90) * 1000,
+        'p99_ms': percentil(99) * 1000,
+        'max_ms': ordenadas[-1] * 1000,
+    }
+
+
+def bytes_gravados(metrica):
+    return Instrumentacao.operacoes().get(metrica, {}).get('bytes_escritos', 0)
+
+
+def medir_operacoes(operacoes, metrica_gravacao=None, preparar=None):
+    # 'preparar' roda antes de cada operação, fora da medição (ex.: esvaziar caches).
+    latencias = []
+    bytes_iniciais = bytes_gravados(metrica_gravacao)
+    total = 0.0
+    for operacao in operacoes:
+        if preparar is not None:
+            preparar()
+        t = time.perf_counter()
+        operacao()
+        latencias.append(time.perf_counter() - t)
+        total += latencias[-1]
+    resultado = {
+        'operacoes': len(latencias),
+        'segundos': total,
+        'operacoes_por_segundo': len(latencias) / total if total else None,
+        **percentis(latencias),
+    }
+    if metrica_gravacao:
+        bytes_escritos = bytes_gravados(metrica_gravacao) - bytes_iniciais
+        resultado['bytes_por_operacao'] = bytes_escritos / len(latencias) if latencias else 0
+    return resultado
+
+
+def medir_unica(funcao):
+    inicio = time.perf_counter()
+    funcao()
+    return {'segundos': time.perf_counter() - inicio}
+
+
+def pico_rss_kb():
+    if resource is None:
+        return None
+    pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return pico // 1024 if sys.platform == 'darwin' else pico
+
+
+def executar_tamanho(tamanho, operacoes, semente, codec=None):
+    resultados = {}
+    diretorio_original = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix='benchmark-afiliados-') as diretorio:
+        os.chdir(diretorio)
+        try:
+            resultados.update(executar_cenarios(tamanho, operacoes, semente, codec))
+        finally:
+            os.chdir(diretorio_original)
+
+    resultados['pico_rss_kb'] = pico_rss_kb()
+    resultados['instrumentacao'] = {'operacoes': Instrumentacao.operacoes(), 'contadores': Instrumentacao.contadores()}
+    return resultados
+
+
+def executar_cenarios(tamanho, operacoes, semente, codec=None):
+    resultados = {}
+    afiliados, produtos, vendas = gerar_dados(tamanho, semente)
+
+    dao = VendaDAO(codec=codec)
+    def carga():
+        with dao.agrupar_escritas():
+            for venda in vendas:
+                dao.add(venda)
+    resultados['dao_carga'] = medir_unica(carga)
+    resultados['dao_carga']['bytes'] = bytes_gravados('dao.venda.dump')
+
+    aleatorio = random.Random(semente)
+    proximo_id = tamanho + 1
+    novas = []
+    for id in range(proximo_id, proximo_id + operacoes):
+        novas.append(Venda(id, vendas[0].data, aleatorio.choice(afiliados), aleatorio.choice(produtos), 1))
+    resultados['dao_add'] = medir_operacoes([lambda v=v: dao.add(v) for v in novas], 'dao.venda.dump')
+    resultados['dao_update'] = medir_operacoes(
+        [lambda v=aleatorio.choice(vendas): dao.update(v) for _ in range(operacoes)], 'dao.venda.dump')
+    del dao
+
+    # Abertura a frio: só o índice é lido; os registros são montados no primeiro acesso.
+    resultados['dao_abertura'] = medir_unica(VendaDAO)
+    resultados['dao_abertura']['bytes'] = os.path.getsize('venda.pkl')
+    reaberto = VendaDAO(codec=codec)
+    resultados['dao_materializar'] = medir_unica(reaberto.get_all)
+    del reaberto
+
+    os.mkdir('controladores')
+    os.chdir('controladores')
+    controller_afiliado = ControllerAfiliado(TelaSilenciosa())
+    controller_produto = ControllerProduto(TelaSilenciosa())
+    controller_venda = ControllerVenda(TelaSilenciosa(), controller_afiliado, controller_produto)
+    controller_pagamento = ControllerPagamento(TelaSilenciosa(), controller_venda)
+    with controller_afiliado.afiliado_DAO.agrupar_escritas():
+        for afiliado in afiliados:
+            controller_afiliado.afiliado_DAO.add(afiliado)
+    with controller_produto.produto_DAO.agrupar_escritas():
+        for produto in produtos:
+            controller_produto.produto_DAO.add(produto)
+    with controller_venda.venda_DAO.agrupar_escritas():
+        for venda in vendas + novas:
+            controller_venda.venda_DAO.add(venda)
+    controller_venda.venda_DAO.flush()
+
+    # Os passos de comissão são privados no controlador; o benchmark os chama diretamente.
+    resultados['gerar_comissoes'] = medir_unica(controller_pagamento._ControllerPagamento__gerar_comissoes)
+    resultados['gerar_comissoes']['comissoes'] = len(controller_pagamento.listaComissoes)
+    resultados['gerar_comissoes_flush'] = medir_unica(controller_venda.venda_DAO.flush)
+    resultados['processar_pagamentos'] = medir_unica(controller_pagamento._ControllerPagamento__processar_pagamentos)
+    resultados['processar_pagamentos_flush'] = medir_unica(
+        lambda: (controller_pagamento.pagamento_DAO.flush(), controller_venda.venda_DAO.flush()))
+
+    periodo = {
+        'data_inicial': str(date.today() - timedelta(days=90)),
+        'data_final': str(date.today()),
+        'afiliado_id': '',
+        'quantidade': '10'
+    }
+    periodo_afiliado = dict(periodo, afiliado_id=str(afiliados[0].id))
+    # Cada relatório é medido a frio (caches esvaziados antes de cada chamada) e, em
+    # '<cenário>_cache', repetido sobre o resultado já guardado.
+    for nome, dados in (('todos', periodo), ('afiliado', periodo_afiliado)):
+        tela = TelaSilenciosa(dados)
+        relatorio = ControllerRelatorio(tela, controller_venda, controller_pagamento, controller_afiliado)
+        for cenario, gerar in (('relatorio_vendas', relatorio.gerar_relatorio_vendas),
+                               ('relatorio_financeiro', relatorio.gerar_relatorio_financeiro),
+                               ('relatorio_rede', relatorio.gerar_relatorio_rede)):
+            chave = f'{cenario}_{nome}'
+            resultados[chave] = medir_operacoes([gerar] * max(1, operacoes // 4), preparar=relatorio.limpar)
+            resultados[chave]['linhas'] = len(tela.resultado)
+            resultados[f'{chave}_cache'] = medir_operacoes([gerar] * max(1, operacoes // 4))
+    resultados['rankings'] = medir_operacoes([relatorio.gerar_rankings] * max(1, operacoes // 4),
+                                             preparar=relatorio.limpar)
+    resultados['rankings_cache'] = medir_operacoes([relatorio.gerar_rankings] * max(1, operacoes // 4))
+
+    for dao in (controller_afiliado.afiliado_DAO, controller_produto.produto_DAO,
+                controller_venda.venda_DAO, controller_pagamento.pagamento_DAO, controller_pagamento.saldo_DAO):
+        dao.flush()
+    return resultados
+
+
+def comparar(atual, anterior):
+    linhas = []
+    for tamanho, cenarios in atual['resultados'].items():
+        base = anterior['resultados'].get(tamanho, {})
+        for cenario, metricas in cenarios.items():
+            if not isinstance(metricas, dict) or cenario not in base:
+                continue
+            for metrica in ('segundos', 'p50_ms', 'p99_ms', 'bytes_por_operacao'):
+                if metrica in metricas and base[cenario].get(metrica):
+                    razao = metricas[metrica] / base[cenario][metrica]
+                    linhas.append(f"{tamanho:>9} {cenario:<32} {metrica:<20} {razao:6.2f}x")
+    return linhas
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark dos DAOs, comissões e relatórios sem interface gráfica.")
+    parser.add_argument('--tamanhos', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help="quantidades de vendas sintéticas (ex.: 1000 10000 1000000)")
+    parser.add_argument('--operacoes', type=int, default=20, help="operações individuais medidas por cenário")
+    parser.add_argument('--semente', type=int, default=42)
+    parser.add_argument('--saida', default='benchmark.json', help="arquivo JSON com os resultados")
+    parser.add_argument('--comparar', help="JSON de uma execução anterior para comparação")
+    parser.add_argument('--codec', choices=Codec.nomes(), default=DAO.CODEC_PADRAO,
+                        help="codec dos registros no cenário isolado do VendaDAO")
+    args = parser.parse_args()
+
+    resultado = {
+        'data': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'plataforma': platform.platform(),
+        'operacoes': args.operacoes,
+        'codec': args.codec,
+        'resultados': {},
+    }
+    for tamanho in args.tamanhos:
+        # Cada tamanho roda em um processo novo para que o pico de memória seja só dele.
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            resultado['resultados'][str(tamanho)] = executor.submit(
+                executar_tamanho, tamanho, args.operacoes, args.semente, args.codec).result()
+        print(f"{tamanho} vendas: concluído")
+
+    caminho = os.path.abspath(args.saida)
+    with open(caminho, 'w', encoding='utf-8') as arquivo:
+        json.dump(resultado, arquivo, indent=2, ensure_ascii=False)
+    print(f"Resultados gravados em {caminho}")
+
+    if args.comparar:
+        with open(args.comparar, encoding='utf-8') as arquivo:
+            anterior = json.load(arquivo)
+        print("\n".join(comparar(resultado, anterior)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,32 @@
+import argparse
+import os
+
+from index import Codec, DAO, AfiliadoDAO, ProdutoDAO, VendaDAO, PagamentoDAO, Resolvedor
+
+
+def tamanho(caminho):
+    return os.path.getsize(caminho) if os.path.exists(caminho) else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Regrava os arquivos de dados com outro codec de registros.")
+    parser.add_argument('--diretorio', default='.', help="diretório dos arquivos .pkl")
+    parser.add_argument('--codec', choices=Codec.nomes(), default=DAO.CODEC_PADRAO,
+                        help="'binario' é compacto; 'pickle' mantém o formato anterior")
+    args = parser.parse_args()
+
+    os.chdir(args.diretorio)
+    # Todos os DAOs ficam abertos juntos, no mesmo resolvedor, para que as referências
+    # entre eles sejam resolvidas.
+    resolvedor = Resolvedor()
+    daos = [(arquivo, classe(resolvedor=resolvedor))
+            for arquivo, classe in (('afiliado.pkl', AfiliadoDAO), ('produto.pkl', ProdutoDAO),
+                                    ('venda.pkl', VendaDAO), ('pagamento.pkl', PagamentoDAO))]
+    for arquivo, dao in daos:
+        antes = tamanho(arquivo)
+        dao.converter(args.codec)
+        print(f"{arquivo}: {antes} -> {tamanho(arquivo)} bytes")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,287 @@
+import argparse
+import csv
+import json
+import os
+import time
+from bisect import bisect_right
+from datetime import date
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+from index import AfiliadoDAO, ArquivoVendas, ControllerPagamento, Intervalo, PagamentoDAO, Resolvedor, VendaDAO
+
+
+# Colunas exportadas de cada conjunto, com o tipo usado nos formatos colunares.
+COLUNAS = {
+    'vendas': (('id', 'int64'), ('data', 'date32'), ('afiliado_id', 'int64'), ('produto_codigo', 'string'),
+               ('quantidade', 'int64'), ('total', 'float64'), ('pagamento_afiliado', 'string')),
+    'comissoes': (('venda_id', 'int64'), ('data', 'date32'), ('vendedor_id', 'int64'), ('recebedor_id', 'int64'),
+                  ('tipo', 'string'), ('valor', 'float64'), ('pagamento_afiliado', 'string')),
+    'pagamentos': (('id', 'int64'), ('data', 'date32'), ('afiliado_id', 'int64'), ('valor_pago', 'float64')),
+}
+# Só vendas e pagamentos têm exportação incremental (pelos ids já exportados); as
+# comissões pendentes são um retrato do momento e saem sempre inteiras.
+INCREMENTAIS = ('vendas', 'pagamentos')
+EXTENSOES = {'csv': 'csv', 'parquet': 'parquet', 'arrow': 'arrow'}
+ESTADO = 'exportacao.json'
+
+
+class EscritorCSV:
+    def __init__(self, caminho, colunas):
+        self.__arquivo = open(caminho, 'w', newline='', encoding='utf-8')
+        self.__colunas = [nome for nome, _ in colunas]
+        self.__escritor = csv.writer(self.__arquivo)
+        self.__escritor.writerow(self.__colunas)
+
+    def escrever(self, linhas):
+        self.__escritor.writerows([linha[coluna] for coluna in self.__colunas] for linha in linhas)
+
+    def fechar(self):
+        self.__arquivo.close()
+
+
+class EscritorColunar:
+    # Parquet ou Arrow IPC: cada lote vira um grupo de linhas / record batch.
+    def __init__(self, caminho, colunas, formato):
+        self.__esquema = pa.schema([(nome, getattr(pa, tipo)()) for nome, tipo in colunas])
+        if formato == 'parquet':
+            self.__escritor = pq.ParquetWriter(caminho, self.__esquema)
+        else:
+            self.__escritor = pa.ipc.new_file(caminho, self.__esquema)
+
+    def escrever(self, linhas):
+        dados = {nome: [linha[nome] for linha in linhas] for nome in self.__esquema.names}
+        self.__escritor.write_table(pa.Table.from_pydict(dados, schema=self.__esquema))
+
+    def fechar(self):
+        self.__escritor.close()
+
+
+class IdsExportados:
+    # Faixas [inicio, fim] dos ids já exportados de um conjunto. Um "último id" não
+    # basta: cada processo reserva um bloco de ids da sequência, e um id de bloco mais
+    # baixo pode ser gravado depois de outro mais alto já ter sido exportado.
+    def __init__(self, faixas=()):
+        self.__faixas = []
+        for inicio, fim in sorted(faixas):
+            if self.__faixas and inicio <= self.__faixas[-1][1] + 1:
+                self.__faixas[-1][1] = max(self.__faixas[-1][1], fim)
+            else:
+                self.__faixas.append([inicio, fim])
+        self.__inicios = [inicio for inicio, _ in self.__faixas]
+
+    @property
+    def faixas(self):
+        return [list(faixa) for faixa in self.__faixas]
+
+    def contem(self, id):
+        posicao = bisect_right(self.__inicios, id) - 1
+        return posicao >= 0 and id <= self.__faixas[posicao][1]
+
+    def intervalos(self):
+        # Faixas de id consultadas nos DAOs: abaixo e acima da primeira faixa exportada.
+        # As lacunas entre as faixas seguintes são conferidas linha a linha por contem().
+        if not self.__faixas:
+            return [Intervalo()]
+        inicio, fim = self.__faixas[0]
+        return [Intervalo(None, inicio - 1), Intervalo(fim + 1, None)]
+
+    def juntar(self, faixas):
+        return IdsExportados(self.__faixas + list(faixas))
+
+
+def filtros_periodo(periodo, ids=None):
+    filtros = {}
+    if periodo.inicio is not None or periodo.fim is not None:
+        filtros['data'] = periodo
+    if ids is not None and (ids.inicio is not None or ids.fim is not None):
+        filtros['id'] = ids
+    return filtros
+
+
+def percorrer_novos(dao, periodo, exportados, lote):
+    # Lotes do DAO no período, sem os ids já exportados (exportados=None: todos).
+    for ids in exportados.intervalos() if exportados is not None else [None]:
+        for linhas in dao.percorrer(filtros_periodo(periodo, ids), lote=lote):
+            if exportados is not None:
+                linhas = [linha for linha in linhas if not exportados.contem(linha['id'])]
+            if linhas:
+                yield linhas
+
+
+def lotes_vendas(venda_DAO, arquivo_vendas, periodo, exportados, lote):
+    # Primeiro as vendas arquivadas (que saíram do VendaDAO), depois as do DAO.
+    atual = []
+    for venda in arquivo_vendas.registros(periodo.inicio, periodo.fim):
+        if exportados is None or not exportados.contem(venda['id']):
+            atual.append({'id': venda['id'], 'data': venda['data'], 'afiliado_id': venda['afiliado_id'],
+                          'produto_codigo': venda['produto_codigo'], 'quantidade': venda['quantidade'],
+                          'total': venda['total'], 'pagamento_afiliado': 'realizado'})
+            if len(atual) == lote:
+                yield atual
+                atual = []
+    if atual:
+        yield atual
+    for linhas in percorrer_novos(venda_DAO, periodo, exportados, lote):
+        yield [{'id': venda['id'], 'data': venda['data'], 'afiliado_id': venda['afiliado'],
+                'produto_codigo': venda['produto'], 'quantidade': venda['quantidade'], 'total': venda['total'],
+                'pagamento_afiliado': venda['pagamento_afiliado']} for venda in linhas]
+
+
+def lotes_comissoes(venda_DAO, afiliado_DAO, periodo, lote):
+    # As mesmas comissões que "Gerar comissões" monta: as das vendas ainda não pagas.
+    # A situação é conferida aqui, lote a lote, em vez de pelo índice da coluna, que
+    # ocuparia memória proporcional ao histórico inteiro.
+    for vendas in venda_DAO.percorrer(filtros_periodo(periodo), ('id', 'data', 'afiliado', 'total', 'pagamento_afiliado'),
+                                      lote):
+        vendas = [venda for venda in vendas if venda['pagamento_afiliado'] != 'realizado']
+        if not vendas:
+            continue
+        ids = {venda['afiliado'] for venda in vendas}
+        parents = {linha['id']: linha['parent'] for linha in afiliado_DAO.consultar({'id': ids}, campos=('id', 'parent'))}
+        linhas = []
+        for venda in vendas:
+            parent = parents.get(venda['afiliado'])
+            comum = {'venda_id': venda['id'], 'data': venda['data'], 'vendedor_id': venda['afiliado'],
+                     'pagamento_afiliado': venda['pagamento_afiliado']}
+            if parent is not None:
+                linhas.append(dict(comum, recebedor_id=parent, tipo='indireto',
+                                   valor=venda['total'] * ControllerPagamento.COMISSAO_INDIRETA))
+            linhas.append(dict(comum, recebedor_id=venda['afiliado'], tipo='direto',
+                               valor=venda['total'] * ControllerPagamento.COMISSAO_DIRETA))
+        yield linhas
+
+
+def lotes_pagamentos(pagamento_DAO, periodo, exportados, lote):
+    for pagamentos in percorrer_novos(pagamento_DAO, periodo, exportados, lote):
+        yield [{'id': pagamento['id'], 'data': pagamento['data'], 'afiliado_id': pagamento['afiliado'],
+                'valor_pago': pagamento['valorPago']} for pagamento in pagamentos]
+
+
+def exportar(conjunto, lotes, caminho, formato, vazio_grava=True, nomear=None):
+    # Grava em arquivo temporário e só substitui o destino no fim: uma exportação
+    # interrompida não deixa arquivo pela metade nem avança o estado incremental.
+    # nomear(faixas), quando dado, escolhe o destino pelas faixas de ids exportadas,
+    # que só se conhecem no fim. Devolve o número de linhas, as faixas e o destino.
+    temporario = f"{caminho}.{os.getpid()}.tmp"
+    colunas = COLUNAS[conjunto]
+    escritor = EscritorCSV(temporario, colunas) if formato == 'csv' else EscritorColunar(temporario, colunas, formato)
+    linhas, faixas = 0, []
+    try:
+        for lote in lotes:
+            escritor.escrever(lote)
+            linhas += len(lote)
+            if 'id' in lote[0]:
+                for linha in lote:
+                    if faixas and linha['id'] == faixas[-1][1] + 1:
+                        faixas[-1][1] = linha['id']
+                    else:
+                        faixas.append([linha['id'], linha['id']])
+    except BaseException:
+        escritor.fechar()
+        os.remove(temporario)
+        raise
+    escritor.fechar()
+    if nomear is not None and linhas:
+        caminho = nomear(IdsExportados(faixas).faixas)
+    if linhas or vazio_grava:
+        os.replace(temporario, caminho)
+    else:
+        os.remove(temporario)
+    return linhas, faixas, caminho
+
+
+def ler_estado(caminho):
+    try:
+        with open(caminho, encoding='utf-8') as arquivo:
+            return json.load(arquivo)
+    except FileNotFoundError:
+        return {}
+
+
+def gravar_estado(caminho, estado):
+    temporario = f"{caminho}.{os.getpid()}.tmp"
+    with open(temporario, 'w', encoding='utf-8') as arquivo:
+        json.dump(estado, arquivo, indent=2, ensure_ascii=False)
+    os.replace(temporario, caminho)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Exporta vendas, comissões pendentes e pagamentos em CSV, Parquet "
+                                                 "ou Arrow IPC, em lotes de tamanho fixo.")
+    parser.add_argument('--diretorio', default='.', help="diretório dos arquivos .pkl")
+    parser.add_argument('--saida', default='exportacao', help="diretório dos arquivos exportados")
+    parser.add_argument('--formato', choices=sorted(EXTENSOES), default='csv',
+                        help="'parquet' e 'arrow' precisam do pyarrow")
+    parser.add_argument('--conjuntos', nargs='+', choices=sorted(COLUNAS), default=sorted(COLUNAS))
+    parser.add_argument('--inicio', type=date.fromisoformat, help="só registros com data a partir desta")
+    parser.add_argument('--fim', type=date.fromisoformat, help="só registros com data até esta")
+    parser.add_argument('--lote', type=int, default=10000, help="linhas por lote (memória usada e grupos do Parquet)")
+    parser.add_argument('--incremental', action='store_true',
+                        help=f"só vendas e pagamentos ainda não exportados de modo incremental (os ids "
+                             f"exportados ficam em {ESTADO} na saída); não combina com --inicio/--fim. "
+                             f"Alterações de registros já exportados ficam de fora, use a exportação completa "
+                             f"ou os eventos (AFILIADOS_EVENTOS) para elas")
+    args = parser.parse_args()
+
+    if args.formato != 'csv' and pa is None:
+        parser.error(f"o formato '{args.formato}' precisa do pyarrow (pip install pyarrow)")
+    if args.lote < 1:
+        parser.error("--lote deve ser ao menos 1")
+    if args.inicio and args.fim and args.inicio > args.fim:
+        parser.error("--inicio deve ser anterior ou igual a --fim")
+    if args.incremental and (args.inicio or args.fim):
+        # Os ids exportados num período ficariam marcados e os de fora dele, não: o
+        # estado deixaria de descrever o que já saiu.
+        parser.error("--incremental não pode ser usado com --inicio/--fim")
+
+    saida = os.path.abspath(args.saida)
+    os.makedirs(saida, exist_ok=True)
+    os.chdir(args.diretorio)
+    periodo = Intervalo(args.inicio, args.fim)
+    resolvedor = Resolvedor()
+    venda_DAO, pagamento_DAO, afiliado_DAO = (VendaDAO(resolvedor=resolvedor), PagamentoDAO(resolvedor=resolvedor),
+                                              AfiliadoDAO(resolvedor=resolvedor))
+    caminho_estado = os.path.join(saida, ESTADO)
+    estado = ler_estado(caminho_estado)
+    carimbo = time.strftime('%Y-%m-%dT%H:%M:%S')
+
+    for conjunto in args.conjuntos:
+        incremental = args.incremental and conjunto in INCREMENTAIS
+        exportados = None
+        if incremental:
+            anterior = estado.get(conjunto, {})
+            if 'ultimo_id' in anterior:
+                # Estado das versões que guardavam só o último id exportado.
+                anterior = {'faixas': [[1, anterior['ultimo_id']]]}
+            exportados = IdsExportados(anterior.get('faixas', ()))
+        if conjunto == 'vendas':
+            lotes = lotes_vendas(venda_DAO, ArquivoVendas(), periodo, exportados, args.lote)
+        elif conjunto == 'comissoes':
+            lotes = lotes_comissoes(venda_DAO, afiliado_DAO, periodo, args.lote)
+        else:
+            lotes = lotes_pagamentos(pagamento_DAO, periodo, exportados, args.lote)
+        extensao = EXTENSOES[args.formato]
+        caminho = os.path.join(saida, f"{conjunto}.{extensao}")
+        # Cada exportação incremental vai para um arquivo novo, nomeado pelo menor id que
+        # contém; como cada id sai uma vez só, o nome não se repete.
+        nomear = None
+        if incremental:
+            nomear = lambda faixas: os.path.join(saida, f"{conjunto}_desde_{faixas[0][0]}.{extensao}")
+        inicio = time.perf_counter()
+        linhas, faixas, caminho = exportar(conjunto, lotes, caminho, args.formato, vazio_grava=not incremental,
+                                           nomear=nomear)
+        print(f"{conjunto}: {linhas} linhas em {time.perf_counter() - inicio:.2f}s"
+              + (f" -> {caminho}" if linhas or not incremental else ""))
+        if incremental:
+            estado[conjunto] = {'faixas': exportados.juntar(faixas).faixas, 'exportado_em': carimbo}
+            gravar_estado(caminho_estado, estado)
+
+
+if __name__ == '__main__':
+    main()
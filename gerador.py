@@ -0,0 +1,183 @@
+import argparse
+import math
+import os
+import random
+from bisect import bisect_left
+from collections import deque
+from datetime import date, timedelta
+from itertools import accumulate
+
+from index import Afiliado, Produto, Venda, AfiliadoDAO, ProdutoDAO, Resolvedor, VendaDAO
+
+
+# Peso relativo de cada mês nas datas das vendas (novembro e dezembro concentram
+# Black Friday e Natal; janeiro e fevereiro são mais fracos).
+SAZONALIDADE_PADRAO = {1: 0.8, 2: 0.8, 3: 0.9, 4: 0.9, 5: 1.0, 6: 0.9,
+                       7: 1.0, 8: 1.0, 9: 1.0, 10: 1.1, 11: 1.6, 12: 1.8}
+
+# Peso de cada dia da semana (segunda = 0).
+SEMANA_PADRAO = (1.0, 1.0, 1.0, 1.0, 1.1, 1.3, 0.8)
+
+
+class GeradorDados:
+    DISTRIBUICOES_FILHOS = ('fixa', 'poisson', 'geometrica')
+
+    def __init__(self, semente=None):
+        self.__aleatorio = random.Random(semente)
+
+    def __quantidade_filhos(self, distribuicao: str, media: float):
+        if distribuicao == 'fixa':
+            return int(round(media))
+        if distribuicao == 'poisson':
+            limite, k, p = math.exp(-media), 0, 1.0
+            while True:
+                p *= self.__aleatorio.random()
+                if p <= limite:
+                    return k
+                k += 1
+        if distribuicao == 'geometrica':
+            # Cauda longa: a maioria indica poucos afiliados e alguns indicam muitos.
+            if media <= 0:
+                return 0
+            sucesso = 1 / (1 + media)
+            return int(math.log(1 - self.__aleatorio.random()) / math.log(1 - sucesso))
+        raise ValueError(f"distribuição de filhos deve ser uma de {self.DISTRIBUICOES_FILHOS}")
+
+    def afiliados(self, quantidade: int, raizes: int = 1, profundidade_maxima: int = 5,
+                  filhos_media: float = 3.0, distribuicao: str = 'poisson', primeiro_id: int = 1):
+        if raizes < 1 and quantidade > 0:
+            # Sem raízes a fila nunca recebe o primeiro afiliado.
+            raise ValueError("raizes deve ser ao menos 1")
+        gerados = []
+        fila = deque()
+        proximo_id = primeiro_id
+        while len(gerados) < quantidade:
+            if not fila:
+                # Sem mais nós para expandir (ou início): começa novas árvores.
+                for _ in range(min(raizes, quantidade - len(gerados))):
+                    raiz = Afiliado(proximo_id, f"Afiliado {proximo_id}", f"afiliado{proximo_id}@exemplo.com")
+                    proximo_id += 1
+                    gerados.append(raiz)
+                    fila.append((raiz, 0))
+                continue
+            parent, profundidade = fila.popleft()
+            if profundidade >= profundidade_maxima:
+                continue
+            for _ in range(self.__quantidade_filhos(distribuicao, filhos_media)):
+                if len(gerados) >= quantidade:
+                    break
+                filho = Afiliado(proximo_id, f"Afiliado {proximo_id}",
+                                 f"afiliado{proximo_id}@exemplo.com", parent)
+                proximo_id += 1
+                gerados.append(filho)
+                fila.append((filho, profundidade + 1))
+        return gerados
+
+    def produtos(self, quantidade: int, preco_mediano: float = 80.0, dispersao: float = 0.8,
+                 preco_minimo: float = 1.0, primeiro_codigo: int = 1):
+        # Preços log-normais: muitos produtos baratos e poucos caros.
+        produtos = []
+        for codigo in range(primeiro_codigo, primeiro_codigo + quantidade):
+            preco = max(preco_minimo, self.__aleatorio.lognormvariate(math.log(preco_mediano), dispersao))
+            produtos.append(Produto(f"P{codigo}", f"Produto {codigo}",
+                                    f"Produto sintético {codigo}", round(preco, 2)))
+        return produtos
+
+    def __pesos_popularidade(self, quantidade: int, expoente: float):
+        # Lei de Zipf sobre uma ordem aleatória: poucos itens concentram boa parte das vendas.
+        pesos = [1 / (posicao ** expoente) for posicao in range(1, quantidade + 1)]
+        self.__aleatorio.shuffle(pesos)
+        return list(accumulate(pesos))
+
+    def __escolher(self, itens, acumulados):
+        return itens[bisect_left(acumulados, self.__aleatorio.random() * acumulados[-1])]
+
+    def vendas(self, quantidade: int, afiliados, produtos, data_inicial: date, data_final: date,
+               sazonalidade=None, semana=SEMANA_PADRAO, quantidade_media: float = 2.0,
+               concentracao: float = 1.0, primeiro_id: int = 1):
+        if not afiliados or not produtos:
+            raise ValueError("É preciso ao menos um afiliado e um produto para gerar vendas")
+        if data_inicial > data_final:
+            raise ValueError("data_inicial deve ser anterior ou igual a data_final")
+        sazonalidade = sazonalidade or SAZONALIDADE_PADRAO
+
+        dias = [data_inicial + timedelta(days=d) for d in range((data_final - data_inicial).days + 1)]
+        pesos_dias = list(accumulate(sazonalidade.get(dia.month, 1.0) * semana[dia.weekday()] for dia in dias))
+        pesos_afiliados = self.__pesos_popularidade(len(afiliados), concentracao)
+        pesos_produtos = self.__pesos_popularidade(len(produtos), concentracao)
+
+        # Gerador: as vendas saem uma a uma, sem montar antes a lista inteira. Não
+        # economiza memória: cada venda fica no cache do DAO em que for gravada.
+        for id in range(primeiro_id, primeiro_id + quantidade):
+            yield Venda(
+                id,
+                self.__escolher(dias, pesos_dias),
+                self.__escolher(afiliados, pesos_afiliados),
+                self.__escolher(produtos, pesos_produtos),
+                1 + int(self.__aleatorio.expovariate(1 / max(quantidade_media - 1, 1e-9)))
+            )
+
+
+def gravar_em_lote(dao, entidades):
+    quantidade = 0
+    with dao.agrupar_escritas():
+        for entidade in entidades:
+            dao.add(entidade)
+            quantidade += 1
+    return quantidade
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Gera afiliados, produtos e vendas sintéticos nos arquivos de dados.")
+    parser.add_argument('--diretorio', default='.', help="diretório dos arquivos .pkl")
+    parser.add_argument('--semente', type=int)
+    parser.add_argument('--afiliados', type=int, default=100)
+    parser.add_argument('--raizes', type=int, default=5, help="afiliados sem 'pai' criados a cada nova árvore")
+    parser.add_argument('--profundidade', type=int, default=5, help="profundidade máxima da rede")
+    parser.add_argument('--filhos', type=float, default=3.0, help="média de afiliados indicados por afiliado")
+    parser.add_argument('--distribuicao-filhos', choices=GeradorDados.DISTRIBUICOES_FILHOS, default='poisson')
+    parser.add_argument('--produtos', type=int, default=50)
+    parser.add_argument('--preco-mediano', type=float, default=80.0)
+    parser.add_argument('--dispersao-preco', type=float, default=0.8)
+    parser.add_argument('--vendas', type=int, default=1000)
+    parser.add_argument('--inicio', type=date.fromisoformat, default=date.today() - timedelta(days=365))
+    parser.add_argument('--fim', type=date.fromisoformat, default=date.today())
+    parser.add_argument('--quantidade-media', type=float, default=2.0, help="itens por venda, em média")
+    args = parser.parse_args()
+
+    if args.fim > date.today():
+        parser.error("--fim não pode ser uma data futura")
+    if args.raizes < 1:
+        parser.error("--raizes deve ser ao menos 1")
+    for opcao in ('afiliados', 'produtos', 'vendas'):
+        if getattr(args, opcao) < 0:
+            parser.error(f"--{opcao} não pode ser negativo")
+
+    os.chdir(args.diretorio)
+    resolvedor = Resolvedor()
+    afiliado_DAO, produto_DAO, venda_DAO = (AfiliadoDAO(resolvedor=resolvedor), ProdutoDAO(resolvedor=resolvedor),
+                                            VendaDAO(resolvedor=resolvedor))
+    gerador = GeradorDados(args.semente)
+
+    # Continua a numeração dos dados existentes em vez de sobrescrevê-los.
+    primeiro_afiliado = max((a.id for a in afiliado_DAO.get_all()), default=0) + 1
+    primeiro_produto = 1 + max((int(p.codigo[1:]) for p in produto_DAO.get_all()
+                                if p.codigo[:1] == 'P' and p.codigo[1:].isdigit()), default=0)
+    # As vendas reservam um bloco de ids na sequência do VendaDAO.
+    primeira_venda = venda_DAO.reservar_ids(args.vendas).start if args.vendas > 0 else 1
+
+    afiliados = gerador.afiliados(args.afiliados, args.raizes, args.profundidade, args.filhos,
+                                  args.distribuicao_filhos, primeiro_afiliado)
+    produtos = gerador.produtos(args.produtos, args.preco_mediano, args.dispersao_preco,
+                                primeiro_codigo=primeiro_produto)
+    gravar_em_lote(afiliado_DAO, afiliados)
+    gravar_em_lote(produto_DAO, produtos)
+    vendas = gravar_em_lote(venda_DAO, gerador.vendas(args.vendas, afiliados, produtos, args.inicio, args.fim,
+                                                      quantidade_media=args.quantidade_media,
+                                                      primeiro_id=primeira_venda))
+    print(f"Gerados {len(afiliados)} afiliados, {len(produtos)} produtos e {vendas} vendas em "
+          f"{os.path.abspath('.')}")
+
+
+if __name__ == '__main__':
+    main()
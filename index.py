@@ -1,7 +1,46 @@
-from datetime import date
+from datetime import date, timedelta
 import pickle
+import io
+import struct
+import mmap
+import os
+import gc
+import weakref
+from array import array
+from collections import OrderedDict
+from bisect import bisect_left, bisect_right, insort
 from abc import ABC, abstractmethod
-import PySimpleGUI as sg
+from contextlib import contextmanager
+import threading
+import heapq
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain, repeat
+import atexit
+import time
+import json
+import re
+import unicodedata
+import queue
+import socket
+from functools import wraps, partial
+from datetime import datetime
+import cProfile
+import pstats
+import tracemalloc
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+try:
+    import PySimpleGUI as sg
+except ImportError:
+    # Permite usar o modelo, os DAOs e os controladores sem interface (benchmarks, scripts).
+    sg = None
 
 
 class EntidadeNaoEncontradaException(Exception):
@@ -40,49 +79,2329 @@ class ViolacaoRegraNegocioException(Exception):
     def __init__(self, mensagem: str = "Violação de regra de negócio!"):
         super().__init__(mensagem)
 
+class OperacaoCanceladaException(Exception):
+    def __init__(self, mensagem: str = "Operação cancelada pelo usuário"):
+        super().__init__(mensagem)
+
+class Instrumentacao:
+    __operacoes = {}
+    __contadores = {}
+    __trava = threading.Lock()
+    # Ações em andamento na thread (a mais interna por último), para pausa() e falha().
+    __local = threading.local()
+
+    @classmethod
+    def registrar(cls, nome: str, segundos: float, bytes_escritos: int = 0, erro: bool = False):
+        with cls.__trava:
+            metrica = cls.__operacoes.setdefault(nome, {
+                'chamadas': 0, 'erros': 0, 'segundos_total': 0.0,
+                'segundos_max': 0.0, 'segundos_ultima': 0.0, 'bytes_escritos': 0
+            })
+            metrica['chamadas'] += 1
+            metrica['erros'] += 1 if erro else 0
+            metrica['segundos_total'] += segundos
+            metrica['segundos_max'] = max(metrica['segundos_max'], segundos)
+            metrica['segundos_ultima'] = segundos
+            metrica['bytes_escritos'] += bytes_escritos
+
+    @classmethod
+    def contar(cls, nome: str, quantidade: int = 1):
+        with cls.__trava:
+            cls.__contadores[nome] = cls.__contadores.get(nome, 0) + quantidade
+
+    @classmethod
+    @contextmanager
+    def medir(cls, nome: str):
+        # Quem mede pode anotar em medicao['bytes_escritos'] quanto gravou.
+        inicio = time.perf_counter()
+        medicao = {'bytes_escritos': 0}
+        erro = False
+        try:
+            yield medicao
+        except BaseException:
+            erro = True
+            raise
+        finally:
+            cls.registrar(nome, time.perf_counter() - inicio, medicao['bytes_escritos'], erro)
+
+    @classmethod
+    @contextmanager
+    def acao(cls, nome: str):
+        # Uma ação do usuário: o tempo dos diálogos (pausa()) fica de fora, e os erros
+        # que o próprio controlador trata e mostra contam pelo falha(). Cancelar não é erro.
+        acoes = getattr(cls.__local, 'acoes', None)
+        if acoes is None:
+            acoes = cls.__local.acoes = []
+        estado = {'pausado': 0.0, 'erro': False}
+        acoes.append(estado)
+        inicio = time.perf_counter()
+        try:
+            with Perfilador.perfilar(nome):
+                yield
+        except OperacaoCanceladaException:
+            raise
+        except BaseException:
+            estado['erro'] = True
+            raise
+        finally:
+            acoes.pop()
+            cls.registrar(nome, time.perf_counter() - inicio - estado['pausado'], erro=estado['erro'])
+
+    @classmethod
+    def instrumentar(cls, nome: str):
+        def decorador(funcao):
+            @wraps(funcao)
+            def instrumentada(*args, **kwargs):
+                with cls.acao(nome):
+                    return funcao(*args, **kwargs)
+            return instrumentada
+        return decorador
+
+    @classmethod
+    @contextmanager
+    def pausa(cls):
+        acoes = getattr(cls.__local, 'acoes', None)
+        if not acoes:
+            yield
+            return
+        inicio = time.perf_counter()
+        try:
+            with Perfilador.pausa():
+                yield
+        finally:
+            pausado = time.perf_counter() - inicio
+            for estado in acoes:
+                estado['pausado'] += pausado
+
+    @classmethod
+    def dialogo(cls, funcao):
+        # Métodos das telas que esperam pelo usuário: não entram no tempo da ação.
+        @wraps(funcao)
+        def pausada(*args, **kwargs):
+            with cls.pausa():
+                return funcao(*args, **kwargs)
+        return pausada
+
+    @classmethod
+    def falha(cls):
+        acoes = getattr(cls.__local, 'acoes', None)
+        if acoes:
+            acoes[-1]['erro'] = True
+
+    @classmethod
+    def operacoes(cls):
+        with cls.__trava:
+            return {nome: dict(metrica) for nome, metrica in cls.__operacoes.items()}
+
+    @classmethod
+    def contadores(cls):
+        with cls.__trava:
+            return dict(cls.__contadores)
+
+    @classmethod
+    def limpar(cls):
+        with cls.__trava:
+            cls.__operacoes.clear()
+            cls.__contadores.clear()
+
+    @classmethod
+    def exportar_json(cls):
+        return json.dumps({'operacoes': cls.operacoes(), 'contadores': cls.contadores()},
+                          indent=2, ensure_ascii=False)
+
+    @classmethod
+    def exportar_prometheus(cls):
+        def rotulo(valor):
+            return valor.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+        linhas = []
+        series = (
+            ('afiliados_operacao_chamadas_total', 'counter', 'chamadas'),
+            ('afiliados_operacao_erros_total', 'counter', 'erros'),
+            ('afiliados_operacao_segundos_total', 'counter', 'segundos_total'),
+            ('afiliados_operacao_segundos_max', 'gauge', 'segundos_max'),
+            ('afiliados_operacao_bytes_escritos_total', 'counter', 'bytes_escritos'),
+        )
+        operacoes = cls.operacoes()
+        for serie, tipo, campo in series:
+            linhas.append(f"# TYPE {serie} {tipo}")
+            for nome, metrica in sorted(operacoes.items()):
+                linhas.append(f'{serie}{{operacao="{rotulo(nome)}"}} {metrica[campo]}')
+        linhas.append("# TYPE afiliados_contador_total counter")
+        for nome, valor in sorted(cls.contadores().items()):
+            linhas.append(f'afiliados_contador_total{{nome="{rotulo(nome)}"}} {valor}')
+        return "\n".join(linhas) + "\n"
+
+    @classmethod
+    def resumo(cls):
+        linhas = ["=== Operações ===", ""]
+        operacoes = sorted(cls.operacoes().items(), key=lambda item: item[1]['segundos_total'], reverse=True)
+        for nome, m in operacoes:
+            media = m['segundos_total'] / m['chamadas'] * 1000 if m['chamadas'] else 0
+            linhas.append(f"{nome} | Chamadas: {m['chamadas']} | Erros: {m['erros']} | "
+                          f"Total: {m['segundos_total']:.3f}s | Média: {media:.1f}ms | "
+                          f"Máx: {m['segundos_max'] * 1000:.1f}ms | Bytes: {m['bytes_escritos']}")
+        linhas += ["", "=== Contadores ===", ""]
+        for nome, valor in sorted(cls.contadores().items()):
+            linhas.append(f"{nome}: {valor}")
+        return "\n".join(linhas)
+
+class Perfilador:
+    # Ativado pela variável de ambiente AFILIADOS_PERFIL (diretório de saída) ou pelo menu principal.
+    __diretorio = os.environ.get('AFILIADOS_PERFIL') or None
+    __local = threading.local()
+
+    @classmethod
+    def ativo(cls):
+        return cls.__diretorio is not None
+
+    @classmethod
+    def diretorio(cls):
+        return cls.__diretorio
+
+    @classmethod
+    def ativar(cls, diretorio: str = 'perfis'):
+        cls.__diretorio = diretorio
+
+    @classmethod
+    def desativar(cls):
+        cls.__diretorio = None
+
+    @classmethod
+    @contextmanager
+    def perfilar(cls, nome: str):
+        # Só a ação mais externa é perfilada; ações chamadas de dentro dela entram no mesmo perfil.
+        if cls.__diretorio is None or getattr(cls.__local, 'ativo', False):
+            yield
+            return
+        diretorio = cls.__diretorio
+        cls.__local.ativo = True
+        iniciou_tracemalloc = not tracemalloc.is_tracing()
+        if iniciou_tracemalloc:
+            tracemalloc.start(10)
+        tracemalloc.reset_peak()
+        antes = tracemalloc.take_snapshot()
+        perfil = cProfile.Profile()
+        perfis = [perfil]
+        cls.__local.perfil, cls.__local.perfis, cls.__local.pausado = perfil, perfis, 0.0
+        inicio = time.perf_counter()
+        perfil.enable()
+        try:
+            yield
+        finally:
+            perfil.disable()
+            duracao = time.perf_counter() - inicio - cls.__local.pausado
+            cls.__local.perfil = cls.__local.perfis = None
+            depois = tracemalloc.take_snapshot()
+            _, pico = tracemalloc.get_traced_memory()
+            if iniciou_tracemalloc:
+                tracemalloc.stop()
+            cls.__local.ativo = False
+            try:
+                cls.__gravar(diretorio, nome, perfis, duracao, pico, depois.compare_to(antes, 'lineno'))
+            except OSError:
+                pass
+
+    @classmethod
+    def em_thread(cls, funcao):
+        # O cProfile só registra a thread em que foi ativado. Uma função que a ação
+        # perfilada manda rodar em outra thread (ex.: a operação de TelaProgresso)
+        # ganha ali um perfil próprio, somado ao da ação na gravação.
+        perfis = getattr(cls.__local, 'perfis', None)
+        if perfis is None:
+            return funcao
+
+        @wraps(funcao)
+        def perfilada(*args, **kwargs):
+            # Ações chamadas nesta thread entram neste perfil, como na thread da ação.
+            cls.__local.ativo = True
+            perfil = cProfile.Profile()
+            perfil.enable()
+            try:
+                return funcao(*args, **kwargs)
+            finally:
+                perfil.disable()
+                cls.__local.ativo = False
+                perfis.append(perfil)
+        return perfilada
+
+    @classmethod
+    @contextmanager
+    def pausa(cls, descontar=True):
+        # Com descontar=False o tempo continua na duração da ação e só sai do perfil
+        # (ex.: a thread da tela esperando a thread de trabalho).
+        perfil = getattr(cls.__local, 'perfil', None)
+        if perfil is None:
+            yield
+            return
+        perfil.disable()
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            if descontar:
+                cls.__local.pausado += time.perf_counter() - inicio
+            perfil.enable()
+
+    @staticmethod
+    def __gravar(diretorio, nome, perfis, duracao, pico, alocacoes):
+        os.makedirs(diretorio, exist_ok=True)
+        base = os.path.join(diretorio, f"{datetime.now():%Y%m%d-%H%M%S-%f}-{nome}")
+        relatorio = io.StringIO()
+        estatisticas = pstats.Stats(*perfis, stream=relatorio)
+        estatisticas.dump_stats(f"{base}.prof")
+
+        relatorio.write(f"Ação: {nome}\nDuração: {duracao:.3f}s\nPico de memória: {pico / 1024:.1f} KiB\n\n")
+        relatorio.write("=== Funções por tempo acumulado ===\n")
+        estatisticas.sort_stats('cumulative').print_stats(30)
+        relatorio.write("\n=== Principais pontos de alocação ===\n")
+        for estatistica in alocacoes[:25]:
+            relatorio.write(f"{estatistica}\n")
+        with open(f"{base}.txt", 'w', encoding='utf-8') as arquivo:
+            arquivo.write(relatorio.getvalue())
+
+class CarregadorEntidades(pickle.Unpickler):
+    # Os arquivos gravados pela aplicação referenciam as classes em '__main__', e os
+    # gravados por scripts que importam este módulo (gerador, benchmark) em 'index'.
+    # Ambos são resolvidos para as classes deste módulo.
+    def find_class(self, module, name):
+        if module in ('__main__', 'index', __name__) and isinstance(globals().get(name), type):
+            return globals()[name]
+        return super().find_class(module, name)
+
+    @classmethod
+    def carregar(cls, dados: bytes):
+        return cls(io.BytesIO(dados)).load()
+
+class Codec(ABC):
+    # Converte um registro (tupla de tipos simples) em bytes e de volta. O estado do
+    # codec (ex.: a tabela de textos) é gravado no índice do arquivo, junto com o nome.
+    nome = ''
+    __tipos = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        Codec.__tipos[cls.nome] = cls
+
+    @staticmethod
+    def criar(nome: str, campos: str = ''):
+        if nome not in Codec.__tipos:
+            raise DadoInvalidoException("codec", nome, f"Use um de: {', '.join(Codec.__tipos)}")
+        return Codec.__tipos[nome](campos)
+
+    @staticmethod
+    def nomes():
+        return tuple(Codec.__tipos)
+
+    @abstractmethod
+    def codificar(self, registro) -> bytes:
+        pass
+
+    @abstractmethod
+    def decodificar(self, dados) -> tuple:
+        pass
+
+    def estado(self):
+        return None
+
+    def restaurar(self, estado):
+        pass
+
+class CodecPickle(Codec):
+    nome = 'pickle'
+
+    def __init__(self, campos: str = ''):
+        pass
+
+    def codificar(self, registro):
+        return pickle.dumps(registro, pickle.HIGHEST_PROTOCOL)
+
+    def decodificar(self, dados):
+        return pickle.loads(dados)
+
+class CodecBinario(Codec):
+    # Campos: q inteiro de 64 bits, i inteiro de 32 bits, d real, s texto, n inteiro
+    # opcional e l lista de inteiros. Os campos de tamanho fixo vão num único struct
+    # (textos como índice na tabela de textos do arquivo) e as listas vêm em seguida.
+    nome = 'binario'
+    __FORMATOS = {'q': 'q', 'i': 'i', 'd': 'd', 's': 'I', 'n': 'q', 'l': 'I'}
+    __NULO = -2 ** 63
+    __CURTA = 2 ** 31
+
+    def __init__(self, campos: str = ''):
+        if not campos or any(campo not in self.__FORMATOS for campo in campos):
+            raise DadoInvalidoException("campos", campos, "Use apenas q, i, d, s, n e l")
+        self.__fixo = struct.Struct('<' + ''.join(self.__FORMATOS[campo] for campo in campos))
+        self.__posicoes_textos = [i for i, campo in enumerate(campos) if campo == 's']
+        self.__posicoes_nulos = [i for i, campo in enumerate(campos) if campo == 'n']
+        self.__posicoes_listas = [i for i, campo in enumerate(campos) if campo == 'l']
+        self.__textos = []
+        self.__indices = {}
+        self.__trava = threading.Lock()
+
+    def __indice(self, texto):
+        indice = self.__indices.get(texto)
+        if indice is None:
+            with self.__trava:
+                indice = self.__indices.get(texto)
+                if indice is None:
+                    indice = self.__indices[texto] = len(self.__textos)
+                    self.__textos.append(texto)
+        return indice
+
+    def codificar(self, registro):
+        valores = list(registro)
+        for i in self.__posicoes_textos:
+            valores[i] = self.__indice(valores[i])
+        for i in self.__posicoes_nulos:
+            if valores[i] is None:
+                valores[i] = self.__NULO
+        listas = []
+        for i in self.__posicoes_listas:
+            lista = valores[i]
+            # Listas em que todos os valores cabem em 32 bits usam metade do espaço;
+            # o bit mais alto da quantidade indica o tamanho dos itens.
+            if not lista or (min(lista) >= -2 ** 31 and max(lista) < 2 ** 31):
+                valores[i] = len(lista) | self.__CURTA
+                listas.append(struct.pack(f'<{len(lista)}i', *lista))
+            else:
+                valores[i] = len(lista)
+                listas.append(struct.pack(f'<{len(lista)}q', *lista))
+        return b''.join([self.__fixo.pack(*valores)] + listas)
+
+    def decodificar(self, dados):
+        textos = self.__textos
+        if not self.__posicoes_listas:
+            valores = list(self.__fixo.unpack(dados))
+        else:
+            valores = list(self.__fixo.unpack_from(dados))
+            posicao = self.__fixo.size
+            for i in self.__posicoes_listas:
+                quantidade = valores[i]
+                if quantidade & self.__CURTA:
+                    quantidade &= ~self.__CURTA
+                    valores[i] = list(struct.unpack_from(f'<{quantidade}i', dados, posicao))
+                    posicao += 4 * quantidade
+                else:
+                    valores[i] = list(struct.unpack_from(f'<{quantidade}q', dados, posicao))
+                    posicao += 8 * quantidade
+        for i in self.__posicoes_textos:
+            valores[i] = textos[valores[i]]
+        for i in self.__posicoes_nulos:
+            if valores[i] == self.__NULO:
+                valores[i] = None
+        return tuple(valores)
+
+    def estado(self):
+        with self.__trava:
+            return list(self.__textos)
+
+    def restaurar(self, estado):
+        with self.__trava:
+            self.__textos = list(estado)
+            self.__indices = {texto: i for i, texto in enumerate(self.__textos)}
+
+class Intervalo:
+    # Critério de DAO.consultar para faixas de valores (limites inclusivos; None deixa o lado aberto).
+    def __init__(self, inicio=None, fim=None):
+        if inicio is not None and fim is not None and inicio > fim:
+            raise DadoInvalidoException("Intervalo", f"{inicio} a {fim}", "Início maior que o fim")
+        self.__inicio = inicio
+        self.__fim = fim
+
+    @property
+    def inicio(self):
+        return self.__inicio
+
+    @property
+    def fim(self):
+        return self.__fim
+
+    def contem(self, valor):
+        if valor is None:
+            return False
+        return (self.__inicio is None or valor >= self.__inicio) and (self.__fim is None or valor <= self.__fim)
+
+class EventoAlteracao:
+    # Evento de captura de alterações emitido por um DAO a cada inclusão, alteração ou
+    # exclusão feita neste processo. antes/depois são dicionários coluna -> valor; antes
+    # é None na inclusão e quando o estado anterior não é mais conhecido (objeto já
+    # alterado no lugar antes de haver assinantes). sequencia ordena os eventos de um
+    # mesmo DAO dentro do processo.
+    def __init__(self, entidade, operacao, chave, antes, depois, momento, sequencia):
+        self.__entidade = entidade
+        self.__operacao = operacao
+        self.__chave = chave
+        self.__antes = antes
+        self.__depois = depois
+        self.__momento = momento
+        self.__sequencia = sequencia
+        self.__processo = os.getpid()
+
+    @property
+    def entidade(self):
+        return self.__entidade
+
+    @property
+    def operacao(self):
+        return self.__operacao
+
+    @property
+    def chave(self):
+        return self.__chave
+
+    @property
+    def antes(self):
+        return self.__antes
+
+    @property
+    def depois(self):
+        return self.__depois
+
+    @property
+    def momento(self):
+        return self.__momento
+
+    @property
+    def sequencia(self):
+        return self.__sequencia
+
+    @property
+    def processo(self):
+        return self.__processo
+
+    def como_dicionario(self):
+        return {
+            'entidade': self.__entidade,
+            'operacao': self.__operacao,
+            'chave': self.__chave,
+            'antes': self.__antes,
+            'depois': self.__depois,
+            'momento': datetime.fromtimestamp(self.__momento).isoformat(),
+            'sequencia': self.__sequencia,
+            'processo': self.__processo
+        }
+
+    def json(self):
+        # Datas viram texto AAAA-MM-DD.
+        return json.dumps(self.como_dicionario(), ensure_ascii=False, default=str)
+
+class AssinanteEventos(ABC):
+    # Assinante (DAO.assinar) que entrega os eventos em linhas JSON numa thread
+    # própria, para que gravar ou enviar não atrase as alterações nos DAOs. Com
+    # MAXIMO_PENDENTES, eventos além do limite são descartados e contados.
+    MAXIMO_PENDENTES = None
+    LOTE = 1000
+
+    def __init__(self):
+        self.__fila = queue.Queue(self.MAXIMO_PENDENTES or 0)
+        self.__trava = threading.Lock()
+        self.__entregador = None
+
+    @staticmethod
+    def criar(destino: str):
+        # 'unix:/caminho' e 'tcp:host:porta' enviam por socket; o resto é um arquivo JSONL.
+        if destino.startswith('unix:'):
+            return AssinanteSocket(destino[len('unix:'):])
+        if destino.startswith('tcp:'):
+            host, _, porta = destino[len('tcp:'):].rpartition(':')
+            if not host or not porta.isdigit():
+                raise DadoInvalidoException("Destino", destino, "Use tcp:host:porta")
+            return AssinanteSocket((host, int(porta)))
+        return AssinanteArquivo(destino)
+
+    def __call__(self, evento):
+        with self.__trava:
+            if self.__entregador is None:
+                self.__entregador = threading.Thread(target=self.__entregar, name=f"eventos-{type(self).__name__}",
+                                                     daemon=True)
+                self.__entregador.start()
+                atexit.register(self.fechar)
+        try:
+            self.__fila.put_nowait(evento)
+        except queue.Full:
+            Instrumentacao.contar('eventos.descartados')
+
+    def __entregar(self):
+        while True:
+            eventos = [self.__fila.get()]
+            while eventos[-1] is not None and len(eventos) < self.LOTE:
+                try:
+                    eventos.append(self.__fila.get_nowait())
+                except queue.Empty:
+                    break
+            linhas = [evento.json() + '\n' for evento in eventos if evento is not None]
+            try:
+                if linhas:
+                    self.enviar(''.join(linhas).encode('utf-8'))
+                    Instrumentacao.contar('eventos.entregues', len(linhas))
+            except Exception:
+                Instrumentacao.contar('eventos.descartados', len(linhas))
+            finally:
+                for _ in eventos:
+                    self.__fila.task_done()
+            if eventos[-1] is None:
+                self.encerrar()
+                return
+
+    def aguardar(self):
+        # Espera a entrega de tudo o que já foi recebido.
+        self.__fila.join()
+
+    def fechar(self):
+        with self.__trava:
+            entregador, self.__entregador = self.__entregador, None
+        if entregador is not None:
+            self.__fila.put(None)
+            entregador.join()
+
+    @abstractmethod
+    def enviar(self, dados: bytes):
+        pass
+
+    def encerrar(self):
+        pass
+
+class AssinanteArquivo(AssinanteEventos):
+    # Cada lote vai numa única escrita em modo de acréscimo, então vários processos
+    # podem gravar no mesmo arquivo sem misturar linhas.
+    def __init__(self, caminho='eventos.jsonl'):
+        super().__init__()
+        self.__caminho = caminho
+        self.__arquivo = None
+
+    @property
+    def caminho(self):
+        return self.__caminho
+
+    def enviar(self, dados: bytes):
+        if self.__arquivo is None:
+            self.__arquivo = open(self.__caminho, 'ab', buffering=0)
+        self.__arquivo.write(dados)
+
+    def encerrar(self):
+        if self.__arquivo is not None:
+            self.__arquivo.close()
+            self.__arquivo = None
+
+class AssinanteSocket(AssinanteEventos):
+    # Envia as linhas a um consumidor local (socket Unix ou TCP). Sem consumidor
+    # conectado, os eventos são descartados e a conexão é tentada de novo a cada
+    # INTERVALO_RECONEXAO segundos.
+    MAXIMO_PENDENTES = 10000
+    INTERVALO_RECONEXAO = 5.0
+
+    def __init__(self, endereco):
+        super().__init__()
+        self.__endereco = endereco
+        self.__socket = None
+        self.__proxima_tentativa = 0.0
+
+    @property
+    def endereco(self):
+        return self.__endereco
+
+    def __conectar(self):
+        if time.monotonic() < self.__proxima_tentativa:
+            raise ConnectionError(f"Sem conexão com {self.__endereco}")
+        try:
+            if isinstance(self.__endereco, str):
+                conexao = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                try:
+                    conexao.connect(self.__endereco)
+                except OSError:
+                    conexao.close()
+                    raise
+            else:
+                conexao = socket.create_connection(self.__endereco, timeout=self.INTERVALO_RECONEXAO)
+        except OSError:
+            self.__proxima_tentativa = time.monotonic() + self.INTERVALO_RECONEXAO
+            raise
+        return conexao
+
+    def enviar(self, dados: bytes):
+        if self.__socket is None:
+            self.__socket = self.__conectar()
+        try:
+            self.__socket.sendall(dados)
+        except OSError:
+            self.encerrar()
+            raise
+
+    def encerrar(self):
+        if self.__socket is not None:
+            self.__socket.close()
+            self.__socket = None
+
+class IndicePalavras:
+    # Índice invertido (palavra -> chaves) usado por DAO.buscar. Cada palavra leva na
+    # frente uma letra com a coluna de onde veio ('A' para a primeira de `busca`, 'B'
+    # para a segunda...), para que a busca possa se limitar a algumas colunas.
+    # A base fica em arrays (palavras ordenadas, chaves de cada palavra e palavras de
+    # cada chave), gravados e lidos quase sem conversão e nunca alterados no lugar. O
+    # que muda depois fica em dicionários, e as chaves alteradas deixam de valer na
+    # base, até a próxima compactação.
+    MAGICO = b'AFBUS\x00'
+    VERSAO = 1
+    # Mágico, versão, carimbo do arquivo de dados (tamanho e mtime) e tamanho dos metadados.
+    CABECALHO = struct.Struct('<6sHqqQ')
+    ULTIMA = '\U0010ffff'
+
+    def __init__(self):
+        self.__chaves = []
+        self.__numeros = {}
+        self.__palavras = []
+        self.__inicios = array('i', [0])
+        self.__postagens = array('i')
+        self.__inicios_chave = array('i', [0])
+        self.__palavras_chave = array('i')
+        self.__invalidas = set()
+        self.__por_palavra = {}
+        self.__por_chave = {}
+        self.__ordenadas = []
+        self.__tocadas = None
+        # Palavras da base numa só string, montada na primeira busca parcial.
+        self.__texto = None
+        self.__inicios_texto = None
+
+    @staticmethod
+    def etiqueta(posicao):
+        return chr(ord('A') + posicao)
+
+    @staticmethod
+    def montar(pares):
+        indice = IndicePalavras()
+        indice.__montar_base(pares)
+        return indice
+
+    def __montar_base(self, pares):
+        # pares: (chave, palavras). Na base as chaves ficam em ordem, e com elas as
+        # chaves de cada palavra.
+        pares = sorted((par for par in pares if par[1]), key=lambda par: par[0])
+        por_palavra = {}
+        for numero, (_, palavras) in enumerate(pares):
+            for palavra in palavras:
+                if palavra in por_palavra:
+                    por_palavra[palavra].append(numero)
+                else:
+                    por_palavra[palavra] = [numero]
+        palavras = sorted(por_palavra)
+        inicios, postagens = array('i', [0]), array('i')
+        for palavra in palavras:
+            postagens.extend(por_palavra[palavra])
+            inicios.append(len(postagens))
+        numeros = {palavra: numero for numero, palavra in enumerate(palavras)}
+        inicios_chave, palavras_chave = array('i', [0]), array('i')
+        for _, palavras_da_chave in pares:
+            palavras_chave.extend(numeros[palavra] for palavra in palavras_da_chave)
+            inicios_chave.append(len(palavras_chave))
+        self.__chaves = [chave for chave, _ in pares]
+        self.__numeros = {chave: numero for numero, chave in enumerate(self.__chaves)}
+        self.__palavras, self.__inicios, self.__postagens = palavras, inicios, postagens
+        self.__inicios_chave, self.__palavras_chave = inicios_chave, palavras_chave
+        self.__invalidas, self.__por_palavra, self.__por_chave, self.__ordenadas = set(), {}, {}, []
+        self.__texto = self.__inicios_texto = None
+
+    def __len__(self):
+        return len(self.__chaves) - len(self.__invalidas) + len(self.__por_chave)
+
+    def __da_base(self, chave):
+        numero = self.__numeros.get(chave)
+        if numero is None:
+            return None
+        posicoes = self.__palavras_chave[self.__inicios_chave[numero]:self.__inicios_chave[numero + 1]]
+        return frozenset(self.__palavras[posicao] for posicao in posicoes)
+
+    def palavras(self, chave):
+        if chave in self.__por_chave:
+            return self.__por_chave[chave]
+        if chave in self.__invalidas:
+            return frozenset()
+        return self.__da_base(chave) or frozenset()
+
+    def trocar(self, chave, novas):
+        if self.__tocadas is not None:
+            self.__tocadas.add(chave)
+        base = self.__da_base(chave)
+        if base is not None:
+            if base == novas:
+                # Alteração fora das colunas de busca: a base continua valendo.
+                self.__invalidas.discard(chave)
+                novas = frozenset()
+            else:
+                self.__invalidas.add(chave)
+        antigas = self.__por_chave.pop(chave, frozenset())
+        for palavra in antigas - novas:
+            chaves = self.__por_palavra[palavra]
+            chaves.discard(chave)
+            if not chaves:
+                del self.__por_palavra[palavra]
+                del self.__ordenadas[bisect_left(self.__ordenadas, palavra)]
+        for palavra in novas - antigas:
+            if palavra in self.__por_palavra:
+                self.__por_palavra[palavra].add(chave)
+            else:
+                self.__por_palavra[palavra] = {chave}
+                insort(self.__ordenadas, palavra)
+        if novas:
+            self.__por_chave[chave] = novas
+
+    def __faixa(self, ordenadas, prefixo):
+        inicio = bisect_left(ordenadas, prefixo)
+        return inicio, bisect_left(ordenadas, prefixo + self.ULTIMA, inicio)
+
+    def __contar(self, prefixo, teto):
+        inicio, fim = self.__faixa(self.__palavras, prefixo)
+        total = self.__inicios[fim] - self.__inicios[inicio]
+        inicio, fim = self.__faixa(self.__ordenadas, prefixo)
+        for posicao in range(inicio, fim):
+            if total > teto:
+                break
+            total += len(self.__por_palavra[self.__ordenadas[posicao]])
+        return total
+
+    def __das_palavras(self, posicoes_base, palavras_novas):
+        numeros = set()
+        for inicio, fim in posicoes_base:
+            numeros.update(self.__postagens[self.__inicios[inicio]:self.__inicios[fim]])
+        chaves = set(map(self.__chaves.__getitem__, numeros))
+        if self.__invalidas:
+            chaves -= self.__invalidas
+        for palavra in palavras_novas:
+            chaves.update(self.__por_palavra[palavra])
+        return chaves
+
+    def __com_prefixo(self, prefixo):
+        inicio, fim = self.__faixa(self.__ordenadas, prefixo)
+        return self.__das_palavras([self.__faixa(self.__palavras, prefixo)], self.__ordenadas[inicio:fim])
+
+    def __contendo(self, trecho, etiquetas):
+        # Procura o trecho na string com todas as palavras da base, em vez de palavra
+        # por palavra; a etiqueta (maiúscula) nunca coincide com o texto normalizado.
+        if self.__texto is None:
+            self.__texto = '\n'.join(self.__palavras)
+        if self.__inicios_texto is None:
+            inicios = array('i', [0])
+            for palavra in self.__palavras:
+                inicios.append(inicios[-1] + len(palavra) + 1)
+            self.__inicios_texto = inicios
+        posicoes = []
+        achado = self.__texto.find(trecho)
+        while achado != -1:
+            numero = bisect_right(self.__inicios_texto, achado) - 1
+            if self.__palavras[numero][0] in etiquetas:
+                posicoes.append((numero, numero + 1))
+            achado = self.__texto.find(trecho, self.__inicios_texto[numero + 1])
+        novas = [palavra for palavra in self.__ordenadas if palavra[0] in etiquetas and palavra.find(trecho, 1) != -1]
+        return self.__das_palavras(posicoes, novas)
+
+    def buscar(self, termos, etiquetas, limite=None, parcial=False):
+        # Chaves em que cada termo começa (ou, com parcial, aparece dentro de) alguma
+        # palavra das colunas em `etiquetas`. Com limite, só as primeiras em ordem.
+        if parcial:
+            # Cada termo percorre todas as palavras; os conjuntos saem exatos.
+            chaves = None
+            for termo in sorted(set(termos), key=len, reverse=True):
+                encontradas = self.__contendo(termo, etiquetas)
+                chaves = encontradas if chaves is None else chaves & encontradas
+                if not chaves:
+                    break
+        else:
+            # Só o termo com menos correspondências dá as candidatas; os demais são
+            # conferidos nas palavras de cada candidata, o que evita juntar faixas
+            # enormes (ex.: "afiliado 12", em que quase todos são "afiliado...").
+            comum = len(self) // 8
+            contagens = sorted((sum(self.__contar(etiqueta + termo, comum) for etiqueta in etiquetas), termo)
+                               for termo in set(termos))
+            tamanho, termo = contagens[0]
+            outros = [outro for _, outro in contagens[1:]]
+            if limite is not None and tamanho > comum:
+                # Todos os termos são comuns (ex.: a primeira letra digitada): percorre
+                # as chaves em ordem e para nas primeiras que atendem a todos.
+                outros.append(termo)
+                chaves = set()
+                for chave in heapq.merge((chave for chave in self.__chaves if chave not in self.__invalidas),
+                                         sorted(self.__por_chave)):
+                    if self.__atende(chave, outros, etiquetas):
+                        chaves.add(chave)
+                        if len(chaves) >= limite:
+                            break
+                return chaves
+            chaves = set().union(*(self.__com_prefixo(etiqueta + termo) for etiqueta in etiquetas))
+            if outros:
+                chaves = {chave for chave in chaves if self.__atende(chave, outros, etiquetas)}
+        if limite is not None and len(chaves) > limite:
+            return set(heapq.nsmallest(limite, chaves))
+        return chaves
+
+    def __atende(self, chave, termos, etiquetas):
+        palavras = [palavra for palavra in self.palavras(chave) if palavra[0] in etiquetas]
+        return all(any(palavra.startswith(termo, 1) for palavra in palavras) for termo in termos)
+
+    def precisa_compactar(self):
+        return len(self.__por_chave) + len(self.__invalidas) > max(1000, len(self.__chaves) // 4)
+
+    def compactar(self):
+        chaves = heapq.merge((chave for chave in self.__chaves if chave not in self.__invalidas),
+                             sorted(self.__por_chave))
+        self.__montar_base([(chave, self.palavras(chave)) for chave in chaves])
+
+    def copia(self):
+        # Cópia para gravação: divide os arrays da base e copia as alterações. Daí em
+        # diante o original anota as chaves tocadas, que incorporar() leva à cópia.
+        copia = IndicePalavras()
+        copia.__chaves, copia.__numeros, copia.__palavras = self.__chaves, self.__numeros, self.__palavras
+        copia.__inicios, copia.__postagens = self.__inicios, self.__postagens
+        copia.__inicios_chave, copia.__palavras_chave = self.__inicios_chave, self.__palavras_chave
+        copia.__texto, copia.__inicios_texto = self.__texto, self.__inicios_texto
+        copia.__invalidas = set(self.__invalidas)
+        copia.__por_palavra = {palavra: set(chaves) for palavra, chaves in self.__por_palavra.items()}
+        copia.__por_chave = dict(self.__por_chave)
+        copia.__ordenadas = list(self.__ordenadas)
+        self.__tocadas = set()
+        return copia
+
+    def incorporar(self, copia):
+        for chave in self.__tocadas or ():
+            copia.trocar(chave, self.palavras(chave))
+        self.__tocadas = None
+        return copia
+
+    def partes(self, carimbo, colunas):
+        texto = self.__texto if self.__texto is not None else '\n'.join(self.__palavras)
+        palavras = texto.encode('utf-8')
+        arrays = (self.__inicios, self.__postagens, self.__inicios_chave, self.__palavras_chave)
+        metadados = pickle.dumps((tuple(colunas), self.__chaves, self.__invalidas, self.__por_chave,
+                                  len(palavras), [len(dados) for dados in arrays]), pickle.HIGHEST_PROTOCOL)
+        return ([self.CABECALHO.pack(self.MAGICO, self.VERSAO, carimbo[0], carimbo[1], len(metadados)),
+                 metadados, palavras] + [dados.tobytes() for dados in arrays])
+
+    @staticmethod
+    def ler(dados, carimbo, colunas):
+        # Devolve None se o arquivo não corresponde ao arquivo de dados lido (outro
+        # carimbo ou outras colunas); quem chama monta o índice de novo.
+        magico, versao, tamanho, mtime, tamanho_metadados = IndicePalavras.CABECALHO.unpack_from(dados)
+        if magico != IndicePalavras.MAGICO or versao != IndicePalavras.VERSAO or (tamanho, mtime) != carimbo:
+            return None
+        posicao = IndicePalavras.CABECALHO.size
+        gravadas, chaves, invalidas, por_chave, tamanho_palavras, tamanhos = pickle.loads(
+            dados[posicao:posicao + tamanho_metadados])
+        if gravadas != tuple(colunas):
+            return None
+        posicao += tamanho_metadados
+        indice = IndicePalavras()
+        palavras = bytes(dados[posicao:posicao + tamanho_palavras]).decode('utf-8')
+        indice.__palavras = palavras.split('\n') if palavras else []
+        indice.__texto = palavras
+        posicao += tamanho_palavras
+        arrays = []
+        for quantidade in tamanhos:
+            valores = array('i')
+            valores.frombytes(dados[posicao:posicao + quantidade * valores.itemsize])
+            posicao += quantidade * valores.itemsize
+            arrays.append(valores)
+        indice.__inicios, indice.__postagens, indice.__inicios_chave, indice.__palavras_chave = arrays
+        indice.__chaves = chaves
+        indice.__numeros = {chave: numero for numero, chave in enumerate(chaves)}
+        indice.__invalidas = invalidas
+        for chave, palavras_da_chave in por_chave.items():
+            for palavra in palavras_da_chave:
+                if palavra in indice.__por_palavra:
+                    indice.__por_palavra[palavra].add(chave)
+                else:
+                    indice.__por_palavra[palavra] = {chave}
+        indice.__por_chave = por_chave
+        indice.__ordenadas = sorted(indice.__por_palavra)
+        return indice
+
+class Resolvedor:
+    # Liga os DAOs que se referenciam (venda -> afiliado e produto, afiliado -> vendas):
+    # cada DAO resolve as chaves de outras entidades pelo DAO registrado no seu
+    # resolvedor. Uma entidade sem DAO registrado é aberta uma única vez, no
+    # diretório do resolvedor, e passa a ser a usada por todos os DAOs dele.
+    def __init__(self, diretorio: str = '.', concorrente: bool = False):
+        self.__diretorio = os.path.abspath(diretorio)
+        self.__concorrente = concorrente
+        self.__daos = {}
+        self.__trava = threading.RLock()
+
+    @property
+    def diretorio(self):
+        return self.__diretorio
+
+    def registrar(self, dao):
+        with self.__trava:
+            atual = self.__daos.get(dao.entidade)
+            if atual is not None and atual is not dao:
+                raise ViolacaoRegraNegocioException(
+                    f"Já há um {type(atual).__name__} neste resolvedor; passe-o em vez de abrir outro")
+            self.__daos[dao.entidade] = dao
+
+    def dao(self, entidade):
+        with self.__trava:
+            dao = self.__daos.get(entidade)
+            if dao is None:
+                # Ex.: um script que só abriu o VendaDAO e monta vendas com afiliado e produto.
+                dao = DAO.classe(entidade)(concorrente=self.__concorrente, resolvedor=self)
+            return dao
+
+    def daos(self):
+        with self.__trava:
+            return list(self.__daos.values())
+
 class DAO(ABC):
+    # Formato dos arquivos de dados: cabeçalho (mágico, versão, tamanho do índice),
+    # índice (codec, estado do codec, chaves e posições de cada registro, excluídos e
+    # geração do diário que o arquivo contém) e os registros, cada um uma tupla simples
+    # codificada à parte. Os objetos só são montados no primeiro acesso; arquivos
+    # antigos continuam sendo lidos.
+    MAGICO = b'AFDAO\x00'
+    VERSAO = 3
+    CABECALHO = struct.Struct('<6sHQ')
+    CODEC_PADRAO = 'binario'
+    INTERVALO_BUSCA = 30.0
+
+    entidade = None
+    # Tipos dos campos do registro, usados pelo codec binário (ver CodecBinario).
+    campos = ''
+    # Guarda o último registro das entidades excluídas, para que referências
+    # antigas (ex.: vendas de um afiliado excluído) continuem sendo resolvidas.
+    guardar_excluidos = False
+    # Máximo de objetos montados mantidos em memória (None = todos). Os menos
+    # usados voltam a ser só o registro no arquivo e são montados de novo sob demanda.
+    limite_cache = None
+    # Nome de cada posição do registro, usado por consultar(); a primeira é a chave.
+    # As colunas em `indices` ganham um índice secundário, montado na primeira
+    # consulta que o usa e mantido a cada alteração.
+    colunas = ()
+    indices = ()
+    # Colunas cobertas por buscar(): um índice de palavras, montado na primeira busca
+    # e mantido a cada alteração, responde buscas por começo de palavra.
+    busca = ()
+    # Conversões entre o valor da entidade e o do registro (ex.: date <-> ordinal).
+    conversoes = {}
+    # Chaves inteiras geradas por proximo_id()/reservar_ids(). O próximo valor livre
+    # fica em <arquivo>.seq e cada processo reserva um bloco de chaves por vez (com o
+    # arquivo travado no modo concorrente); chaves não usadas de um bloco viram lacunas.
+    sequencial = False
+    BLOCO_SEQUENCIA = 64
+    SEQUENCIA = struct.Struct('<q')
+    __PARTES = re.compile(r'\w+')
+    __tipos = {}
+    __materializacao = threading.RLock()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if cls.entidade is not None:
+            DAO.__tipos[cls.entidade] = cls
+
     @abstractmethod
-    def __init__(self, datasource=''):
+    def __init__(self, datasource='', escrita_assincrona=False, concorrente=False, codec=None,
+                 limite_cache=None, resolvedor=None):
+        self.__resolvedor = resolvedor if resolvedor is not None else Resolvedor(concorrente=concorrente)
+        datasource = os.path.join(self.__resolvedor.diretorio, datasource)
         self.__datasource = datasource
+        self.__metrica = 'dao.' + os.path.splitext(os.path.basename(datasource))[0]
         self.__cache = {}
+        self.__brutos = 0
+        if limite_cache is not None:
+            self.limite_cache = limite_cache
+        if self.limite_cache is not None and (not isinstance(self.limite_cache, int) or self.limite_cache < 1):
+            raise DadoInvalidoException("limite do cache", self.limite_cache, "Deve ser um inteiro positivo")
+        # Objetos montados e não alterados, do menos para o mais usado, com o registro
+        # de onde vieram (é para ele que voltam quando despejados). Os despejados ficam
+        # acessíveis enquanto alguém os referenciar, para que a mesma chave continue
+        # dando o mesmo objeto.
+        self.__recentes = OrderedDict()
+        self.__despejados = weakref.WeakValueDictionary()
+        self.__acertos = 0
+        self.__falhas = 0
+        self.__despejos = 0
+        # coluna -> [chaves por valor, valor por chave, valores ordenados ou None]
+        self.__indices = {}
+        # Índice de buscar() (IndicePalavras) ou None enquanto não é usado. Até lá,
+        # as chaves alteradas desde a leitura do arquivo são anotadas, para que o
+        # índice gravado (<arquivo>.busca) possa ser aproveitado mesmo assim.
+        self.__busca = None
+        self.__fora_da_busca = set()
+        self.__carimbo = None
+        # Cópia do índice (e carimbo do arquivo) ainda não gravada; ver __persistir.
+        self.__busca_atrasada = None
+        self.__busca_gravada_em = 0.0
+        self.__mudancas = 0
+        self.__sequencia = range(0)
+        self.__piso_sequencia = 1
+        self.__trava_sequencia = threading.Lock()
+        self.__ouvintes = []
+        self.__assinantes = []
+        # Último registro publicado de cada chave alterada, para o "antes" dos eventos.
+        self.__publicados = {}
+        self.__eventos = 0
+        self.__codec = Codec.criar(codec or self.CODEC_PADRAO, self.campos)
+        # Arquivo lido por último: dados, início dos registros, posições e codec.
+        self.__origem = (memoryview(b''), 0, array('q', [0]), self.__codec)
+        self.__excluidos = {}
+        self.__excluidos_montados = {}
+        self.__materializando = {}
+        self.__concorrente = concorrente
+        self.__diario = f"{datasource}.log"
+        self.__geracao = 0
+        self.__posicao_diario = 0
+        self.__diario_ino = None
+        self.__sincronia = threading.RLock()
+        self.__trava_arquivo = TravaArquivo(datasource)
+        self.__alteradas = {}
+        self.__removidas = set()
+        # Registro de cada objeto no momento do último add()/update(). A gravação usa
+        # esse retrato, e não o objeto, que a thread da tela pode estar alterando no lugar.
+        self.__confirmados = {}
+        self.__lote = 0
+        self.__pendente = False
+        self.__escrita_assincrona = escrita_assincrona
+        # self.__trava é a mesma trava da condição, usada direto nos trechos mais frequentes.
+        self.__trava = threading.RLock()
+        self.__condicao = threading.Condition(self.__trava)
+        self.__versao = 0
+        self.__versao_gravada = 0
+        self.__erro_escrita = None
+        self.__escritor = None
+        if self.entidade is not None:
+            self.__resolvedor.registrar(self)
         try:
-            self.__load()
+            with self.__travar_arquivo():
+                self.__load()
         except FileNotFoundError:
             self.__dump()
 
+    # Cada DAO concreto converte sua entidade em um registro (tupla só com tipos
+    # simples) e preenche um objeto a partir dele. Outras entidades entram no
+    # registro pela chave e são resolvidas com self.resolver, pelo resolvedor do DAO.
+    @staticmethod
+    @abstractmethod
+    def para_registro(obj):
+        pass
+
+    @abstractmethod
+    def de_registro(self, obj, registro):
+        pass
+
+    # Liga ao DAO um objeto que não passou por de_registro: gravado agora ou lido de
+    # um arquivo no formato antigo.
+    def vincular(self, obj):
+        pass
+
+    @staticmethod
+    def classe(entidade):
+        return DAO.__tipos[entidade]
+
+    @property
+    def resolvedor(self):
+        return self.__resolvedor
+
+    def resolver(self, entidade, chave):
+        if chave is None:
+            return None
+        dao = self.__resolvedor.dao(entidade)
+        obj = dao.__obter(chave)
+        return obj if obj is not None else dao.__obter_excluido(chave)
+
+    @staticmethod
+    def __bruto(valor):
+        # Registro ainda não montado: posição no arquivo lido ou tupla vinda do diário.
+        return type(valor) is int or type(valor) is tuple
+
+    def __colocar(self, key, valor, registro=None):
+        # Chamado com self.__condicao adquirida. O registro, quando conhecido, mantém os índices.
+        self.__mudancas += 1
+        if self.__busca is None:
+            self.__fora_da_busca.add(key)
+        if self.__indices or self.__busca is not None:
+            if registro is None:
+                # Ex.: objetos alterados reaplicados na gravação; o registro sai do
+                # próprio objeto e os índices continuam valendo.
+                registro = self.__para_registro(valor, self.__origem)
+            self.__indexar(key, registro)
+        self.__brutos += self.__bruto(valor) - self.__bruto(self.__cache.get(key))
+        self.__cache[key] = valor
+        self.__recentes.pop(key, None)
+        if self.__bruto(valor):
+            self.__confirmados.pop(key, None)
+        else:
+            self.__despejados.pop(key, None)
+            if registro is not None:
+                self.__confirmados[key] = registro
+        if key in self.__excluidos:
+            del self.__excluidos[key]
+            self.__excluidos_montados.pop(key, None)
+
+    def __retirar(self, key, registro=None):
+        # Chamado com self.__condicao adquirida.
+        valor = self.__cache.pop(key, None)
+        self.__brutos -= self.__bruto(valor)
+        self.__mudancas += 1
+        if self.__busca is None:
+            self.__fora_da_busca.add(key)
+        self.__desindexar(key)
+        self.__recentes.pop(key, None)
+        self.__confirmados.pop(key, None)
+        despejado = self.__despejados.pop(key, None)
+        if despejado is not None:
+            valor = despejado
+        if registro is not None and self.guardar_excluidos:
+            self.__excluidos[key] = registro
+            if valor is not None and not self.__bruto(valor):
+                self.__excluidos_montados[key] = valor
+            else:
+                self.__excluidos_montados.pop(key, None)
+
+    def __decodificar(self, valor, origem):
+        if type(valor) is tuple:
+            return valor
+        dados, base, posicoes, codec = origem
+        return codec.decodificar(dados[base + posicoes[valor]:base + posicoes[valor + 1]])
+
+    def __para_registro(self, valor, origem):
+        if self.__bruto(valor):
+            return self.__decodificar(valor, origem)
+        return self.para_registro(valor)
+
+    def __congelar(self, key, valor):
+        # Chamado com self.__condicao adquirida: o que a gravação deve escrever para a entrada.
+        if self.__bruto(valor):
+            return valor
+        marcador = self.__recentes.get(key)
+        if marcador is not None:
+            return marcador
+        registro = self.__confirmados.get(key)
+        return registro if registro is not None else self.para_registro(valor)
+
+    def __montar(self, key, valor, origem):
+        obj = self.entidade.__new__(self.entidade)
+        self.__materializando[key] = obj
+        try:
+            self.de_registro(obj, self.__decodificar(valor, origem))
+        finally:
+            del self.__materializando[key]
+        return obj
+
+    def __instalar(self, key, obj, valor):
+        # Chamado com self.__trava adquirida.
+        self.__cache[key] = obj
+        self.__brutos -= 1
+        self.__falhas += 1
+        self.__recentes[key] = valor
+        if self.limite_cache is not None:
+            self.__despejados.pop(key, None)
+            self.__despejar()
+
+    def __despejar(self):
+        # Chamado com self.__trava adquirida.
+        while len(self.__recentes) > self.limite_cache:
+            key, valor = self.__recentes.popitem(last=False)
+            obj = self.__cache.get(key)
+            if obj is None or self.__bruto(obj) or key in self.__alteradas:
+                continue
+            self.__despejados[key] = obj
+            self.__cache[key] = valor
+            self.__brutos += 1
+            self.__despejos += 1
+
+    def __obter(self, key):
+        valor = self.__cache.get(key)
+        if type(valor) is not int and type(valor) is not tuple:
+            if valor is not None:
+                self.__acertos += 1
+                if self.limite_cache is not None:
+                    try:
+                        self.__recentes.move_to_end(key)
+                    except KeyError:
+                        pass
+            return valor
+        with DAO.__materializacao:
+            # Referências circulares (afiliado -> venda -> afiliado) recebem o
+            # objeto que ainda está sendo montado.
+            if key in self.__materializando:
+                return self.__materializando[key]
+            with self.__trava:
+                valor, origem = self.__cache.get(key), self.__origem
+                if not self.__bruto(valor):
+                    return valor
+                obj = self.__despejados.get(key)
+                if obj is not None:
+                    self.__instalar(key, obj, valor)
+                    return obj
+            obj = self.__montar(key, valor, origem)
+            with self.__trava:
+                if self.__cache.get(key) is valor and self.__origem is origem:
+                    self.__instalar(key, obj, valor)
+                    return obj
+        return self.__obter(key)
+
+    def estatisticas_cache(self):
+        with self.__trava:
+            consultas = self.__acertos + self.__falhas
+            return {
+                'limite': self.limite_cache,
+                'registros': len(self.__cache),
+                'montados': len(self.__cache) - self.__brutos,
+                'acertos': self.__acertos,
+                'falhas': self.__falhas,
+                'despejos': self.__despejos,
+                'taxa_acertos': self.__acertos / consultas if consultas else None,
+            }
+
+    @staticmethod
+    def estatisticas_caches(daos):
+        return {dao.__metrica: dao.estatisticas_cache() for dao in daos}
+
+    def __registro_de(self, key, valor, recentes, origem):
+        # Registro atual de uma entrada do cache sem montar o objeto; objetos não
+        # alterados desde a leitura usam o registro de onde vieram.
+        if self.__bruto(valor):
+            return self.__decodificar(valor, origem)
+        marcador = recentes.get(key)
+        if marcador is not None:
+            return self.__decodificar(marcador, origem)
+        return self.para_registro(valor)
+
+    def __posicao(self, coluna):
+        if coluna not in self.colunas:
+            raise DadoInvalidoException("coluna", coluna, f"Use uma de: {', '.join(self.colunas)}")
+        return self.colunas.index(coluna)
+
+    def __indexar(self, key, registro):
+        # Chamado com self.__condicao adquirida.
+        for coluna, indice in self.__indices.items():
+            por_valor, por_chave, _ = indice
+            novo = registro[self.colunas.index(coluna)]
+            if key in por_chave:
+                antigo = por_chave[key]
+                if antigo == novo:
+                    continue
+                chaves = por_valor[antigo]
+                chaves.discard(key)
+                if not chaves:
+                    del por_valor[antigo]
+                    indice[2] = None
+            por_chave[key] = novo
+            if novo not in por_valor:
+                por_valor[novo] = set()
+                indice[2] = None
+            por_valor[novo].add(key)
+        if self.__busca is not None:
+            self.__busca.trocar(key, self.__palavras(registro))
+
+    def __desindexar(self, key):
+        # Chamado com self.__condicao adquirida.
+        for indice in self.__indices.values():
+            por_valor, por_chave, _ = indice
+            if key in por_chave:
+                antigo = por_chave.pop(key)
+                chaves = por_valor[antigo]
+                chaves.discard(key)
+                if not chaves:
+                    del por_valor[antigo]
+                    indice[2] = None
+        if self.__busca is not None:
+            self.__busca.trocar(key, frozenset())
+
+    def __indice(self, coluna):
+        posicao = self.__posicao(coluna)
+        while True:
+            with self.__trava:
+                if coluna in self.__indices:
+                    return self.__indices[coluna]
+                mudancas = self.__mudancas
+                itens = list(self.__cache.items())
+                recentes, origem = dict(self.__recentes), self.__origem
+            with Instrumentacao.medir(f"{self.__metrica}.indexar"):
+                por_valor, por_chave = {}, {}
+                for key, valor in itens:
+                    valor = self.__registro_de(key, valor, recentes, origem)[posicao]
+                    por_chave[key] = valor
+                    if valor in por_valor:
+                        por_valor[valor].add(key)
+                    else:
+                        por_valor[valor] = {key}
+            with self.__trava:
+                # Se o cache mudou enquanto o índice era montado, monta de novo.
+                if self.__mudancas == mudancas and self.__origem is origem:
+                    self.__indices[coluna] = [por_valor, por_chave, None]
+                    return self.__indices[coluna]
+
+    def __candidatos(self, coluna, criterio):
+        indice = self.__indice(coluna)
+        with self.__trava:
+            if self.__indices.get(coluna) is indice:
+                return self.__buscar_no_indice(indice, criterio)
+        # Índice descartado (ex.: arquivo recarregado) logo depois de montado.
+        return self.__candidatos(coluna, criterio)
+
+    @staticmethod
+    def __buscar_no_indice(indice, criterio):
+        # Chamado com self.__trava adquirida.
+        por_valor = indice[0]
+        if isinstance(criterio, Intervalo):
+            if indice[2] is None:
+                indice[2] = sorted(valor for valor in por_valor if valor is not None)
+            ordenados = indice[2]
+            inicio = 0 if criterio.inicio is None else bisect_left(ordenados, criterio.inicio)
+            fim = len(ordenados) if criterio.fim is None else bisect_right(ordenados, criterio.fim)
+            return set().union(*(por_valor[valor] for valor in ordenados[inicio:fim]))
+        if isinstance(criterio, (set, frozenset)):
+            return set().union(*(por_valor.get(valor, ()) for valor in criterio))
+        return set(por_valor.get(criterio, ()))
+
+    @staticmethod
+    def __normalizar(texto):
+        # Sem diferença entre maiúsculas e minúsculas nem acentos: "José" acha "jose".
+        texto = str(texto).casefold()
+        if texto.isascii():
+            return texto
+        texto = unicodedata.normalize('NFKD', texto)
+        return ''.join(caractere for caractere in texto if not unicodedata.combining(caractere))
+
+    def __palavras(self, registro):
+        # Cada palavra entra inteira (ex.: "ana@exemplo.com", "2024-05-01") e também
+        # em partes, para que a busca ache tanto "ana@ex" quanto "exemplo".
+        palavras = set()
+        for posicao, coluna in enumerate(self.busca):
+            campo = registro[self.colunas.index(coluna)]
+            if campo is None:
+                continue
+            conversao = self.conversoes.get(coluna)
+            etiqueta = IndicePalavras.etiqueta(posicao)
+            for palavra in self.__normalizar(conversao[1](campo) if conversao else campo).split():
+                palavras.add(etiqueta + palavra)
+                if not palavra.isalnum():
+                    palavras.update(etiqueta + parte for parte in DAO.__PARTES.findall(palavra))
+        return frozenset(palavras)
+
+    def __indice_busca(self):
+        if not self.busca:
+            raise DadoInvalidoException("busca", type(self).__name__, "Este DAO não tem colunas de busca")
+        while True:
+            with self.__trava:
+                if self.__busca is not None:
+                    return self.__busca
+                mudancas, carimbo = self.__mudancas, self.__carimbo
+                alteradas = bool(self.__fora_da_busca)
+                itens = list(self.__cache.items())
+                recentes, origem = dict(self.__recentes), self.__origem
+            busca = self.__ler_busca(carimbo)
+            if busca is not None:
+                with self.__trava:
+                    if self.__carimbo is carimbo:
+                        # O índice gravado corresponde ao arquivo lido; só as chaves
+                        # alteradas desde a leitura são indexadas de novo.
+                        for key in self.__fora_da_busca:
+                            valor = self.__cache.get(key)
+                            busca.trocar(key, frozenset() if valor is None else self.__palavras(
+                                self.__registro_de(key, valor, self.__recentes, self.__origem)))
+                        self.__busca, self.__fora_da_busca = busca, set()
+                        return busca
+                continue
+            with Instrumentacao.medir(f"{self.__metrica}.indexar_busca"):
+                busca = IndicePalavras.montar(
+                    (key, self.__palavras(self.__registro_de(key, valor, recentes, origem))) for key, valor in itens)
+            with self.__trava:
+                # Se o cache mudou enquanto o índice era montado, monta de novo.
+                if self.__mudancas == mudancas and self.__origem is origem:
+                    self.__busca, self.__fora_da_busca = busca, set()
+                    break
+        if not alteradas:
+            # O índice corresponde exatamente ao arquivo lido: fica gravado para a
+            # próxima abertura.
+            with self.__sincronia:
+                self.__gravar_busca(busca, carimbo)
+        return busca
+
+    def __ler_busca(self, carimbo):
+        try:
+            with open(f"{self.__datasource}.busca", 'rb') as arquivo, \
+                    Instrumentacao.medir(f"{self.__metrica}.ler_busca"):
+                return IndicePalavras.ler(memoryview(arquivo.read()), carimbo, self.busca)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            # Índice gravado ilegível (ex.: gravação interrompida): é montado de novo.
+            Instrumentacao.contar(f"{self.__metrica}.busca_erros")
+            return None
+
+    def __gravar_busca(self, busca, carimbo):
+        # O índice é só um atalho: se não puder ser gravado, a próxima abertura o monta
+        # a partir dos dados. O carimbo é conferido de novo para não gravar o índice de
+        # um arquivo que já foi substituído.
+        temporario = self.__temporario(f"{self.__datasource}.busca")
+        try:
+            if self.__carimbar(self.__datasource) != carimbo:
+                return
+            with open(temporario, 'wb') as arquivo, Instrumentacao.medir(f"{self.__metrica}.gravar_busca"):
+                arquivo.writelines(busca.partes(carimbo, self.busca))
+            os.replace(temporario, f"{self.__datasource}.busca")
+        except OSError:
+            Instrumentacao.contar(f"{self.__metrica}.busca_erros")
+            if os.path.exists(temporario):
+                os.remove(temporario)
+
+    @staticmethod
+    def __carimbar(arquivo):
+        estado = os.stat(arquivo) if isinstance(arquivo, str) else os.fstat(arquivo)
+        return (estado.st_size, estado.st_mtime_ns)
+
+    def __chaves_busca(self, palavras, limite=None, colunas=None, parcial=False):
+        etiquetas = [IndicePalavras.etiqueta(self.busca.index(coluna)) for coluna in colunas or self.busca]
+        busca = self.__indice_busca()
+        with self.__trava:
+            if self.__busca is not busca:
+                # Índice descartado (ex.: arquivo recarregado) logo depois de montado.
+                return self.__chaves_busca(palavras, limite, colunas, parcial)
+            return busca.buscar(palavras, etiquetas, limite, parcial)
+
+    # Ouvintes são chamados como ouvinte(dao, chave, valores) depois de cada inclusão,
+    # alteração ou exclusão (local ou vinda de outro processo). valores é um dicionário
+    # coluna -> valor, ou None na exclusão; chave None indica que o arquivo foi relido
+    # e qualquer registro pode ter mudado.
+    def adicionar_ouvinte(self, ouvinte):
+        with self.__trava:
+            self.__ouvintes = self.__ouvintes + [ouvinte]
+
+    def remover_ouvinte(self, ouvinte):
+        with self.__trava:
+            self.__ouvintes = [atual for atual in self.__ouvintes if atual != ouvinte]
+
+    # Assinantes recebem um EventoAlteracao por inclusão, alteração ou exclusão feita
+    # por este processo (as de outros processos são publicadas por eles), logo após a
+    # alteração e antes da gravação em disco. Qualquer chamável serve; AssinanteArquivo
+    # e AssinanteSocket repassam os eventos em JSON.
+    def assinar(self, assinante):
+        with self.__trava:
+            self.__assinantes = self.__assinantes + [assinante]
+
+    def cancelar_assinatura(self, assinante):
+        with self.__trava:
+            self.__assinantes = [atual for atual in self.__assinantes if atual != assinante]
+            if not self.__assinantes:
+                self.__publicados = {}
+
+    def __evento(self, key, depois):
+        # Chamado com self.__condicao adquirida, antes de aplicar a alteração.
+        existia = key in self.__cache
+        antes = self.__publicados.get(key)
+        if antes is None and existia:
+            valor = self.__cache[key]
+            marcador = valor if self.__bruto(valor) else self.__recentes.get(key)
+            if marcador is not None:
+                antes = self.__decodificar(marcador, self.__origem)
+        if depois is None:
+            self.__publicados.pop(key, None)
+        else:
+            self.__publicados[key] = depois
+        self.__eventos += 1
+        operacao = 'exclusao' if depois is None else 'alteracao' if existia else 'inclusao'
+        return EventoAlteracao(self.entidade.__name__, operacao, key, self.__valores(antes),
+                               self.__valores(depois), time.time(), self.__eventos)
+
+    def __publicar(self, evento):
+        for assinante in self.__assinantes:
+            try:
+                assinante(evento)
+            except Exception:
+                Instrumentacao.contar(f"{self.__metrica}.assinante_erros")
+
+    def __valores(self, registro):
+        if registro is None:
+            return None
+        valores = {}
+        for coluna, campo in zip(self.colunas, registro):
+            conversao = self.conversoes.get(coluna)
+            valores[coluna] = conversao[1](campo) if conversao and campo is not None else campo
+        return valores
+
+    def __notificar(self, key, registro=None):
+        valores = self.__valores(registro)
+        for ouvinte in self.__ouvintes:
+            try:
+                ouvinte(self, key, valores)
+            except Exception:
+                # Um ouvinte com erro não pode impedir a gravação.
+                Instrumentacao.contar(f"{self.__metrica}.ouvinte_erros")
+
+    def __converter(self, coluna, criterio):
+        conversao = self.conversoes.get(coluna)
+        if conversao is None:
+            return criterio
+        para_registro = conversao[0]
+        if isinstance(criterio, Intervalo):
+            return Intervalo(None if criterio.inicio is None else para_registro(criterio.inicio),
+                             None if criterio.fim is None else para_registro(criterio.fim))
+        if isinstance(criterio, (set, frozenset)):
+            return frozenset(para_registro(valor) for valor in criterio)
+        return None if criterio is None else para_registro(criterio)
+
+    def __obter_excluido(self, key):
+        with DAO.__materializacao:
+            if key in self.__materializando:
+                return self.__materializando[key]
+            if key not in self.__excluidos_montados:
+                if key not in self.__excluidos:
+                    return None
+                self.__excluidos_montados[key] = self.__montar(key, self.__excluidos[key], None)
+            return self.__excluidos_montados[key]
+
+    def __serializar(self, itens, origem, codec, excluidos, interesse=(), geracao=None):
+        dados, base, posicoes, codec_origem = origem
+        chaves, partes, registros = [], [], {}
+        fins = array('q', [0])
+        for key, valor in itens:
+            if type(valor) is int and codec_origem is codec:
+                # Registro que não foi montado nem alterado: copiado como está.
+                parte = dados[base + posicoes[valor]:base + posicoes[valor + 1]]
+                if key in interesse:
+                    registros[key] = codec.decodificar(parte)
+            else:
+                registro = self.__para_registro(valor, origem)
+                parte = codec.codificar(registro)
+                if key in interesse:
+                    registros[key] = registro
+            chaves.append(key)
+            partes.append(parte)
+            fins.append(fins[-1] + len(parte))
+        indice = pickle.dumps((codec.nome, codec.estado(), chaves, fins, excluidos, geracao), pickle.HIGHEST_PROTOCOL)
+        return [self.CABECALHO.pack(self.MAGICO, self.VERSAO, len(indice)), indice] + partes, registros
+
+    def converter(self, codec: str):
+        # Regrava o arquivo inteiro com o codec indicado. No binário, a tabela de
+        # textos é refeita só com os textos ainda em uso.
+        with self.__sincronia:
+            self.__codec = Codec.criar(codec, self.campos)
+        self.__dump()
+        self.flush()
+
     def __dump(self):
-        pickle.dump(self.__cache, open(self.__datasource, 'wb'))
+        Instrumentacao.contar(f"{self.__metrica}.dump_solicitado")
+        if self.__lote > 0:
+            self.__pendente = True
+            return
+        if not self.__escrita_assincrona:
+            self.__persistir()
+            return
+        with self.__condicao:
+            self.__versao += 1
+            if self.__escritor is None:
+                self.__escritor = threading.Thread(
+                    target=self.__escrever_em_segundo_plano,
+                    name=f"escritor-{self.__datasource}",
+                    daemon=True
+                )
+                self.__escritor.start()
+                atexit.register(self.flush)
+            self.__condicao.notify_all()
+
+    def __escrever_em_segundo_plano(self):
+        while True:
+            with self.__condicao:
+                while self.__versao_gravada == self.__versao:
+                    self.__condicao.wait()
+                # Várias mutações seguidas resultam em uma única gravação
+                # do estado mais recente.
+                versao = self.__versao
+            try:
+                self.__persistir()
+                erro = None
+            except Exception as e:
+                erro = e
+            with self.__condicao:
+                self.__versao_gravada = versao
+                self.__erro_escrita = erro
+                self.__condicao.notify_all()
+
+    def flush(self):
+        with self.__condicao:
+            while self.__versao_gravada < self.__versao:
+                self.__condicao.wait()
+            erro, self.__erro_escrita = self.__erro_escrita, None
+        if erro is not None:
+            raise erro
+        with self.__sincronia:
+            atrasada, self.__busca_atrasada = self.__busca_atrasada, None
+            if atrasada is not None:
+                self.__gravar_busca(*atrasada)
+
+    def __persistir(self):
+        with self.__sincronia, self.__travar_arquivo():
+            with self.__condicao:
+                alteradas, self.__alteradas = self.__alteradas, {}
+                removidas, self.__removidas = self.__removidas, set()
+            try:
+                if self.__concorrente:
+                    # Traz para o cache o que outros processos gravaram desde a
+                    # nossa última leitura e reaplica por cima apenas as nossas alterações.
+                    self.__ler_diario(travado=True, em_gravacao=alteradas.keys() | removidas)
+                    with self.__condicao:
+                        for pendentes, descartadas in ((alteradas, removidas),
+                                                       (self.__alteradas, self.__removidas)):
+                            for key, obj in pendentes.items():
+                                self.__colocar(key, obj)
+                            for key in descartadas:
+                                self.__retirar(key)
+                with self.__condicao:
+                    itens = list(self.__cache.items())
+                    if self.__brutos < len(itens):
+                        itens = [(key, self.__congelar(key, valor)) for key, valor in itens]
+                    origem, codec = self.__origem, self.__codec
+                    excluidos = dict(self.__excluidos)
+                    busca = self.__busca
+                    copia = busca.copia() if busca is not None else None
+                # Sem o modo concorrente não há entrada no diário (nem geração a reaplicar).
+                geracao = self.__geracao + 1 if self.__concorrente else None
+                # A métrica do dump inclui a serialização, que costuma custar mais que a escrita.
+                with Instrumentacao.medir(f"{self.__metrica}.dump") as medicao:
+                    partes, registros = self.__serializar(itens, origem, codec, excluidos,
+                                                          alteradas if self.__concorrente else (), geracao)
+                    if self.__concorrente:
+                        # A entrada do diário vem antes da troca do arquivo: se o processo cair
+                        # entre as duas, quem carregar o arquivo anterior a reaplica ao lê-lo.
+                        self.__registrar_no_diario(geracao, registros,
+                                                   {key: excluidos.get(key) for key in removidas})
+                    medicao['bytes_escritos'] = self.__gravar(partes)
+                if self.__concorrente:
+                    self.__reiniciar_diario(geracao)
+                if copia is not None:
+                    # O índice de busca é gravado no mesmo estado dos dados. Quando as
+                    # alterações acumuladas já pesam, a cópia é compactada aqui, fora da
+                    # trava, e passa a ser o índice em uso.
+                    # O arquivo de índice costuma ser maior que o de dados, então só é
+                    # regravado a cada INTERVALO_BUSCA segundos; a última cópia fica
+                    # pendente e é gravada no flush() (também chamado na saída).
+                    compactar = copia.precisa_compactar()
+                    if compactar:
+                        with Instrumentacao.medir(f"{self.__metrica}.compactar_busca"):
+                            copia.compactar()
+                    carimbo = self.__carimbar(self.__datasource)
+                    if compactar or time.monotonic() - self.__busca_gravada_em >= self.INTERVALO_BUSCA:
+                        self.__busca_atrasada, self.__busca_gravada_em = None, time.monotonic()
+                        self.__gravar_busca(copia, carimbo)
+                    else:
+                        self.__busca_atrasada = (copia, carimbo)
+                    if compactar:
+                        with self.__condicao:
+                            if self.__busca is busca:
+                                self.__busca = busca.incorporar(copia)
+            except BaseException:
+                with self.__condicao:
+                    for key, obj in alteradas.items():
+                        if key not in self.__alteradas and key not in self.__removidas:
+                            self.__alteradas[key] = obj
+                    for key in removidas:
+                        if key not in self.__alteradas:
+                            self.__removidas.add(key)
+                raise
+
+    # O diário (<arquivo>.log) guarda, para cada gravação em modo concorrente,
+    # a geração e apenas os registros alterados ou as chaves removidas. Cada processo
+    # lembra até onde já leu e, antes de consultar o cache, aplica somente as
+    # entradas novas em vez de recarregar o arquivo inteiro.
+    CABECALHO_DIARIO = struct.Struct('<qq')
+    LIMITE_DIARIO = 8 * 1024 * 1024
+
+    def __ler_diario(self, travado=False, em_gravacao=frozenset()):
+        try:
+            info = os.stat(self.__diario)
+        except FileNotFoundError:
+            return
+        if self.__diario_ino is None:
+            self.__diario_ino = info.st_ino
+        elif info.st_ino != self.__diario_ino or info.st_size < self.__posicao_diario:
+            self.__recarregar(travado, em_gravacao)
+            return
+        if info.st_size == self.__posicao_diario:
+            return
+
+        with open(self.__diario, 'rb') as diario:
+            diario.seek(self.__posicao_diario)
+            while True:
+                cabecalho = diario.read(self.CABECALHO_DIARIO.size)
+                if len(cabecalho) < self.CABECALHO_DIARIO.size:
+                    break
+                geracao, tamanho = self.CABECALHO_DIARIO.unpack(cabecalho)
+                conteudo = diario.read(tamanho)
+                if len(conteudo) < tamanho:
+                    # Entrada ainda sendo escrita por outro processo.
+                    break
+                if geracao > self.__geracao:
+                    if tamanho == 0 or geracao != self.__geracao + 1:
+                        self.__recarregar(travado, em_gravacao)
+                        return
+                    registros, removidas = CarregadorEntidades.carregar(conteudo)
+                    self.__aplicar(registros, removidas, em_gravacao)
+                    self.__geracao = geracao
+                self.__posicao_diario = diario.tell()
+
+    def __aplicar(self, registros, removidas, em_gravacao=frozenset()):
+        # O diário traz os registros já decodificados, independentes do codec e da
+        # tabela de textos de quem gravou. Entradas de versões anteriores trazem o
+        # registro em pickle, os próprios objetos ou só a lista de chaves removidas.
+        if not isinstance(removidas, dict):
+            removidas = dict.fromkeys(removidas)
+        for alteracoes in (registros, removidas):
+            for key, valor in alteracoes.items():
+                if type(valor) is bytes:
+                    alteracoes[key] = pickle.loads(valor)
+        # As alterações locais ainda não gravadas prevalecem sobre as de outros processos.
+        with DAO.__materializacao:
+            with self.__condicao:
+                locais = self.__alteradas.keys() | self.__removidas | em_gravacao
+                entregues = []
+                aplicadas = [key for key in registros if key not in locais]
+                aplicadas += [key for key in removidas if key not in locais]
+                for key, valor in registros.items():
+                    if key in locais:
+                        continue
+                    atual = self.__cache.get(key)
+                    if type(valor) is tuple and atual is not None and not self.__bruto(atual):
+                        entregues.append((atual, valor))
+                        if key in self.__recentes:
+                            self.__recentes[key] = valor
+                        else:
+                            self.__confirmados[key] = valor
+                        self.__mudancas += 1
+                        if self.__busca is None:
+                            self.__fora_da_busca.add(key)
+                        self.__indexar(key, valor)
+                    else:
+                        despejado = self.__despejados.get(key)
+                        if type(valor) is tuple and despejado is not None:
+                            entregues.append((despejado, valor))
+                        self.__colocar(key, valor)
+                for key, registro in removidas.items():
+                    if key not in locais:
+                        self.__retirar(key, registro)
+            # Objetos já entregues são atualizados no lugar, para que quem os
+            # referencia continue vendo o mesmo objeto.
+            for obj, registro in entregues:
+                self.de_registro(obj, registro)
+        if self.__publicados:
+            with self.__condicao:
+                for key in aplicadas:
+                    self.__publicados.pop(key, None)
+        if self.__ouvintes:
+            for key in aplicadas:
+                valor = registros.get(key)
+                if valor is not None and type(valor) is not tuple:
+                    valor = self.para_registro(valor)
+                self.__notificar(key, valor)
+
+    def __recarregar(self, travado=False, em_gravacao=frozenset()):
+        if not travado:
+            with self.__travar_arquivo():
+                self.__recarregar(True, em_gravacao)
+            return
+        with self.__condicao:
+            entregues = dict(self.__despejados.items())
+            entregues.update((key, obj) for key, obj in self.__cache.items() if not self.__bruto(obj))
+            excluidos = {key: self.__excluidos[key] for key in self.__removidas | em_gravacao
+                         if key in self.__excluidos}
+        self.__load()
+        with DAO.__materializacao:
+            with self.__condicao:
+                for key, obj in self.__alteradas.items():
+                    self.__colocar(key, obj)
+                for key in self.__removidas | em_gravacao:
+                    self.__retirar(key, excluidos.get(key))
+                locais = self.__alteradas.keys() | self.__removidas | em_gravacao
+                self.__publicados = {key: registro for key, registro in self.__publicados.items() if key in locais}
+                self.__confirmados = {key: registro for key, registro in self.__confirmados.items() if key in locais}
+                refrescar = []
+                for key, obj in entregues.items():
+                    valor = self.__cache.get(key)
+                    if key not in locais and self.__bruto(valor):
+                        refrescar.append((obj, valor))
+                        self.__colocar(key, obj)
+                        self.__recentes[key] = valor
+                if self.limite_cache is not None:
+                    self.__despejar()
+            for obj, valor in refrescar:
+                self.de_registro(obj, self.__decodificar(valor, self.__origem))
+        self.__notificar(None)
+
+    def __percorrer_diario(self, geracao_arquivo=None):
+        # Posiciona no fim do diário, reaplicando as entradas posteriores à geração
+        # gravada no arquivo (a entrada é escrita antes da troca do arquivo).
+        geracao, posicao, ino = geracao_arquivo or 0, 0, None
+        pendentes = []
+        try:
+            with open(self.__diario, 'rb') as diario:
+                info = os.fstat(diario.fileno())
+                ino = info.st_ino
+                while True:
+                    cabecalho = diario.read(self.CABECALHO_DIARIO.size)
+                    if len(cabecalho) < self.CABECALHO_DIARIO.size:
+                        break
+                    proxima, tamanho = self.CABECALHO_DIARIO.unpack(cabecalho)
+                    if diario.tell() + tamanho > info.st_size:
+                        break
+                    if geracao_arquivo is not None and proxima == geracao + 1 and tamanho:
+                        pendentes.append(diario.read(tamanho))
+                    else:
+                        diario.seek(tamanho, os.SEEK_CUR)
+                    geracao, posicao = max(geracao, proxima), diario.tell()
+        except FileNotFoundError:
+            pass
+        for conteudo in pendentes:
+            self.__aplicar(*CarregadorEntidades.carregar(conteudo))
+        if pendentes:
+            Instrumentacao.contar(f"{self.__metrica}.diario_reaplicado", len(pendentes))
+        self.__geracao, self.__posicao_diario, self.__diario_ino = geracao, posicao, ino
+
+    def __registrar_no_diario(self, geracao, registros, removidas):
+        conteudo = pickle.dumps((registros, removidas), pickle.HIGHEST_PROTOCOL)
+        with open(self.__diario, 'ab') as diario:
+            diario.write(self.CABECALHO_DIARIO.pack(geracao, len(conteudo)) + conteudo)
+            diario.flush()
+            os.fsync(diario.fileno())
+        Instrumentacao.contar(f"{self.__metrica}.diario_bytes", self.CABECALHO_DIARIO.size + len(conteudo))
+        info = os.stat(self.__diario)
+        self.__geracao, self.__posicao_diario, self.__diario_ino = geracao, info.st_size, info.st_ino
+
+    def __reiniciar_diario(self, geracao):
+        if self.__posicao_diario <= self.LIMITE_DIARIO:
+            return
+        # O arquivo principal acabou de ser gravado com tudo; o diário
+        # recomeça a partir dele e quem estiver atrasado recarrega.
+        temporario = self.__temporario(self.__diario)
+        with open(temporario, 'wb') as diario:
+            diario.write(self.CABECALHO_DIARIO.pack(geracao, 0))
+            diario.flush()
+            os.fsync(diario.fileno())
+        os.replace(temporario, self.__diario)
+        info = os.stat(self.__diario)
+        self.__posicao_diario, self.__diario_ino = info.st_size, info.st_ino
+
+    def __atualizar(self):
+        if not self.__concorrente:
+            return
+        # Se a thread de escrita estiver gravando, ela mesma sincroniza o cache.
+        if not self.__sincronia.acquire(blocking=False):
+            return
+        try:
+            self.__ler_diario()
+        finally:
+            self.__sincronia.release()
+
+    @contextmanager
+    def __travar_arquivo(self):
+        if not self.__concorrente:
+            yield
+            return
+        with self.__trava_arquivo.travar():
+            yield
+
+    def __gravar(self, partes):
+        # Grava em arquivo temporário e só então substitui o original, para que
+        # uma falha no meio da escrita nunca deixe o arquivo de dados truncado.
+        temporario = self.__temporario(self.__datasource)
+        try:
+            with open(temporario, 'wb') as arquivo:
+                arquivo.writelines(partes)
+                tamanho = arquivo.tell()
+                arquivo.flush()
+                os.fsync(arquivo.fileno())
+            os.replace(temporario, self.__datasource)
+            self.__sincronizar_diretorio()
+        except BaseException:
+            if os.path.exists(temporario):
+                os.remove(temporario)
+            raise
+        return tamanho
+
+    @staticmethod
+    def __temporario(caminho):
+        # Processo e thread no nome: dois DAOs do mesmo arquivo, no mesmo processo ou
+        # não, nunca escrevem no mesmo temporário.
+        return f"{caminho}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+    def __sincronizar_diretorio(self):
+        if os.name == 'nt':
+            return
+        diretorio = os.open(os.path.dirname(os.path.abspath(self.__datasource)), os.O_RDONLY)
+        try:
+            os.fsync(diretorio)
+        finally:
+            os.close(diretorio)
 
     def __load(self):
-        self.__cache = pickle.load(open(self.__datasource,'rb'))
+        with open(self.__datasource, 'rb') as arquivo, Instrumentacao.medir(f"{self.__metrica}.load"):
+            carimbo = self.__carimbar(arquivo.fileno())
+            if self.limite_cache is not None and os.name != 'nt' and os.fstat(arquivo.fileno()).st_size:
+                # Com o cache limitado, os registros ficam no arquivo mapeado e o sistema
+                # operacional decide o que manter em memória. (No Windows o arquivo
+                # mapeado não poderia ser substituído na próxima gravação.)
+                dados = memoryview(mmap.mmap(arquivo.fileno(), 0, access=mmap.ACCESS_READ))
+            else:
+                dados = memoryview(arquivo.read())
+            geracao = None
+            if bytes(dados[:len(self.MAGICO)]) == self.MAGICO:
+                _, versao, tamanho = self.CABECALHO.unpack_from(dados)
+                if versao not in (2, self.VERSAO):
+                    raise DadoInvalidoException("versão do arquivo", versao,
+                                                f"{self.__datasource} foi gravado por uma versão mais nova")
+                base = self.CABECALHO.size + tamanho
+                indice = pickle.loads(dados[self.CABECALHO.size:base])
+                if versao == 2:
+                    # Versão 2: registros sempre em pickle, sem nome de codec no índice.
+                    chaves, posicoes, excluidos, geracao = indice
+                    nome, estado = CodecPickle.nome, None
+                    excluidos = {key: pickle.loads(registro) for key, registro in excluidos.items()}
+                else:
+                    nome, estado, chaves, posicoes, excluidos, geracao = indice
+                codec = Codec.criar(nome, self.campos)
+                codec.restaurar(estado)
+                # Cada chave aponta para a posição do seu registro, ainda não decodificado.
+                cache = dict(zip(chaves, range(len(chaves))))
+                brutos = len(cache)
+            else:
+                cache = CarregadorEntidades.carregar(dados)
+                for obj in cache.values():
+                    self.vincular(obj)
+                dados, base, posicoes, brutos, excluidos = memoryview(b''), 0, array('q', [0]), 0, {}
+                codec = self.__codec
+        with self.__condicao:
+            self.__cache, self.__brutos = cache, brutos
+            self.__recentes.clear()
+            self.__indices = {}
+            self.__busca, self.__fora_da_busca, self.__carimbo = None, set(), carimbo
+            self.__mudancas += 1
+            self.__origem = (dados, base, posicoes, codec)
+            if codec.nome == self.__codec.nome:
+                self.__codec = codec
+            self.__excluidos, self.__excluidos_montados = excluidos, {}
+        if self.__concorrente:
+            self.__percorrer_diario(geracao)
+
+    @contextmanager
+    def agrupar_escritas(self):
+        self.__lote += 1
+        try:
+            yield self
+        finally:
+            self.__lote -= 1
+            if self.__lote == 0 and self.__pendente:
+                self.__pendente = False
+                self.__dump()
+
+    @contextmanager
+    def transacao(self):
+        # Como agrupar_escritas(), mas leitura, alteração e gravação acontecem sob a
+        # trava do arquivo: no modo concorrente o bloco parte do que os outros processos
+        # já gravaram, e as alterações são gravadas antes que outro possa ler e alterar
+        # os mesmos registros (ex.: somar a um saldo sem perder a soma de outro processo).
+        with self.__sincronia, self.__travar_arquivo():
+            if self.__concorrente:
+                self.__ler_diario(travado=True)
+            self.__lote += 1
+            try:
+                yield self
+            finally:
+                self.__lote -= 1
+                if self.__alteradas or self.__removidas:
+                    if self.__lote == 0:
+                        self.__pendente = False
+                    self.__persistir()
+
+    def proximo_id(self):
+        return self.reservar_ids(1)[0]
+
+    def reservar_ids(self, quantidade: int = 1):
+        if not self.sequencial:
+            raise ViolacaoRegraNegocioException(f"{type(self).__name__} não gera chaves automaticamente")
+        if quantidade < 1:
+            raise DadoInvalidoException("Quantidade", quantidade, "Deve ser ao menos 1")
+        with self.__trava_sequencia:
+            while True:
+                disponiveis = range(max(self.__sequencia.start, self.__piso_sequencia), self.__sequencia.stop)
+                if len(disponiveis) < quantidade:
+                    disponiveis = self.__reservar_bloco(max(quantidade, self.BLOCO_SEQUENCIA))
+                reservadas, self.__sequencia = disponiveis[:quantidade], disponiveis[quantidade:]
+                # Chaves gravadas à mão no meio da faixa são puladas.
+                with self.__trava:
+                    ocupadas = [chave for chave in reservadas if chave in self.__cache]
+                if not ocupadas:
+                    return reservadas
+                self.__piso_sequencia = max(self.__piso_sequencia, ocupadas[-1] + 1)
+
+    def __reservar_bloco(self, quantidade):
+        caminho = f"{self.__datasource}.seq"
+        with self.__sincronia, self.__travar_arquivo():
+            if self.__concorrente:
+                self.__ler_diario(travado=True)
+            try:
+                with open(caminho, 'rb') as arquivo:
+                    proximo, = self.SEQUENCIA.unpack(arquivo.read(self.SEQUENCIA.size))
+            except (FileNotFoundError, struct.error):
+                proximo = None
+            with self.__trava:
+                if proximo is None or proximo in self.__cache:
+                    # Sem sequência gravada (ou atrasada em relação aos dados): começa
+                    # depois da maior chave existente, uma única vez.
+                    proximo = 1 + max((chave for chave in chain(self.__cache, self.__excluidos)
+                                       if type(chave) is int), default=0)
+            proximo = max(proximo, self.__piso_sequencia)
+            temporario = self.__temporario(caminho)
+            with open(temporario, 'wb') as arquivo:
+                arquivo.write(self.SEQUENCIA.pack(proximo + quantidade))
+                arquivo.flush()
+                os.fsync(arquivo.fileno())
+            os.replace(temporario, caminho)
+            self.__sincronizar_diretorio()
+        Instrumentacao.contar(f"{self.__metrica}.blocos_sequencia")
+        return range(proximo, proximo + quantidade)
 
     def add(self, key, obj):
-        self.__cache[key] = obj
+        if self.sequencial and type(key) is int and key >= self.__piso_sequencia:
+            self.__piso_sequencia = key + 1
+        self.vincular(obj)
+        assinantes = self.__assinantes
+        registro = self.para_registro(obj)
+        with self.__condicao:
+            evento = self.__evento(key, registro) if assinantes else None
+            self.__colocar(key, obj, registro)
+            self.__alteradas[key] = obj
+            self.__removidas.discard(key)
+        if self.__ouvintes:
+            self.__notificar(key, registro)
+        if evento is not None:
+            self.__publicar(evento)
         self.__dump()
 
     def update(self, key, obj):
         try:
             if(self.__cache[key] != None):
-                self.__cache[key] = obj
+                self.vincular(obj)
+                assinantes = self.__assinantes
+                registro = self.para_registro(obj)
+                with self.__condicao:
+                    evento = self.__evento(key, registro) if assinantes else None
+                    self.__colocar(key, obj, registro)
+                    self.__alteradas[key] = obj
+                    self.__removidas.discard(key)
+                if self.__ouvintes:
+                    self.__notificar(key, registro)
+                if evento is not None:
+                    self.__publicar(evento)
                 self.__dump()
         except KeyError:
             pass
 
     def get(self, key):
-        try:
-            return self.__cache[key]
-        except KeyError:
-            pass
+        self.__atualizar()
+        return self.__obter(key)
 
     def remove(self, key):
         try:
-            self.__cache.pop(key)
+            with self.__condicao:
+                valor = self.__cache[key]
+                registro = None
+                if self.guardar_excluidos:
+                    registro = self.__registro_de(key, valor, self.__recentes, self.__origem)
+                evento = self.__evento(key, None) if self.__assinantes else None
+                self.__retirar(key, registro)
+                self.__alteradas.pop(key, None)
+                self.__removidas.add(key)
+            self.__notificar(key)
+            if evento is not None:
+                self.__publicar(evento)
             self.__dump()
         except KeyError:
             pass
 
     def get_all(self):
-        return self.__cache.values()
+        self.__atualizar()
+        todos = None
+        if self.__brutos:
+            # Sem a coleta de lixo rodando a cada lote de objetos novos, montar
+            # todos os registros de uma vez fica bem mais rápido.
+            coleta = gc.isenabled()
+            gc.disable()
+            try:
+                with Instrumentacao.medir(f"{self.__metrica}.materializar"), DAO.__materializacao:
+                    if self.limite_cache is None:
+                        for key in [key for key, valor in self.__cache.items() if self.__bruto(valor)]:
+                            self.__obter(key)
+                    else:
+                        # Com o cache limitado, a lista devolvida é que mantém os objetos vivos.
+                        todos = [obj for obj in map(self.__obter, list(self.__cache)) if obj is not None]
+            finally:
+                if coleta:
+                    gc.enable()
+        Instrumentacao.contar(f"{self.__metrica}.get_all")
+        Instrumentacao.contar(f"{self.__metrica}.get_all_itens", len(self.__cache))
+        return self.__cache.values() if todos is None else todos
+
+    def consultar(self, filtros=None, ordem=None, limite=None, deslocamento=0, campos=None):
+        # filtros: {coluna: valor | Intervalo | conjunto de valores}. ordem: coluna ou
+        # tupla de colunas, com '-' na frente para ordem decrescente. campos: devolve
+        # só essas colunas (dicionários), sem montar os objetos.
+        self.__atualizar()
+        filtros = {coluna: self.__converter(coluna, criterio) for coluna, criterio in (filtros or {}).items()}
+        posicoes = {coluna: self.__posicao(coluna) for coluna in filtros}
+        if isinstance(ordem, str):
+            ordem = (ordem,)
+        ordem = [(coluna.lstrip('-'), coluna.startswith('-')) for coluna in ordem or ()]
+        for coluna, _ in ordem:
+            self.__posicao(coluna)
+        for coluna in campos or ():
+            self.__posicao(coluna)
+        chave = self.colunas[0]
+        fim = None if limite is None else deslocamento + limite
+        with Instrumentacao.medir(f"{self.__metrica}.consultar"):
+            chaves, restantes = self.__candidatas(filtros)
+
+            if not restantes and all(coluna == chave for coluna, _ in ordem) and set(campos or ()) <= {chave}:
+                # Tudo resolvido pelas chaves: nenhum registro precisa ser lido.
+                with self.__trava:
+                    if chaves is None:
+                        chaves = list(self.__cache)
+                    else:
+                        chaves = [key for key in chaves if key in self.__cache]
+                Instrumentacao.contar(f"{self.__metrica}.consultar_examinados", len(chaves))
+                chaves.sort(reverse=bool(ordem) and ordem[-1][1])
+                chaves = chaves[deslocamento:fim]
+                if campos:
+                    return [{chave: key} for key in chaves]
+                objetos = (self.__obter(key) for key in chaves)
+                return [obj for obj in objetos if obj is not None]
+
+            with self.__trava:
+                if chaves is None:
+                    itens = list(self.__cache.items())
+                else:
+                    # Candidatas vindas dos índices saem em ordem de chave.
+                    itens = sorted((key, self.__cache[key]) for key in chaves if key in self.__cache)
+                recentes, origem = self.__recentes, self.__origem
+                if any(not self.__bruto(valor) for _, valor in itens):
+                    recentes = dict(recentes)
+            maximo = None if ordem else fim
+            encontrados = []
+            for key, valor in itens:
+                registro = self.__registro_de(key, valor, recentes, origem)
+                if self.__atende(registro, restantes, posicoes):
+                    encontrados.append((key, registro))
+                    if maximo is not None and len(encontrados) >= maximo:
+                        break
+            Instrumentacao.contar(f"{self.__metrica}.consultar_examinados", len(itens))
+            for coluna, decrescente in reversed(ordem):
+                posicao = self.colunas.index(coluna)
+                encontrados.sort(key=lambda item: (item[1][posicao] is None, item[1][posicao]), reverse=decrescente)
+            encontrados = encontrados[deslocamento:fim]
+            if campos:
+                saida = self.__saida(campos)
+                return [self.__linha(registro, saida) for _, registro in encontrados]
+            objetos = (self.__obter(key) for key, _ in encontrados)
+            return [obj for obj in objetos if obj is not None]
+
+    def percorrer(self, filtros=None, campos=None, lote: int = 10000):
+        # Como consultar(filtros, ordem=chave, campos=...), mas entregue em listas de até
+        # `lote` linhas: só a lista de chaves e um lote de registros ficam em memória,
+        # qualquer que seja o tamanho do arquivo. Intervalo na chave é resolvido pela
+        # lista ordenada, sem ler os registros de fora dele.
+        if lote < 1:
+            raise DadoInvalidoException("Lote", lote, "Deve ser ao menos 1")
+        self.__atualizar()
+        filtros = {coluna: self.__converter(coluna, criterio) for coluna, criterio in (filtros or {}).items()}
+        posicoes = {coluna: self.__posicao(coluna) for coluna in filtros}
+        saida = self.__saida(campos or self.colunas)
+        chaves, restantes = self.__candidatas(filtros)
+        faixa = restantes.pop(self.colunas[0], None)
+        with self.__trava:
+            chaves = sorted(self.__cache if chaves is None else (key for key in chaves if key in self.__cache))
+        if faixa is not None:
+            inicio = 0 if faixa.inicio is None else bisect_left(chaves, faixa.inicio)
+            fim = len(chaves) if faixa.fim is None else bisect_right(chaves, faixa.fim)
+            chaves = chaves[inicio:fim]
+        for inicio in range(0, len(chaves), lote):
+            with self.__trava:
+                itens = [(key, self.__cache.get(key)) for key in chaves[inicio:inicio + lote]]
+                recentes = {key: self.__recentes[key] for key, valor in itens
+                            if valor is not None and not self.__bruto(valor) and key in self.__recentes}
+                origem = self.__origem
+            Instrumentacao.contar(f"{self.__metrica}.percorrer_examinados", len(itens))
+            linhas = []
+            for key, valor in itens:
+                if valor is None:
+                    # Excluído depois que a lista de chaves foi tirada.
+                    continue
+                registro = self.__registro_de(key, valor, recentes, origem)
+                if self.__atende(registro, restantes, posicoes):
+                    linhas.append(self.__linha(registro, saida))
+            if linhas:
+                yield linhas
+
+    def __candidatas(self, filtros):
+        # Os critérios da chave e das colunas indexadas dão as chaves candidatas (None =
+        # todas); os demais são avaliados sobre os registros, sem montar objetos.
+        chave = self.colunas[0]
+        chaves, restantes = None, {}
+        for coluna, criterio in filtros.items():
+            if coluna == chave and isinstance(criterio, (set, frozenset)):
+                candidatas = set(criterio)
+            elif coluna == chave and not isinstance(criterio, Intervalo):
+                candidatas = {criterio}
+            elif coluna in self.indices:
+                candidatas = self.__candidatos(coluna, criterio)
+            else:
+                restantes[coluna] = criterio
+                continue
+            chaves = candidatas if chaves is None else chaves & candidatas
+        return chaves, restantes
+
+    @staticmethod
+    def __atende(registro, restantes, posicoes):
+        for coluna, criterio in restantes.items():
+            campo = registro[posicoes[coluna]]
+            if isinstance(criterio, Intervalo):
+                if not criterio.contem(campo):
+                    return False
+            elif isinstance(criterio, (set, frozenset)):
+                if campo not in criterio:
+                    return False
+            elif campo != criterio:
+                return False
+        return True
+
+    def __saida(self, campos):
+        # (coluna, posição no registro, conversão do registro para o valor) de cada campo pedido.
+        return [(coluna, self.__posicao(coluna), self.conversoes[coluna][1] if coluna in self.conversoes else None)
+                for coluna in campos]
+
+    @staticmethod
+    def __linha(registro, saida):
+        linha = {}
+        for coluna, posicao, conversao in saida:
+            campo = registro[posicao]
+            linha[coluna] = conversao(campo) if conversao is not None and campo is not None else campo
+        return linha
+
+    def buscar(self, texto, limite=None, campos=None, colunas=None, parcial=False):
+        # Busca enquanto se digita: cada palavra do texto precisa ser o começo de
+        # alguma palavra das colunas em `busca` (ou só das indicadas em `colunas`);
+        # com parcial, basta aparecer dentro dela ("silva" acha "dasilva@..."). O
+        # resultado vem como em consultar(), em ordem de chave; texto vazio devolve os
+        # primeiros registros.
+        for coluna in colunas or ():
+            if coluna not in self.busca:
+                raise DadoInvalidoException("coluna de busca", coluna, f"Use uma de: {', '.join(self.busca)}")
+        self.__atualizar()
+        palavras = self.__normalizar(texto).split()
+        if not palavras:
+            if limite is None:
+                return self.consultar(campos=campos)
+            with self.__trava:
+                chaves = set(heapq.nsmallest(limite, self.__cache))
+            return self.consultar({self.colunas[0]: chaves}, limite=limite, campos=campos)
+        with Instrumentacao.medir(f"{self.__metrica}.buscar"):
+            chaves = self.__chaves_busca(palavras, limite, colunas, parcial)
+        return self.consultar({self.colunas[0]: chaves}, limite=limite, campos=campos)
 
 class Pessoa(ABC):
     @abstractmethod
@@ -127,7 +2446,21 @@ class Pessoa(ABC):
             raise TypeError("contato deve ser str")
         self.__contato = value
 
+    def __getstate__(self):
+        return (self.__id, self.__nome, self.__contato)
+
+    def __setstate__(self, estado):
+        # Arquivos antigos guardam o __dict__ do objeto.
+        if isinstance(estado, dict):
+            self.__dict__.update(estado)
+        else:
+            self.__id, self.__nome, self.__contato = estado
+
 class Afiliado(Pessoa):
+    # Afiliados lidos de um AfiliadoDAO (ou gravados nele) não guardam a lista de vendas:
+    # cada acesso a consulta no VendaDAO. Os demais mantêm a lista em memória.
+    __consultar_vendas = None
+
     def __init__(self, id, nome, contato, parent=None):
         super().__init__(id, nome, contato)
         if parent is not None and not isinstance(parent, Afiliado):
@@ -147,6 +2480,8 @@ class Afiliado(Pessoa):
 
     @property
     def vendas(self):
+        if self.__consultar_vendas is not None:
+            return self.__consultar_vendas()
         return self.__vendas
 
     @vendas.setter
@@ -157,11 +2492,52 @@ class Afiliado(Pessoa):
             if not isinstance(item, Venda):
                 raise TypeError("Cada item em vendas deve ser do tipo Venda")
         self.__vendas = value
+        self.__consultar_vendas = None
+
+    def __getstate__(self):
+        return super().__getstate__() + (self.__parent, self.__vendas)
+
+    def __setstate__(self, estado):
+        if isinstance(estado, dict):
+            super().__setstate__(estado)
+        else:
+            super().__setstate__(estado[:3])
+            self.__parent, vendas = estado[3:]
+            # As vendas podem vir como a função que as consulta a cada acesso.
+            if callable(vendas):
+                self.__vendas, self.__consultar_vendas = [], vendas
+            else:
+                self.__vendas, self.__consultar_vendas = vendas, None
 
 class AfiliadoDAO(DAO):
-    def __init__(self):
-        super().__init__('afiliado.pkl')
-    
+    entidade = Afiliado
+    campos = 'qssn'
+    colunas = ('id', 'nome', 'contato', 'parent')
+    indices = ('parent',)
+    busca = ('id', 'nome', 'contato')
+    guardar_excluidos = True
+
+    def __init__(self, escrita_assincrona=False, concorrente=False, codec=None, limite_cache=None,
+                 resolvedor=None):
+        super().__init__('afiliado.pkl', escrita_assincrona, concorrente, codec, limite_cache, resolvedor)
+
+    @staticmethod
+    def para_registro(afiliado):
+        return (afiliado.id, afiliado.nome, afiliado.contato,
+                afiliado.parent.id if afiliado.parent is not None else None)
+
+    def de_registro(self, afiliado, registro):
+        id, nome, contato, parent = registro
+        afiliado.__setstate__((id, nome, contato, self.resolver(Afiliado, parent),
+                               partial(self.consultar_vendas, id)))
+
+    def consultar_vendas(self, afiliado_id):
+        # Pelo índice da coluna 'afiliado' do VendaDAO: registrar uma venda não regrava o afiliado.
+        return self.resolvedor.dao(Venda).consultar({'afiliado': afiliado_id})
+
+    def vincular(self, afiliado):
+        afiliado.__setstate__(afiliado.__getstate__()[:4] + (partial(self.consultar_vendas, afiliado.id),))
+
     def add(self, afiliado: Afiliado):
         if((afiliado is not None) and isinstance(afiliado, Afiliado) and isinstance(afiliado.id, int)):
             super().add(afiliado.id, afiliado)
@@ -178,11 +2554,71 @@ class AfiliadoDAO(DAO):
         if(isinstance(key, int)):
             return super().remove(key)
 
+class Janelas:
+    # Janelas de uma tela, montadas uma única vez. Fechar só esconde a janela; ao
+    # abrir de novo ela volta com os campos no estado inicial e recebe os valores do
+    # uso atual. Se o usuário fechou pelo X, a janela é montada outra vez.
+    def __init__(self):
+        self.__janelas = {}
+        self.__iniciais = {}
+
+    def abrir(self, nome, montar, valores=None):
+        window = self.__janelas.get(nome)
+        if window is None or window.was_closed():
+            window = montar()
+            window.finalize()
+            self.__janelas[nome] = window
+            self.__iniciais[nome] = {chave: elemento.get() for chave, elemento in window.key_dict.items()
+                                     if isinstance(elemento, (sg.Input, sg.Radio, sg.Checkbox, sg.Multiline))}
+        else:
+            for chave, valor in self.__iniciais[nome].items():
+                window[chave].update(valor)
+            window.un_hide()
+        for chave, valor in (valores or {}).items():
+            window[chave].update(valor)
+        return window
+
+    def esconder(self, nome):
+        window = self.__janelas.get(nome)
+        if window is not None and not window.was_closed():
+            window.hide()
+
+    def ler(self, nome, montar, valores=None):
+        window = self.abrir(nome, montar, valores)
+        botao, values = window.read()
+        self.esconder(nome)
+        return botao, values
+
+    def selecionar(self, nome, montar, titulo, buscar, descrever, campo):
+        # Diálogo de seleção com busca enquanto se digita: cada tecla no campo 'busca'
+        # refaz a lista 'resultados' e escolher uma linha preenche `campo`.
+        window = self.abrir(nome, montar, {'titulo': titulo})
+        resultados = buscar('') if buscar else []
+        window['resultados'].update([descrever(resultado) for resultado in resultados])
+        while True:
+            botao, values = window.read()
+            if botao == 'busca':
+                if buscar:
+                    resultados = buscar(values['busca'])
+                    window['resultados'].update([descrever(resultado) for resultado in resultados])
+            elif botao == 'resultados':
+                indices = window['resultados'].get_indexes()
+                if indices:
+                    window[campo].update(str(resultados[indices[0]][campo]))
+            else:
+                break
+        self.esconder(nome)
+        return botao, values
+
 class TelaAfiliado:
     def __init__(self):
         self.__window = None
+        self.__janelas = Janelas()
 
     def init_components(self):
+        self.__window = self.__janelas.abrir('menu', self.__montar_menu)
+
+    def __montar_menu(self):
         sg.theme('DarkBlue14')
         layout = [
             [sg.Text('Escolha uma opção', font=('Helvetica', 14), expand_x=True, justification='center', pad=(5, 10))],
@@ -196,18 +2632,22 @@ class TelaAfiliado:
             sg.Button('Cancelar', size=(10,1), button_color=('white', 'firebrick3')), 
             sg.Push()]
         ]
-        self.__window = sg.Window('Menu de Afiliado').Layout(layout)
+        return sg.Window('Menu de Afiliado').Layout(layout)
 
     def close(self):
-        if self.__window:
-            self.__window.Close()
+        self.__janelas.esconder('menu')
         self.__window = None
 
     def mostrar_menu(self):
         botao, opc = self.__window.Read()
         return botao, opc
 
+    @Instrumentacao.dialogo
     def ler_dados(self):
+        botao, values = self.__janelas.ler('cadastro', self.__montar_cadastro)
+        return None if botao == 'Cancelar' else values
+
+    def __montar_cadastro(self):
         sg.theme('DarkBlue14')
         layout = [
             [sg.Text('Incluir Novo Afiliado', font=('Helvetica', 16), expand_x=True, justification='center', pad=(5, 10))],
@@ -221,12 +2661,9 @@ class TelaAfiliado:
             sg.Button('Cancelar', size=(12, 1), button_color=('white', 'firebrick3')), 
             sg.Push()]
         ]
+        return sg.Window('Cadastro de Afiliado', layout)
 
-        window = sg.Window('Cadastro de Afiliado', layout)
-        botao, values = window.read()
-        window.close()
-        return None if botao == 'Cancelar' else values
-
+    @Instrumentacao.dialogo
     def mostrar_afiliado(self, lista_afiliados):
         texto = "=== Lista de Afiliados ===\n\n"
         for info in lista_afiliados:
@@ -235,42 +2672,62 @@ class TelaAfiliado:
                 parent_id = 'Nenhum'
             texto += f"ID: {info['id']} | Nome: {info['nome']} | Contato: {info['contato']} | Parent ID: {parent_id}\n"
 
+        self.__janelas.ler('lista', self.__montar_lista, {'texto': texto})
+
+    def __montar_lista(self):
         sg.theme('DarkBlue14')
         layout = [
-            [sg.Multiline(texto, size=(60, len(lista_afiliados) + 6), disabled=True)],
+            [sg.Multiline('', size=(60, 25), disabled=True, key='texto')],
             [sg.Button("Fechar")]
         ]
+        return sg.Window("Afiliados Cadastrados", layout)
 
-        window = sg.Window("Afiliados Cadastrados", layout)
-        window.read()
-        window.close()
+    @Instrumentacao.dialogo
+    def selecionar_afiliado(self, titulo: str, buscar=None):
+        botao, values = self.__janelas.selecionar('selecionar', self.__montar_selecao, titulo, buscar,
+                                                  self.__descrever, 'id')
+        return None if botao == 'Cancelar' else values['id']
 
-    def selecionar_afiliado(self, titulo: str):
+    @staticmethod
+    def __descrever(afiliado):
+        return f"{afiliado['id']} | {afiliado['nome']} | {afiliado['contato']}"
+
+    def __montar_selecao(self):
         sg.theme('DarkBlue14')
         layout = [
-            [sg.Text(titulo)],
+            [sg.Text('', key='titulo', size=(45, 1))],
+            [sg.Text('Buscar:'), sg.InputText(key='busca', enable_events=True)],
+            [sg.Listbox([], size=(70, 10), key='resultados', enable_events=True)],
             [sg.Text('ID do Afiliado:'), sg.InputText(key='id')],
             [sg.Submit('Confirmar'), sg.Cancel('Cancelar')]
         ]
-        window = sg.Window('Selecionar Afiliado', layout)
-        botao, values = window.read()
-        window.close()
-        return None if botao == 'Cancelar' else values['id']
+        return sg.Window('Selecionar Afiliado', layout)
 
+    @Instrumentacao.dialogo
     def modificar_dados(self, afiliado_data):
+        botao, values = self.__janelas.ler('modificar', self.__montar_modificacao, {
+            'id_atual': str(afiliado_data['id']),
+            'id': str(afiliado_data['id']),
+            'nome': afiliado_data['nome'],
+            'contato': afiliado_data['contato'],
+            'parent': str(afiliado_data['parent']) if afiliado_data['parent'] else ''
+        })
+        return None if botao == 'Cancelar' else values
+
+    def __montar_modificacao(self):
         sg.theme('DarkBlue14')
         layout = [
             [sg.Text('Modificar Afiliado', font=('Helvetica', 16), expand_x=True, justification='center', pad=(5, 10))],
             [sg.Text('ID Atual:', size=(15, 1), font=('Helvetica', 12)), 
-            sg.Text(str(afiliado_data['id']), key='id_atual', font=('Helvetica', 12))],
+            sg.Text('', key='id_atual', size=(30, 1), font=('Helvetica', 12))],
             [sg.Text('Novo ID:', size=(15, 1), font=('Helvetica', 12)), 
-            sg.InputText(str(afiliado_data['id']), key='id', font=('Helvetica', 12), size=(30, 1))],
+            sg.InputText(key='id', font=('Helvetica', 12), size=(30, 1))],
             [sg.Text('Nome:', size=(15, 1), font=('Helvetica', 12)), 
-            sg.InputText(afiliado_data['nome'], key='nome', font=('Helvetica', 12), size=(30, 1))],
+            sg.InputText(key='nome', font=('Helvetica', 12), size=(30, 1))],
             [sg.Text('Contato:', size=(15, 1), font=('Helvetica', 12)), 
-            sg.InputText(afiliado_data['contato'], key='contato', font=('Helvetica', 12), size=(30, 1))],
+            sg.InputText(key='contato', font=('Helvetica', 12), size=(30, 1))],
             [sg.Text('Parent ID:', size=(15, 1), font=('Helvetica', 12)), 
-            sg.InputText(str(afiliado_data['parent']) if afiliado_data['parent'] else '', key='parent', font=('Helvetica', 12), size=(30, 1))],
+            sg.InputText(key='parent', font=('Helvetica', 12), size=(30, 1))],
             [sg.HorizontalSeparator(pad=(5, 15))],
 
             [sg.Push(), 
@@ -278,37 +2735,45 @@ class TelaAfiliado:
             sg.Button('Cancelar', size=(12, 1), button_color=('white', 'firebrick3')), 
             sg.Push()]
         ]
+        return sg.Window('Modificar Afiliado', layout)
 
-        window = sg.Window('Modificar Afiliado', layout)
-        botao, values = window.read()
-        window.close()
-        return None if botao == 'Cancelar' else values
-
+    @Instrumentacao.dialogo
     def confirmar_exclusao(self, afiliado_data):
+        botao, _ = self.__janelas.ler('excluir', self.__montar_exclusao, {
+            'id': f'ID: {afiliado_data["id"]}',
+            'nome': f'Nome: {afiliado_data["nome"]}'
+        })
+        return botao == 'Confirmar'
+
+    def __montar_exclusao(self):
         sg.theme('DarkBlue14')
         layout = [
             [sg.Text(f'Confirmar exclusão do afiliado?')],
-            [sg.Text(f'ID: {afiliado_data["id"]}')],
-            [sg.Text(f'Nome: {afiliado_data["nome"]}')],
+            [sg.Text('', key='id', size=(40, 1))],
+            [sg.Text('', key='nome', size=(40, 1))],
             [sg.Submit('Confirmar'), sg.Cancel('Cancelar')]
         ]
-        window = sg.Window('Confirmar Exclusão', layout)
-        botao, _ = window.read()
-        window.close()
-        return botao == 'Confirmar'
+        return sg.Window('Confirmar Exclusão', layout)
 
+    @Instrumentacao.dialogo
     def mostrar_mensagem_popup(self, mensagem):
         sg.popup(mensagem)
 
 class ControllerAfiliado:
-    def __init__(self, tela):
+    # Linhas mostradas na busca enquanto se digita.
+    RESULTADOS_BUSCA = 50
+
+    def __init__(self, tela, resolvedor=None):
         self.__tela = tela
-        self.__afiliado_DAO = AfiliadoDAO()
+        self.__afiliado_DAO = AfiliadoDAO(escrita_assincrona=True, concorrente=True, resolvedor=resolvedor)
 
     @property
     def afiliado_DAO (self):
         return self.__afiliado_DAO
 
+    def buscar(self, texto):
+        return self.__afiliado_DAO.buscar(texto, self.RESULTADOS_BUSCA, ('id', 'nome', 'contato'))
+
     def executar(self):
         self.__tela.init_components()
         while True:
@@ -330,6 +2795,7 @@ class ControllerAfiliado:
                 self.__tela.close()
                 break
             
+    @Instrumentacao.instrumentar('afiliado.cadastrar')
     def __cadastrar(self):
         while True:
             try:
@@ -351,15 +2817,12 @@ class ControllerAfiliado:
                     except ValueError:
                         raise DadoInvalidoException("Id Afiliado Pai", dados['parent'], "Id deve ser um inteiro!")
 
-                parent = None
-                for a in self.__afiliado_DAO.get_all():
-                    if a.id == id:
-                        raise DadoInvalidoException("Id", id, "ID já existe")
-                    if parent_id and a.id == parent_id:
-                        parent = a
+                if self.__afiliado_DAO.get(id):
+                    raise DadoInvalidoException("Id", id, "ID já existe")
+                parent = self.__afiliado_DAO.get(parent_id) if parent_id else None
 
                 if parent_id and not parent:
-                    raise sg.popup(EntidadeNaoEncontradaException("Afiliado", parent_id))
+                    raise EntidadeNaoEncontradaException("Afiliado", parent_id)
 
                 afiliado = Afiliado(id, nome, contato, parent)
                 self.__afiliado_DAO.add(afiliado)
@@ -368,13 +2831,15 @@ class ControllerAfiliado:
 
                 break
             except Exception as e:
+                Instrumentacao.falha()
                 self.__tela.mostrar_mensagem_popup(f"Erro ao cadastrar afiliado: {e}")
             
 
+    @Instrumentacao.instrumentar('afiliado.listar')
     def __listar(self):
         afiliados = self.__afiliado_DAO.get_all()
         if not afiliados:
-            sg.popup(EntidadeNaoEncontradaException("Afiliado"))
+            self.__tela.mostrar_mensagem_popup(EntidadeNaoEncontradaException("Afiliado"))
         else:
             lista_afiliados = []
             for a in afiliados:
@@ -385,9 +2850,10 @@ class ControllerAfiliado:
                 lista_afiliados.append(info)
             self.__tela.mostrar_afiliado(lista_afiliados)
 
+    @Instrumentacao.instrumentar('afiliado.modificar')
     def __modificar(self):
         try:
-            id_str = self.__tela.selecionar_afiliado("Digite o ID do afiliado para modificar")
+            id_str = self.__tela.selecionar_afiliado("Busque ou digite o ID do afiliado para modificar", self.buscar)
             if not id_str: return
             id = int(id_str)
             
@@ -439,11 +2905,13 @@ class ControllerAfiliado:
             self.__tela.mostrar_mensagem_popup("Afiliado modificado com sucesso!")
             
         except Exception as e:
+            Instrumentacao.falha()
             self.__tela.mostrar_mensagem_popup(f"Erro ao modificar afiliado: {e}")
 
+    @Instrumentacao.instrumentar('afiliado.excluir')
     def __excluir(self):
         try:
-            id_str = self.__tela.selecionar_afiliado("Digite o ID do afiliado para excluir")
+            id_str = self.__tela.selecionar_afiliado("Busque ou digite o ID do afiliado para excluir", self.buscar)
             if not id_str: return
             id = int(id_str)
             
@@ -451,11 +2919,10 @@ class ControllerAfiliado:
             if not afiliado:
                 raise EntidadeNaoEncontradaException("Afiliado", id)
 
-            for a in self.__afiliado_DAO.get_all():
-                if a.parent and a.parent.id == id:
-                    raise ViolacaoRegraNegocioException(
-                        f"Não é possível excluir {afiliado.nome} pois é parente de outros afiliados"
-                    )
+            if self.__afiliado_DAO.consultar({'parent': id}, limite=1, campos=('id',)):
+                raise ViolacaoRegraNegocioException(
+                    f"Não é possível excluir {afiliado.nome} pois é parente de outros afiliados"
+                )
                 
             dados_afiliado = {
                 "id": afiliado.id,
@@ -469,6 +2936,7 @@ class ControllerAfiliado:
             self.__tela.mostrar_mensagem_popup("Afiliado excluído com sucesso!")
             
         except Exception as e:
+            Instrumentacao.falha()
             self.__tela.mostrar_mensagem_popup(f"Erro ao excluir afiliado: {e}")
 
 class ProdutoDetalhes:
@@ -540,10 +3008,35 @@ class Produto:
             raise TypeError("preco deve ser numérico")
         self.__preco = float(value)
 
+    def __getstate__(self):
+        return (self.__codigo, self.__detalhes.nome, self.__detalhes.descricao, self.__preco)
+
+    def __setstate__(self, estado):
+        if isinstance(estado, dict):
+            self.__dict__.update(estado)
+        else:
+            self.__codigo, nome, descricao, self.__preco = estado
+            self.__detalhes = ProdutoDetalhes(nome, descricao)
+
 class ProdutoDAO(DAO):
-    def __init__(self):
-        super().__init__('produto.pkl')
-    
+    entidade = Produto
+    campos = 'sssd'
+    colunas = ('codigo', 'nome', 'descricao', 'preco')
+    busca = ('codigo', 'nome', 'descricao')
+    guardar_excluidos = True
+
+    def __init__(self, escrita_assincrona=False, concorrente=False, codec=None, limite_cache=None,
+                 resolvedor=None):
+        super().__init__('produto.pkl', escrita_assincrona, concorrente, codec, limite_cache, resolvedor)
+
+    @staticmethod
+    def para_registro(produto):
+        return produto.__getstate__()
+
+    @staticmethod
+    def de_registro(produto, registro):
+        produto.__setstate__(registro)
+
     def add(self, produto: Produto):
         if((produto is not None) and isinstance(produto, Produto) and isinstance(produto.codigo, str)):
             super().add(produto.codigo, produto)
@@ -563,8 +3056,12 @@ class ProdutoDAO(DAO):
 class TelaProduto:
     def __init__(self):
         self.__window = None
+        self.__janelas = Janelas()
 
     def init_components(self):
+        self.__window = self.__janelas.abrir('menu', self.__montar_menu)
+
+    def __montar_menu(self):
         sg.theme('DarkBlue14')
         layout = [
             [sg.Text('Escolha uma opção', font=('Helvetica', 14), expand_x=True, justification='center', pad=(5, 10))],
@@ -576,18 +3073,22 @@ class TelaProduto:
             [sg.Push(), sg.Button('Confirmar', size=(10,1), button_color=('white', 'green')),
             sg.Button('Cancelar', size=(10,1), button_color=('white', 'firebrick3')), sg.Push()]
         ]
-        self.__window = sg.Window('Menu de Produtos').Layout(layout)
+        return sg.Window('Menu de Produtos').Layout(layout)
 
     def close(self):
-        if self.__window:
-            self.__window.Close()
+        self.__janelas.esconder('menu')
         self.__window = None
 
     def mostrar_menu(self):
         botao, opc = self.__window.Read()
         return botao, opc
 
+    @Instrumentacao.dialogo
     def ler_dados(self):
+        botao, values = self.__janelas.ler('cadastro', self.__montar_cadastro)
+        return None if botao == 'Cancelar' else values
+
+    def __montar_cadastro(self):
         sg.theme('DarkBlue14')
         layout = [
         [sg.Text('Incluir Novo Produto', font=('Helvetica', 16), expand_x=True, justification='center', pad=(5, 10))],
@@ -603,50 +3104,65 @@ class TelaProduto:
          sg.Button('Cancelar', size=(12, 1), button_color=('white', 'firebrick3')), 
          sg.Push()]
     ]
+        return sg.Window('Cadastro de Produto', layout)
 
-        window = sg.Window('Cadastro de Produto', layout)
-        botao, values = window.read()
-        window.close()
-        return None if botao == 'Cancelar' else values
-
+    @Instrumentacao.dialogo
     def mostrar_produto(self, lista_produtos):
         texto = "=== Lista de Produtos ===\n\n"
         for info in lista_produtos:
             texto += f"Código: {info['codigo']} | Nome: {info['nome']} | Descrição: {info['descricao']} | Preço: {info['preco']}\n"
 
+        self.__janelas.ler('lista', self.__montar_lista, {'texto': texto})
+
+    def __montar_lista(self):
         layout = [
-            [sg.Multiline(texto, size=(60, len(lista_produtos) + 6), disabled=True)],
+            [sg.Multiline('', size=(60, 25), disabled=True, key='texto')],
             [sg.Button("Fechar", size=(7, 1), button_color=('white', 'firebrick3'))]
         ]
+        return sg.Window("Produtos Cadastrados", layout)
 
-        window = sg.Window("Produtos Cadastrados", layout)
-        window.read()
-        window.close()
+    @Instrumentacao.dialogo
+    def selecionar_produto(self, titulo: str, buscar=None):
+        botao, values = self.__janelas.selecionar('selecionar', self.__montar_selecao, titulo, buscar,
+                                                  self.__descrever, 'codigo')
+        return None if botao == 'Cancelar' else values['codigo']
 
-    def selecionar_produto(self, titulo: str):
+    @staticmethod
+    def __descrever(produto):
+        return f"{produto['codigo']} | {produto['nome']} | {produto['descricao']} | R${produto['preco']:.2f}"
+
+    def __montar_selecao(self):
         layout = [
-            [sg.Text(titulo)],
+            [sg.Text('', key='titulo', size=(45, 1))],
+            [sg.Text('Buscar:'), sg.InputText(key='busca', enable_events=True)],
+            [sg.Listbox([], size=(70, 10), key='resultados', enable_events=True)],
             [sg.Text('Código do Produto:'), sg.InputText(key='codigo')],
             [sg.Button('Confirmar', size=(12, 1), button_color=('white', 'green')), 
             sg.Button('Cancelar', size=(12, 1), button_color=('white', 'firebrick3'))]
         ]
-        window = sg.Window('Selecionar Produto', layout)
-        botao, values = window.read()
-        window.close()
-
-        return None if botao == 'Cancelar' else values['codigo']
+        return sg.Window('Selecionar Produto', layout)
 
+    @Instrumentacao.dialogo
     def modificar_dados(self, produto_data):
+        botao, values = self.__janelas.ler('modificar', self.__montar_modificacao, {
+            'codigo_atual': str(produto_data['codigo']),
+            'nome': produto_data['nome'],
+            'descricao': produto_data['descricao'],
+            'preco': str(produto_data['preco'])
+        })
+        return None if botao == 'Cancelar' else values
+
+    def __montar_modificacao(self):
         layout = [
             [sg.Text('Modificar Produto', font=('Helvetica', 16), expand_x=True, justification='center', pad=(5, 10))],
             [sg.Text('Código atual:', size=(15, 1), font=('Helvetica', 12)), 
-            sg.Text(str(produto_data['codigo']), key='codigo_atual', font=('Helvetica', 12))],
+            sg.Text('', key='codigo_atual', size=(40, 1), font=('Helvetica', 12))],
             [sg.Text('Nome:', size=(15, 1), font=('Helvetica', 12)), 
-            sg.InputText(produto_data['nome'], key='nome', font=('Helvetica', 12), size=(40, 1))],
+            sg.InputText(key='nome', font=('Helvetica', 12), size=(40, 1))],
             [sg.Text('Descrição:', size=(15, 1), font=('Helvetica', 12)), 
-            sg.InputText(produto_data['descricao'], key='descricao', font=('Helvetica', 12), size=(40, 1))],
+            sg.InputText(key='descricao', font=('Helvetica', 12), size=(40, 1))],
             [sg.Text('Preço:', size=(15, 1), font=('Helvetica', 12)), 
-            sg.InputText(str(produto_data['preco']), key='preco', font=('Helvetica', 12), size=(40, 1))],
+            sg.InputText(key='preco', font=('Helvetica', 12), size=(40, 1))],
             [sg.HorizontalSeparator(pad=(5, 15))],
 
             [sg.Push(), 
@@ -654,34 +3170,38 @@ class TelaProduto:
             sg.Button('Cancelar', size=(12, 1), button_color=('white', 'firebrick3')), 
             sg.Push()]
         ]
+        return sg.Window('Modificar Produto', layout)
 
-        window = sg.Window('Modificar Produto', layout)
-        botao, values = window.read()
-        window.close()
-        return None if botao == 'Cancelar' else values
-
+    @Instrumentacao.dialogo
     def confirmar_exclusao(self, produto_data):
+        botao, _ = self.__janelas.ler('excluir', self.__montar_exclusao, {
+            'codigo': f'Código: {produto_data["codigo"]}',
+            'nome': f'Nome: {produto_data["nome"]}'
+        })
+        return botao == 'Confirmar'
+
+    def __montar_exclusao(self):
         layout = [
             [sg.Text(f'Confirmar exclusão do produto?')],
-            [sg.Text(f'Código: {produto_data["codigo"]}')],
-            [sg.Text(f'Nome: {produto_data["nome"]}')],
+            [sg.Text('', key='codigo', size=(40, 1))],
+            [sg.Text('', key='nome', size=(40, 1))],
             [sg.Push(), 
             sg.Button('Confirmar', size=(9, 1), button_color=('white', 'green')), 
             sg.Button('Cancelar', size=(9, 1), button_color=('white', 'firebrick3')),
             sg.Push()]
         ]
-        window = sg.Window('Confirmar Exclusão', layout)
-        botao, _ = window.read()
-        window.close()
-        return botao == 'Confirmar'
+        return sg.Window('Confirmar Exclusão', layout)
     
+    @Instrumentacao.dialogo
     def mostrar_mensagem_popup(self, mensagem):
         sg.popup(mensagem)
 
 class ControllerProduto:
-    def __init__(self, tela):
+    RESULTADOS_BUSCA = 50
+
+    def __init__(self, tela, resolvedor=None):
         self.__tela = tela
-        self.__produto_DAO = ProdutoDAO()
+        self.__produto_DAO = ProdutoDAO(escrita_assincrona=True, concorrente=True, resolvedor=resolvedor)
         self.__controller_venda = None  # Será injetado posteriormente
 
     def set_controller_venda(self, controller_venda):
@@ -700,6 +3220,9 @@ class ControllerProduto:
                 raise TypeError("Cada item em listaProdutos deve ser do tipo Produto")
         self.__produto_DAO = value
 
+    def buscar(self, texto):
+        return self.__produto_DAO.buscar(texto, self.RESULTADOS_BUSCA, ('codigo', 'nome', 'descricao', 'preco'))
+
     def executar(self):
         self.__tela.init_components()
         while True:
@@ -721,6 +3244,7 @@ class ControllerProduto:
                 self.__tela.close()
                 break
 
+    @Instrumentacao.instrumentar('produto.cadastrar')
     def __cadastrar(self):
         while True:
             try:
@@ -737,9 +3261,8 @@ class ControllerProduto:
                 except ValueError:
                     raise DadoInvalidoException("Preço", dados['preco'], "Preço deve ser numérico")
 
-                for item in self.__produto_DAO.get_all():
-                    if item.codigo == dados['codigo']:
-                        raise DadoInvalidoException("Código", dados['codigo'], "Código já existe")
+                if self.__produto_DAO.get(dados['codigo']):
+                    raise DadoInvalidoException("Código", dados['codigo'], "Código já existe")
 
                 produto = Produto(codigo, nome, descricao, preco)
                 self.__produto_DAO.add(produto)
@@ -747,12 +3270,14 @@ class ControllerProduto:
                 
                 break
             except Exception as e:
+                Instrumentacao.falha()
                 self.__tela.mostrar_mensagem_popup(f"Erro ao cadastrar Produto: {e}")
 
+    @Instrumentacao.instrumentar('produto.listar')
     def __listar(self):
         produtos = self.__produto_DAO.get_all()
         if not produtos:
-            sg.popup(EntidadeNaoEncontradaException("Produto"))
+            self.__tela.mostrar_mensagem_popup(EntidadeNaoEncontradaException("Produto"))
         else:
             lista_produtos = []
             for p in produtos:
@@ -760,9 +3285,10 @@ class ControllerProduto:
                 lista_produtos.append(info)
             self.__tela.mostrar_produto(lista_produtos)
 
+    @Instrumentacao.instrumentar('produto.modificar')
     def __modificar(self):
         try:
-            codigo = self.__tela.selecionar_produto("Digite o Código do produto para modificar")
+            codigo = self.__tela.selecionar_produto("Busque ou digite o Código do produto para modificar", self.buscar)
             if not codigo: return
 
             produto = None
@@ -797,11 +3323,13 @@ class ControllerProduto:
             self.__tela.mostrar_mensagem_popup("Produto modificado com sucesso!")
             
         except Exception as e:
+            Instrumentacao.falha()
             self.__tela.mostrar_mensagem_popup(f"Erro ao modificar produto: {e}")
 
+    @Instrumentacao.instrumentar('produto.excluir')
     def __excluir(self):
         try:
-            codigo = self.__tela.selecionar_produto("Digite o Código do produto para modificar")
+            codigo = self.__tela.selecionar_produto("Busque ou digite o Código do produto para modificar", self.buscar)
             if not codigo: return
             produto = None
 
@@ -811,10 +3339,8 @@ class ControllerProduto:
 
             tem_venda = False
             if self.__controller_venda:
-                for venda in self.__controller_venda.venda_DAO.get_all():
-                    if venda.produto == produto:
-                        tem_venda = True
-                        break
+                tem_venda = bool(self.__controller_venda.venda_DAO.consultar(
+                    {'produto': produto.codigo}, limite=1, campos=('id',)))
             
             if tem_venda:
                 raise ViolacaoRegraNegocioException(
@@ -833,6 +3359,7 @@ class ControllerProduto:
             self.__tela.mostrar_mensagem_popup("Produto excluído com sucesso!")
             
         except Exception as e:
+            Instrumentacao.falha()
             self.__tela.mostrar_mensagem_popup(f"Erro ao excluir produto: {e}")
 
 class Venda:
@@ -930,10 +3457,43 @@ class Venda:
     def calcularTotal(self):
         self.__total = self.quantidade * self.produto.preco
         return self.__total
+
+    def __getstate__(self):
+        return (self.__id, self.__data, self.__afiliado, self.__produto,
+                self.__quantidade, self.__total, self.__pagamento_afiliado)
+
+    def __setstate__(self, estado):
+        if isinstance(estado, dict):
+            self.__dict__.update(estado)
+        else:
+            (self.__id, self.__data, self.__afiliado, self.__produto,
+             self.__quantidade, self.__total, self.__pagamento_afiliado) = estado
     
 class VendaDAO(DAO):
-    def __init__(self):
-        super().__init__('venda.pkl')
+    entidade = Venda
+    campos = 'qiqsqds'
+    colunas = ('id', 'data', 'afiliado', 'produto', 'quantidade', 'total', 'pagamento_afiliado')
+    indices = ('data', 'afiliado', 'produto', 'pagamento_afiliado')
+    busca = ('id', 'data', 'afiliado', 'produto', 'pagamento_afiliado')
+    conversoes = {'data': (date.toordinal, date.fromordinal)}
+    sequencial = True
+    # O histórico de vendas é o que mais cresce; AFILIADOS_LIMITE_CACHE_VENDAS limita
+    # quantas vendas ficam montadas em memória (afiliados e produtos ficam todos).
+    limite_cache = int(os.environ['AFILIADOS_LIMITE_CACHE_VENDAS']) if os.environ.get('AFILIADOS_LIMITE_CACHE_VENDAS') else None
+
+    def __init__(self, escrita_assincrona=False, concorrente=False, codec=None, limite_cache=None,
+                 resolvedor=None):
+        super().__init__('venda.pkl', escrita_assincrona, concorrente, codec, limite_cache, resolvedor)
+
+    @staticmethod
+    def para_registro(venda):
+        return (venda.id, venda.data.toordinal(), venda.afiliado.id, venda.produto.codigo,
+                venda.quantidade, venda.total, venda.pagamento_afiliado)
+
+    def de_registro(self, venda, registro):
+        id, data, afiliado, produto, quantidade, total, pagamento_afiliado = registro
+        venda.__setstate__((id, date.fromordinal(data), self.resolver(Afiliado, afiliado),
+                            self.resolver(Produto, produto), quantidade, total, pagamento_afiliado))
     
     def add(self, venda: Venda):
         if((venda is not None) and isinstance(venda, Venda) and isinstance(venda.id, int)):
@@ -943,19 +3503,431 @@ class VendaDAO(DAO):
         if((venda is not None) and isinstance(venda, Venda) and isinstance(venda.id, int)):
             super().update(venda.id, venda)
 
-    def get(self, key:int):
-        if isinstance(key, int):
-            return super().get(key)
+    def get(self, key:int):
+        if isinstance(key, int):
+            return super().get(key)
+
+    def remove(self, key:int):
+        if(isinstance(key, int)):
+            return super().remove(key)
+
+class TravaArquivo:
+    # Trava exclusiva entre processos sobre <arquivo>.lock (flock ou, no Windows,
+    # msvcrt; sem nenhum dos dois, só entre as threads do processo). A thread que já
+    # detém a trava pode travar de novo (ex.: a gravação dentro de DAO.transacao()).
+    def __init__(self, arquivo):
+        self.__caminho = f"{arquivo}.lock"
+        self.__local = threading.RLock()
+        self.__profundidade = 0
+
+    @contextmanager
+    def travar(self):
+        with self.__local:
+            self.__profundidade += 1
+            try:
+                if self.__profundidade > 1 or (fcntl is None and msvcrt is None):
+                    yield
+                    return
+                with open(self.__caminho, 'a+b') as trava:
+                    if fcntl is not None:
+                        fcntl.flock(trava.fileno(), fcntl.LOCK_EX)
+                    else:
+                        trava.seek(0)
+                        msvcrt.locking(trava.fileno(), msvcrt.LK_LOCK, 1)
+                    try:
+                        yield
+                    finally:
+                        if fcntl is not None:
+                            fcntl.flock(trava.fileno(), fcntl.LOCK_UN)
+                        else:
+                            trava.seek(0)
+                            msvcrt.locking(trava.fileno(), msvcrt.LK_UNLCK, 1)
+            finally:
+                self.__profundidade -= 1
+
+class ArquivoVendas:
+    MAGICO = b'AFVARQ01'
+    # id, data (ordinal), afiliado id, afiliado nome, produto código, produto nome, quantidade, total
+    REGISTRO = struct.Struct('<qiq40s32s40sid')
+    CHAVES = struct.Struct('<qiq')
+    ID = struct.Struct('<q')
+
+    def __init__(self, datasource='venda_arquivo.bin'):
+        self.__datasource = datasource
+        # Ids do arquivamento em andamento, gravados antes de anexar ao arquivo e apagados
+        # depois que as vendas saem do VendaDAO: se o processo cair no meio, quem abrir o
+        # arquivo em seguida conclui a remoção em vez de contar as vendas duas vezes.
+        self.__pendente = f"{datasource}.pendente"
+        # Outras estações (ou outras instâncias) também arquivam: o arquivamento inteiro
+        # acontece sob a trava, e o mapa é refeito quando o tamanho do arquivo muda.
+        self.__trava = TravaArquivo(datasource)
+        self.__mapa = None
+        self.__ids = None
+
+    def __abrir(self):
+        try:
+            tamanho = os.path.getsize(self.__datasource)
+        except FileNotFoundError:
+            self.fechar()
+            return None
+        if self.__mapa is not None and len(self.__mapa) != tamanho:
+            self.fechar()
+        if self.__mapa is None:
+            with open(self.__datasource, 'rb') as arquivo:
+                self.__mapa = mmap.mmap(arquivo.fileno(), 0, access=mmap.ACCESS_READ)
+            self.__ids = None
+            if self.__mapa[:len(self.MAGICO)] != self.MAGICO:
+                self.fechar()
+                raise DadoInvalidoException("Arquivo", self.__datasource, "Arquivo de vendas arquivadas inválido")
+        return self.__mapa
+
+    def travar(self):
+        # Para quem precisa manter o arquivamento e os passos seguintes (ex.: tirar as
+        # vendas do VendaDAO e concluir()) sem outra estação no meio.
+        return self.__trava.travar()
+
+    def fechar(self):
+        if self.__mapa is not None:
+            self.__mapa.close()
+        self.__mapa = None
+        self.__ids = None
+
+    @staticmethod
+    def __texto(valor: str, tamanho: int, campo: str, obrigatorio: bool = False):
+        dados = valor.encode('utf-8')
+        if len(dados) > tamanho:
+            if obrigatorio:
+                raise DadoInvalidoException(campo, valor, f"Não cabe no arquivo (máximo {tamanho} bytes)")
+            dados = dados[:tamanho]
+        return dados
+
+    def arquivar(self, vendas):
+        # Devolve as vendas gravadas: as que outra estação arquivou antes ficam de fora.
+        with self.__trava.travar():
+            vendas = [venda for venda in vendas if not self.contem(venda.id)]
+            self.__anexar(vendas)
+        return vendas
+
+    def __anexar(self, vendas):
+        registros = []
+        for venda in vendas:
+            if venda.pagamento_afiliado != 'realizado':
+                raise ViolacaoRegraNegocioException(
+                    f"Venda {venda.id} não pode ser arquivada antes do pagamento da comissão"
+                )
+            registros.append(self.REGISTRO.pack(
+                venda.id,
+                venda.data.toordinal(),
+                venda.afiliado.id,
+                self.__texto(venda.afiliado.nome, 40, "Nome do afiliado"),
+                self.__texto(venda.produto.codigo, 32, "Código do produto", obrigatorio=True),
+                self.__texto(venda.produto.detalhes.nome, 40, "Nome do produto"),
+                venda.quantidade,
+                venda.total
+            ))
+
+        self.fechar()
+        with open(self.__pendente, 'wb') as arquivo:
+            arquivo.write(b''.join(self.ID.pack(venda.id) for venda in vendas))
+            arquivo.flush()
+            os.fsync(arquivo.fileno())
+        novo = not os.path.exists(self.__datasource)
+        with open(self.__datasource, 'ab') as arquivo:
+            if novo:
+                arquivo.write(self.MAGICO)
+            else:
+                # Registro incompleto de uma gravação interrompida: descartado para não desalinhar os seguintes.
+                sobra = (arquivo.tell() - len(self.MAGICO)) % self.REGISTRO.size
+                if sobra:
+                    arquivo.truncate(arquivo.tell() - sobra)
+                    arquivo.seek(0, os.SEEK_END)
+            arquivo.write(b''.join(registros))
+            arquivo.flush()
+            os.fsync(arquivo.fileno())
+
+    def pendentes(self):
+        # Ids de um arquivamento interrompido que já estão no arquivo e portanto devem sair do VendaDAO.
+        try:
+            with open(self.__pendente, 'rb') as arquivo:
+                dados = arquivo.read()
+        except FileNotFoundError:
+            return []
+        return [id for (id,) in self.ID.iter_unpack(dados[:len(dados) - len(dados) % self.ID.size]) if self.contem(id)]
+
+    def concluir(self):
+        try:
+            os.remove(self.__pendente)
+        except FileNotFoundError:
+            pass
+
+    def registros(self, data_inicial: date = None, data_final: date = None, afiliado_id: int = None):
+        mapa = self.__abrir()
+        if mapa is None:
+            return
+        inicio = data_inicial.toordinal() if data_inicial else None
+        fim = data_final.toordinal() if data_final else None
+        for posicao in range(len(self.MAGICO), len(mapa) - self.REGISTRO.size + 1, self.REGISTRO.size):
+            id, data, id_afiliado = self.CHAVES.unpack_from(mapa, posicao)
+            if inicio is not None and data < inicio:
+                continue
+            if fim is not None and data > fim:
+                continue
+            if afiliado_id is not None and id_afiliado != afiliado_id:
+                continue
+            (_, _, _, nome_afiliado, codigo, nome_produto,
+             quantidade, total) = self.REGISTRO.unpack_from(mapa, posicao)
+            yield {
+                'id': id,
+                'data': date.fromordinal(data),
+                'afiliado_id': id_afiliado,
+                'afiliado': nome_afiliado.rstrip(b'\0').decode('utf-8', 'ignore'),
+                'produto_codigo': codigo.rstrip(b'\0').decode('utf-8'),
+                'produto': nome_produto.rstrip(b'\0').decode('utf-8', 'ignore'),
+                'quantidade': quantidade,
+                'total': total
+            }
+
+    def contem(self, id: int):
+        mapa = self.__abrir()
+        if mapa is None:
+            return False
+        if self.__ids is None:
+            self.__ids = {self.ID.unpack_from(mapa, posicao)[0]
+                          for posicao in range(len(self.MAGICO), len(mapa) - self.REGISTRO.size + 1, self.REGISTRO.size)}
+        return id in self.__ids
+
+class Progresso:
+    # Liga uma operação longa, rodando numa thread de trabalho, à tela que a acompanha.
+    # A operação informa o andamento e, nos pontos em que pode parar sem deixar dados
+    # pela metade, avancar()/verificar() lançam OperacaoCanceladaException se o
+    # usuário cancelou. Etapas não canceláveis (gravação) ignoram o pedido.
+    def __init__(self, ao_informar=None):
+        self.__ao_informar = ao_informar
+        self.__cancelado = threading.Event()
+        self.__cancelavel = True
+        self.__ultimo = None
+
+    @property
+    def cancelado(self):
+        return self.__cancelado.is_set()
+
+    @property
+    def cancelavel(self):
+        return self.__cancelavel
+
+    def cancelar(self):
+        self.__cancelado.set()
+
+    def verificar(self):
+        if self.__cancelavel and self.__cancelado.is_set():
+            raise OperacaoCanceladaException()
+
+    def etapa(self, mensagem, cancelavel=True):
+        self.__cancelavel = cancelavel
+        self.verificar()
+        self.__informar(mensagem, None)
 
-    def remove(self, key:int):
-        if(isinstance(key, int)):
-            return super().remove(key)
+    def avancar(self, atual, total, mensagem=None):
+        self.verificar()
+        self.__informar(mensagem, atual / total if total else None)
+
+    def __informar(self, mensagem, fracao):
+        if self.__ao_informar is None:
+            return
+        # Só avisa a tela quando o percentual ou a mensagem mudam, para não inundar
+        # a fila de eventos com uma chamada por registro.
+        estado = (mensagem, None if fracao is None else int(fracao * 100), self.__cancelavel)
+        if estado != self.__ultimo:
+            self.__ultimo = estado
+            self.__ao_informar(mensagem, fracao, self.__cancelavel)
+
+class TelaProgresso:
+    def __init__(self):
+        self.__janelas = Janelas()
+
+    def acompanhar(self, titulo, operacao):
+        # Roda operacao(progresso) numa thread e mantém a janela respondendo, com barra
+        # de progresso e botão de cancelar; devolve o resultado ou relança o erro.
+        # A janela é a mesma entre usos: só título, barra e botão voltam ao início.
+        window = self.__janelas.abrir('progresso', self.__montar)
+        window.set_title(titulo)
+        window['mensagem'].update(titulo)
+        window['barra'].update(current_count=0)
+        window['Cancelar'].update(disabled=False)
+        progresso = Progresso(lambda mensagem, fracao, cancelavel:
+                              window.write_event_value('-PROGRESSO-', (mensagem, fracao, cancelavel)))
+        resultado = {}
+
+        def trabalhar():
+            try:
+                resultado['valor'] = operacao(progresso)
+            except Exception as e:
+                resultado['erro'] = e
+            window.write_event_value('-FIM-', None)
+
+        # Com o modo de perfil ativo, o perfil da ação é o da thread de trabalho; a espera
+        # da janela conta na duração, mas fica fora do perfil.
+        threading.Thread(target=Perfilador.em_thread(trabalhar), daemon=True).start()
+        try:
+            with Perfilador.pausa(descontar=False):
+                while True:
+                    evento, valores = window.read()
+                    if evento == '-FIM-':
+                        break
+                    if evento == '-PROGRESSO-':
+                        mensagem, fracao, cancelavel = valores[evento]
+                        if mensagem:
+                            window['mensagem'].update(mensagem)
+                        if fracao is not None:
+                            window['barra'].update(current_count=int(fracao * 1000))
+                        window['Cancelar'].update(disabled=not cancelavel or progresso.cancelado)
+                    elif evento == 'Cancelar':
+                        progresso.cancelar()
+                        window['Cancelar'].update(disabled=True)
+                        window['mensagem'].update("Cancelando...")
+        finally:
+            self.__janelas.esconder('progresso')
+        if 'erro' in resultado:
+            raise resultado['erro']
+        return resultado.get('valor')
+
+    def __montar(self):
+        layout = [
+            [sg.Text('', key='mensagem', size=(50, 1), font=('Helvetica', 11))],
+            [sg.ProgressBar(1000, orientation='h', size=(40, 20), key='barra')],
+            [sg.Push(), sg.Button('Cancelar', size=(10, 1), button_color=('white', 'firebrick3')), sg.Push()]
+        ]
+        return sg.Window('', layout, disable_close=True)
+
+class ProcessamentoParalelo:
+    # Divide os relatórios de vendas/pagamentos em partições (faixas de data) e
+    # processa cada uma num processo separado. Os processos leem os próprios arquivos
+    # de dados, então só os filtros de cada partição e os resultados parciais cruzam
+    # a fronteira entre processos; as pendências de escrita são gravadas antes.
+    # Abaixo de MINIMO registros o custo de despachar supera o ganho e quem chama
+    # segue pelo caminho de um processo só.
+    MINIMO = 100000
+    PARTICOES_POR_PROCESSO = 4
+    __padrao = None
+    __resolvedores = {}
+
+    def __init__(self, processos=None, minimo=None):
+        self.__processos = processos or os.cpu_count() or 1
+        self.__minimo = self.MINIMO if minimo is None else minimo
+        self.__executor = None
+        self.__trava = threading.Lock()
+
+    @classmethod
+    def padrao(cls):
+        if cls.__padrao is None:
+            processos = os.environ.get('AFILIADOS_PROCESSOS')
+            cls.__padrao = cls(int(processos) if processos else None)
+        return cls.__padrao
+
+    @property
+    def processos(self):
+        return self.__processos
+
+    def vale_a_pena(self, dao, filtros):
+        if self.__processos <= 1:
+            return False
+        # Com filtros só em colunas indexadas a contagem não lê nenhum registro.
+        return len(dao.consultar(filtros, campos=(dao.colunas[0],))) >= self.__minimo
+
+    def particionar_por_data(self, filtros, partes=None):
+        partes = partes or self.__processos * self.PARTICOES_POR_PROCESSO
+        periodo = filtros.get('data')
+        if not isinstance(periodo, Intervalo) or periodo.inicio is None or periodo.fim is None:
+            return [dict(filtros)]
+        dias = (periodo.fim - periodo.inicio).days + 1
+        partes = max(1, min(partes, dias))
+        particoes = []
+        for parte in range(partes):
+            inicio = periodo.inicio + timedelta(days=dias * parte // partes)
+            fim = periodo.inicio + timedelta(days=dias * (parte + 1) // partes - 1)
+            particoes.append(dict(filtros, data=Intervalo(inicio, fim)))
+        return particoes
+
+    def executar(self, tarefa, particoes, progresso=None):
+        with self.__trava:
+            if self.__executor is None:
+                # spawn: nada de fork com as threads de escrita dos DAOs em andamento.
+                self.__executor = ProcessPoolExecutor(self.__processos,
+                                                      mp_context=multiprocessing.get_context('spawn'))
+            executor = self.__executor
+        with Instrumentacao.medir('paralelo.executar'):
+            Instrumentacao.contar('paralelo.particoes', len(particoes))
+            resultados = []
+            for resultado in executor.map(tarefa, repeat(os.getcwd()), particoes):
+                resultados.append(resultado)
+                if progresso is not None:
+                    progresso.avancar(len(resultados), len(particoes), "Processando partições")
+            return resultados
+
+    def encerrar(self):
+        with self.__trava:
+            executor, self.__executor = self.__executor, None
+        if executor is not None:
+            executor.shutdown()
+
+    @staticmethod
+    def __abrir(diretorio, *classes):
+        # Cada processo abre os DAOs de um diretório uma vez, todos num resolvedor
+        # daquele diretório; em modo concorrente eles se atualizam sozinhos quando
+        # o arquivo muda entre uma tarefa e outra.
+        resolvedor = ProcessamentoParalelo.__resolvedores.get(diretorio)
+        if resolvedor is None:
+            resolvedor = ProcessamentoParalelo.__resolvedores[diretorio] = Resolvedor(diretorio, concorrente=True)
+        return [resolvedor.dao(classe.entidade) for classe in classes]
+
+    @staticmethod
+    def __nomes(dao, chaves):
+        if not chaves:
+            return {}
+        coluna = dao.colunas[0]
+        return {linha[coluna]: linha['nome'] for linha in dao.consultar({coluna: set(chaves)}, campos=(coluna, 'nome'))}
+
+    # Tarefas executadas nos processos: recebem o diretório dos dados e os filtros
+    # da partição e devolvem resultados parciais em tipos simples.
+    @staticmethod
+    def particao_vendas(diretorio, filtros):
+        venda_DAO, afiliado_DAO, produto_DAO = ProcessamentoParalelo.__abrir(diretorio, VendaDAO, AfiliadoDAO, ProdutoDAO)
+        vendas = venda_DAO.consultar(filtros, ordem='id',
+                                     campos=('id', 'data', 'afiliado', 'produto', 'quantidade', 'total'))
+        afiliados = ProcessamentoParalelo.__nomes(afiliado_DAO, {venda['afiliado'] for venda in vendas})
+        produtos = ProcessamentoParalelo.__nomes(produto_DAO, {venda['produto'] for venda in vendas})
+        linhas = [{
+            'id': venda['id'],
+            'data': str(venda['data']),
+            'afiliado': afiliados.get(venda['afiliado'], ''),
+            'produto': produtos.get(venda['produto'], ''),
+            'quantidade': venda['quantidade'],
+            'total': venda['total']
+        } for venda in vendas]
+        return linhas, afiliados, produtos
+
+    @staticmethod
+    def particao_financeiro(diretorio, filtros):
+        pagamento_DAO, afiliado_DAO = ProcessamentoParalelo.__abrir(diretorio, PagamentoDAO, AfiliadoDAO)
+        pagamentos = pagamento_DAO.consultar(filtros, ordem='id', campos=('id', 'data', 'afiliado', 'valorPago'))
+        afiliados = ProcessamentoParalelo.__nomes(afiliado_DAO, {pagamento['afiliado'] for pagamento in pagamentos})
+        linhas = [{
+            'id': pagamento['id'],
+            'data': str(pagamento['data']),
+            'afiliado': f"{afiliados.get(pagamento['afiliado'], '')} (ID: {pagamento['afiliado']})",
+            'valorPago': pagamento['valorPago']
+        } for pagamento in pagamentos]
+        return linhas, afiliados
 
 class TelaVenda:
     def __init__(self):
         self.__window = None
+        self.__janelas = Janelas()
 
     def init_components(self):
+        self.__window = self.__janelas.abrir('menu', self.__montar_menu)
+
+    def __montar_menu(self):
         sg.theme('DarkBlue14')
         layout = [
             [sg.Text('Escolha uma opção', font=('Helvetica', 14), expand_x=True, justification='center', pad=(5, 10))],
@@ -963,25 +3935,30 @@ class TelaVenda:
             [sg.Radio('Listar vendas', "RD1", default=False, key='2', font=('Helvetica', 12), pad=(10, 5))],
             [sg.Radio('Modificar venda', "RD1", default=False, key='3', font=('Helvetica', 12), pad=(10, 5))],
             [sg.Radio('Excluir venda', "RD1", default=False, key='4', font=('Helvetica', 12), pad=(10, 5))],
+            [sg.Radio('Arquivar períodos fechados', "RD1", default=False, key='5', font=('Helvetica', 12), pad=(10, 5))],
             [sg.HorizontalSeparator()],
             [sg.Push(), sg.Button('Confirmar', size=(10,1), button_color=('white', 'green')),
             sg.Button('Cancelar', size=(10,1), button_color=('white', 'firebrick3')), sg.Push()]
         ]
-        self.__window = sg.Window('Sistema de Vendas').Layout(layout)
+        return sg.Window('Sistema de Vendas').Layout(layout)
 
     def close(self):
-        if self.__window:
-            self.__window.Close()
+        self.__janelas.esconder('menu')
         self.__window = None
 
     def mostrar_menu(self):
         botao, opc = self.__window.Read()
         return botao, opc
 
+    @Instrumentacao.dialogo
     def ler_dados(self):
+        botao, values = self.__janelas.ler('cadastro', self.__montar_cadastro)
+        return None if botao == 'Cancelar' else values
+
+    def __montar_cadastro(self):
         layout = [
             [sg.Text('Registrar Nova Venda', font=('Helvetica', 16), expand_x=True, justification='center', pad=(5, 10))],
-            [sg.Text('ID:', size=(19, 1), font=('Helvetica', 12)), 
+            [sg.Text('ID (vazio = automático):', size=(19, 1), font=('Helvetica', 12)), 
             sg.InputText(key='id', font=('Helvetica', 12), size=(30, 1))],
             [sg.Text('Data (AAAA-MM-DD):', size=(19, 1), font=('Helvetica', 12)), 
             sg.InputText(key='data', font=('Helvetica', 12), size=(30, 1))],
@@ -998,13 +3975,9 @@ class TelaVenda:
             sg.Button('Cancelar', size=(12, 1), button_color=('white', 'firebrick3')), 
             sg.Push()]
         ]
+        return sg.Window('Registrar Venda', layout)
 
-
-        window = sg.Window('Registrar Venda', layout)
-        botao, values = window.read()
-        window.close()
-        return None if botao == 'Cancelar' else values
-
+    @Instrumentacao.dialogo
     def mostrar_vendas(self, lista_vendas):
         texto = "=== Lista de Vendas ===\n\n"
         for info in lista_vendas:
@@ -1013,73 +3986,138 @@ class TelaVenda:
                       f"Quantidade: {info['quantidade']} | Total: R${info['total']:.2f} | "
                       f"Status: {info['pagamento_afiliado']}\n")
 
+        self.__janelas.ler('lista', self.__montar_lista, {'texto': texto})
+
+    def __montar_lista(self):
         layout = [
-            [sg.Multiline(texto, size=(100, len(lista_vendas) + 6), disabled=True)],
+            [sg.Multiline('', size=(100, 25), disabled=True, key='texto')],
             [sg.Button("Fechar")]
         ]
+        return sg.Window("Vendas Registradas", layout)
+
+    @Instrumentacao.dialogo
+    def selecionar_venda(self, titulo: str, buscar=None):
+        botao, values = self.__janelas.selecionar('selecionar', self.__montar_selecao, titulo, buscar,
+                                                  self.__descrever, 'id')
+        return None if botao == 'Cancelar' else values['id']
 
-        window = sg.Window("Vendas Registradas", layout)
-        window.read()
-        window.close()
+    @staticmethod
+    def __descrever(venda):
+        return (f"{venda['id']} | {venda['data']} | Afiliado: {venda['afiliado']} | Produto: {venda['produto']} | "
+                f"Qtd: {venda['quantidade']} | R${venda['total']:.2f} | {venda['pagamento_afiliado']}")
 
-    def selecionar_venda(self, titulo: str):
+    def __montar_selecao(self):
         layout = [
-            [sg.Text(titulo)],
+            [sg.Text('', key='titulo', size=(45, 1))],
+            [sg.Text('Buscar:'), sg.InputText(key='busca', enable_events=True)],
+            [sg.Listbox([], size=(100, 10), key='resultados', enable_events=True)],
             [sg.Text('ID da Venda:'), sg.InputText(key='id')],
             [sg.Submit('Confirmar'), sg.Cancel('Cancelar')]
         ]
-        window = sg.Window('Selecionar Venda', layout)
-        botao, values = window.read()
-        window.close()
-        return None if botao == 'Cancelar' else values['id']
+        return sg.Window('Selecionar Venda', layout)
 
+    @Instrumentacao.dialogo
     def modificar_dados(self, venda_data):
+        botao, values = self.__janelas.ler('modificar', self.__montar_modificacao, {
+            'id_atual': str(venda_data['id']),
+            'data': venda_data['data'],
+            'afiliado_id': str(venda_data['afiliado_id']),
+            'produto_codigo': venda_data['produto_codigo'],
+            'quantidade': str(venda_data['quantidade'])
+        })
+        return None if botao == 'Cancelar' else values
+
+    def __montar_modificacao(self):
         layout = [
             [sg.Text('Modificar Venda', font=('Helvetica', 16), expand_x=True, justification='center', pad=(5, 10))],
-            [sg.Text('ID:', size=(22, 1), font=('Helvetica', 12)), sg.Text(str(venda_data['id']), key='id_atual', font=('Helvetica', 12))],
-            [sg.Text('Nova Data (AAAA-MM-DD):', size=(22, 1), font=('Helvetica', 12)), sg.InputText(venda_data['data'], key='data', font=('Helvetica', 12))],
-            [sg.Text('Novo ID Afiliado:', size=(22, 1), font=('Helvetica', 12)), sg.InputText(str(venda_data['afiliado_id']), key='afiliado_id', font=('Helvetica', 12))],
-            [sg.Text('Novo Código Produto:', size=(22, 1), font=('Helvetica', 12)), sg.InputText(venda_data['produto_codigo'], key='produto_codigo', font=('Helvetica', 12))],
-            [sg.Text('Nova Quantidade:', size=(22, 1), font=('Helvetica', 12)), sg.InputText(str(venda_data['quantidade']), key='quantidade', font=('Helvetica', 12))],
+            [sg.Text('ID:', size=(22, 1), font=('Helvetica', 12)), sg.Text('', key='id_atual', size=(30, 1), font=('Helvetica', 12))],
+            [sg.Text('Nova Data (AAAA-MM-DD):', size=(22, 1), font=('Helvetica', 12)), sg.InputText(key='data', font=('Helvetica', 12))],
+            [sg.Text('Novo ID Afiliado:', size=(22, 1), font=('Helvetica', 12)), sg.InputText(key='afiliado_id', font=('Helvetica', 12))],
+            [sg.Text('Novo Código Produto:', size=(22, 1), font=('Helvetica', 12)), sg.InputText(key='produto_codigo', font=('Helvetica', 12))],
+            [sg.Text('Nova Quantidade:', size=(22, 1), font=('Helvetica', 12)), sg.InputText(key='quantidade', font=('Helvetica', 12))],
             [sg.HorizontalSeparator(pad=(5, 15))],
             [sg.Push(), 
             sg.Button('Confirmar', size=(12, 1), button_color=('white', 'green')), 
             sg.Button('Cancelar', size=(12, 1), button_color=('white', 'firebrick3')), 
             sg.Push()]
         ]
+        return sg.Window('Modificar Venda', layout)
 
-        window = sg.Window('Modificar Venda', layout)
-        botao, values = window.read()
-        window.close()
-        return None if botao == 'Cancelar' else values
-
+    @Instrumentacao.dialogo
     def confirmar_exclusao(self, venda_data):
+        botao, _ = self.__janelas.ler('excluir', self.__montar_exclusao, {
+            'id': f'ID: {venda_data["id"]}',
+            'produto': f'Produto: {venda_data["produto"]}',
+            'quantidade': f'Quantidade: {venda_data["quantidade"]}'
+        })
+        return botao == 'Confirmar'
+
+    def __montar_exclusao(self):
         layout = [
             [sg.Text(f'Confirmar exclusão da venda?')],
-            [sg.Text(f'ID: {venda_data["id"]}')],
-            [sg.Text(f'Produto: {venda_data["produto"]}')],
-            [sg.Text(f'Quantidade: {venda_data["quantidade"]}')],
+            [sg.Text('', key='id', size=(40, 1))],
+            [sg.Text('', key='produto', size=(40, 1))],
+            [sg.Text('', key='quantidade', size=(40, 1))],
             [sg.Submit('Confirmar'), sg.Cancel('Cancelar')]
         ]
-        window = sg.Window('Confirmar Exclusão', layout)
-        botao, _ = window.read()
-        window.close()
+        return sg.Window('Confirmar Exclusão', layout)
+
+    @Instrumentacao.dialogo
+    def confirmar_arquivamento(self, periodos, quantidade):
+        botao, _ = self.__janelas.ler('arquivar', self.__montar_arquivamento, {
+            'periodos': f'Períodos: {", ".join(periodos)}',
+            'quantidade': f'Vendas a arquivar: {quantidade}'
+        })
         return botao == 'Confirmar'
 
+    def __montar_arquivamento(self):
+        layout = [
+            [sg.Text('Confirmar arquivamento dos períodos fechados?')],
+            [sg.Text('', key='periodos', size=(60, 2))],
+            [sg.Text('', key='quantidade', size=(60, 1))],
+            [sg.Submit('Confirmar'), sg.Cancel('Cancelar')]
+        ]
+        return sg.Window('Confirmar Arquivamento', layout)
+
+    @Instrumentacao.dialogo
     def mostrar_mensagem_popup(self, mensagem):
         sg.popup(mensagem)
 
 class ControllerVenda:
+    RESULTADOS_BUSCA = 50
+
     def __init__(self, tela, controller_afiliado, controller_produto):
         self.__tela = tela
         self.__controller_afiliado = controller_afiliado
         self.__controller_produto = controller_produto
-        self.__venda_DAO = VendaDAO()
+        # As vendas referenciam afiliados e produtos: os três DAOs ficam no mesmo resolvedor.
+        resolvedor = controller_afiliado.afiliado_DAO.resolvedor
+        if controller_produto.produto_DAO.resolvedor is not resolvedor:
+            resolvedor.registrar(controller_produto.produto_DAO)
+        self.__venda_DAO = VendaDAO(escrita_assincrona=True, concorrente=True, resolvedor=resolvedor)
+        self.__arquivo_vendas = ArquivoVendas()
+        self.__concluir_arquivamento()
 
     @property
     def venda_DAO(self):
         return self.__venda_DAO
 
+    @property
+    def controller_afiliado(self):
+        return self.__controller_afiliado
+
+    @property
+    def controller_produto(self):
+        return self.__controller_produto
+
+    @property
+    def arquivo_vendas(self):
+        return self.__arquivo_vendas
+
+    def buscar(self, texto):
+        return self.__venda_DAO.buscar(texto, self.RESULTADOS_BUSCA,
+                                       ('id', 'data', 'afiliado', 'produto', 'quantidade', 'total', 'pagamento_afiliado'))
+
     def executar(self):
         self.__tela.init_components()
         while True:
@@ -1094,6 +4132,8 @@ class ControllerVenda:
                     self.__modificar()
                 elif opc['4'] == True:
                     self.__excluir()
+                elif opc['5'] == True:
+                    self.__arquivar()
                 else:
                     self.__tela.mostrar_mensagem_popup("Opção inválida!")
                 self.__tela.init_components()
@@ -1101,6 +4141,7 @@ class ControllerVenda:
                 self.__tela.close()
                 break
 
+    @Instrumentacao.instrumentar('venda.cadastrar')
     def __cadastrar(self):
         while True:
             try:
@@ -1109,10 +4150,11 @@ class ControllerVenda:
                 if dados is None:
                     break
 
-                id = dados['id']
+                id = dados['id'].strip()
                 data = dados['data']
                 try:
-                    id = int(dados['id'])
+                    # Sem id informado, a venda recebe o próximo da sequência.
+                    id = int(id) if id else None
                 except ValueError:
                     raise DadoInvalidoException("Id", dados['id'], "Id deve ser um inteiro!")
                 try:
@@ -1130,34 +4172,33 @@ class ControllerVenda:
                 except Exception:
                     raise Exception("Id de afiliado, código de produto e quantidade devem ser inteiros!")
 
-                if self.__venda_DAO.get(id):
+                if id is not None and (self.__venda_DAO.get(id) or self.__arquivo_vendas.contem(id)):
                     raise DadoInvalidoException("ID", id, "ID já existe")
 
-                afiliado = None
-                for a in self.__controller_afiliado.afiliado_DAO.get_all():
-                    if a.id == afiliado_id:
-                        afiliado = a
-                        break
+                afiliado = self.__controller_afiliado.afiliado_DAO.get(afiliado_id)
                 if afiliado is None:
                     raise EntidadeNaoEncontradaException("Afiliado", afiliado_id)
 
-                produto = None
-                for p in self.__controller_produto.produto_DAO.get_all():
-                    if p.codigo == produto_codigo:
-                        produto = p
-                        break
+                produto = self.__controller_produto.produto_DAO.get(produto_codigo)
                 if produto is None:
                     raise EntidadeNaoEncontradaException("Produto", produto_codigo)
 
+                if id is None:
+                    id = self.__venda_DAO.proximo_id()
+                    # Vendas arquivadas antes da sequência existir podem ter ids à frente dela.
+                    while self.__arquivo_vendas.contem(id):
+                        id = self.__venda_DAO.proximo_id()
+
                 venda = Venda(id, data, afiliado, produto, quantidade)
-                afiliado.vendas.append(venda)
                 self.__venda_DAO.add(venda)
 
-                self.__tela.mostrar_mensagem_popup("Venda registrada com sucesso!")
+                self.__tela.mostrar_mensagem_popup(f"Venda {id} registrada com sucesso!")
                 break
             except Exception as e:
+                Instrumentacao.falha()
                 self.__tela.mostrar_mensagem_popup(f"Erro ao registrar venda: {e}")
 
+    @Instrumentacao.instrumentar('venda.listar')
     def __listar(self):
         vendas = self.__venda_DAO.get_all()
         if not vendas:
@@ -1177,9 +4218,10 @@ class ControllerVenda:
                 lista_vendas.append(info)
             self.__tela.mostrar_vendas(lista_vendas)
 
+    @Instrumentacao.instrumentar('venda.modificar')
     def __modificar(self):
         try:
-            id = self.__tela.selecionar_venda("Digite o ID da venda para modificar")
+            id = self.__tela.selecionar_venda("Busque ou digite o ID da venda para modificar", self.buscar)
             if not id: 
                 return
 
@@ -1221,32 +4263,32 @@ class ControllerVenda:
             except Exception:
                 raise Exception("Id de afiliado, código de produto e quantidade devem ser inteiros!")
             
-            novo_afiliado = next((a for a in self.__controller_afiliado.afiliado_DAO.get_all() if a.id == novo_afiliado_id), None)
+            novo_afiliado = self.__controller_afiliado.afiliado_DAO.get(novo_afiliado_id)
             if not novo_afiliado:
                 raise EntidadeNaoEncontradaException("Afiliado", novo_afiliado_id)
 
-            novo_produto = next((p for p in self.__controller_produto.produto_DAO.get_all() if p.codigo == novo_produto_codigo), None)
+            novo_produto = self.__controller_produto.produto_DAO.get(novo_produto_codigo)
             if not novo_produto:
                 raise EntidadeNaoEncontradaException("Produto", novo_produto_codigo)
 
             venda.data = nova_data
-            venda.afiliado.vendas.remove(venda)
             venda.afiliado = novo_afiliado
             venda.produto = novo_produto
             venda.quantidade = nova_quantidade
             venda.calcularTotal()
             venda.pagamento_afiliado = 'não realizado'
             
-            novo_afiliado.vendas.append(venda)
             self.__venda_DAO.update(venda)
             self.__tela.mostrar_mensagem_popup("Venda modificada com sucesso!")
             
         except Exception as e:
+            Instrumentacao.falha()
             self.__tela.mostrar_mensagem_popup(f"Erro ao modificar venda: {e}")
 
+    @Instrumentacao.instrumentar('venda.excluir')
     def __excluir(self):
         try:
-            id = self.__tela.selecionar_venda("Digite o ID da venda para excluir")
+            id = self.__tela.selecionar_venda("Busque ou digite o ID da venda para excluir", self.buscar)
             if not id: 
                 return
                 
@@ -1273,14 +4315,64 @@ class ControllerVenda:
             if not self.__tela.confirmar_exclusao(venda_data):
                 return
 
-            venda.afiliado.vendas.remove(venda)
             self.__venda_DAO.remove(id)
             
             self.__tela.mostrar_mensagem_popup("Venda excluída com sucesso!")
             
         except Exception as e:
+            Instrumentacao.falha()
             self.__tela.mostrar_mensagem_popup(f"Erro ao excluir venda: {e}")
 
+    @Instrumentacao.instrumentar('venda.arquivar')
+    def __arquivar(self):
+        try:
+            mes_atual = date.today().replace(day=1)
+            periodos = {}
+            for venda in self.__venda_DAO.consultar({'data': Intervalo(fim=mes_atual - timedelta(days=1))},
+                                                    campos=('id', 'data', 'pagamento_afiliado')):
+                periodos.setdefault(venda['data'].replace(day=1), []).append(venda)
+
+            fechados = sorted(
+                periodo for periodo, vendas in periodos.items()
+                if all(v['pagamento_afiliado'] == 'realizado' for v in vendas)
+            )
+            if not fechados:
+                raise ViolacaoRegraNegocioException("Nenhum período fechado para arquivar")
+
+            vendas = self.__venda_DAO.consultar({'id': {v['id'] for periodo in fechados for v in periodos[periodo]}})
+            nomes = [periodo.strftime('%Y-%m') for periodo in fechados]
+            if not self.__tela.confirmar_arquivamento(nomes, len(vendas)):
+                return
+
+            # Outra estação pode ter arquivado parte delas enquanto a confirmação estava aberta.
+            with self.__arquivo_vendas.travar():
+                arquivadas = self.__arquivo_vendas.arquivar(vendas)
+                self.__remover_arquivadas(vendas)
+
+            self.__tela.mostrar_mensagem_popup(f"{len(arquivadas)} vendas arquivadas com sucesso!")
+
+        except Exception as e:
+            Instrumentacao.falha()
+            self.__tela.mostrar_mensagem_popup(f"Erro ao arquivar vendas: {e}")
+
+    def __remover_arquivadas(self, vendas):
+        with self.__venda_DAO.agrupar_escritas():
+            for venda in vendas:
+                self.__venda_DAO.remove(venda.id)
+        self.__venda_DAO.flush()
+        self.__arquivo_vendas.concluir()
+
+    def __concluir_arquivamento(self):
+        # Arquivamento interrompido entre anexar ao arquivo e remover do DAO: as vendas
+        # que já estão no arquivo saem agora; as que não chegaram a ele continuam no DAO.
+        with self.__arquivo_vendas.travar():
+            ids = self.__arquivo_vendas.pendentes()
+            vendas = self.__venda_DAO.consultar({'id': set(ids)}) if ids else []
+            if vendas:
+                self.__remover_arquivadas(vendas)
+            else:
+                self.__arquivo_vendas.concluir()
+
 class Comissao:
     def __init__(self, vendedor, recebedor, venda, tipo, valor):
         if not isinstance(vendedor, Afiliado):
@@ -1377,9 +4469,34 @@ class Pagamento:
             raise TypeError("valorPago deve ser numérico")
         self.__valorPago = float(value)
 
+    def __getstate__(self):
+        return (self.__id, self.__data, self.__afiliado, self.__valorPago)
+
+    def __setstate__(self, estado):
+        if isinstance(estado, dict):
+            self.__dict__.update(estado)
+        else:
+            self.__id, self.__data, self.__afiliado, self.__valorPago = estado
+
 class PagamentoDAO(DAO):
-    def __init__(self):
-        super().__init__('pagamento.pkl')
+    entidade = Pagamento
+    campos = 'qiqd'
+    colunas = ('id', 'data', 'afiliado', 'valorPago')
+    indices = ('data', 'afiliado')
+    conversoes = {'data': (date.toordinal, date.fromordinal)}
+    sequencial = True
+
+    def __init__(self, escrita_assincrona=False, concorrente=False, codec=None, limite_cache=None,
+                 resolvedor=None):
+        super().__init__('pagamento.pkl', escrita_assincrona, concorrente, codec, limite_cache, resolvedor)
+
+    @staticmethod
+    def para_registro(pagamento):
+        return (pagamento.id, pagamento.data.toordinal(), pagamento.afiliado.id, pagamento.valorPago)
+
+    def de_registro(self, pagamento, registro):
+        id, data, afiliado, valorPago = registro
+        pagamento.__setstate__((id, date.fromordinal(data), self.resolver(Afiliado, afiliado), valorPago))
     
     def add(self, pagamento: Pagamento):
         if((pagamento is not None) and isinstance(pagamento, Pagamento) and isinstance(pagamento.id, int)):
@@ -1397,11 +4514,127 @@ class PagamentoDAO(DAO):
         if(isinstance(key, int)):
             return super().remove(key)
 
+class SaldoAfiliado:
+    # Resumo financeiro de um afiliado, mantido a cada geração de comissões e
+    # processamento de pagamentos para ser consultado sem somar o histórico.
+    def __init__(self, afiliado_id, pendente=0.0, pago=0.0, ultimo_pagamento=None, valor_ultimo_pagamento=0.0):
+        if not isinstance(afiliado_id, int):
+            raise TypeError("afiliado_id deve ser int")
+        if not isinstance(pendente, (int, float)):
+            raise TypeError("pendente deve ser numérico")
+        if not isinstance(pago, (int, float)):
+            raise TypeError("pago deve ser numérico")
+        if ultimo_pagamento is not None and not isinstance(ultimo_pagamento, date):
+            raise TypeError("ultimo_pagamento deve ser do tipo date ou None")
+        if not isinstance(valor_ultimo_pagamento, (int, float)):
+            raise TypeError("valor_ultimo_pagamento deve ser numérico")
+        self.__afiliado_id = afiliado_id
+        self.__pendente = float(pendente)
+        self.__pago = float(pago)
+        self.__ultimo_pagamento = ultimo_pagamento
+        self.__valor_ultimo_pagamento = float(valor_ultimo_pagamento)
+
+    @property
+    def afiliado_id(self):
+        return self.__afiliado_id
+
+    @property
+    def pendente(self):
+        return self.__pendente
+
+    @pendente.setter
+    def pendente(self, value):
+        if not isinstance(value, (int, float)):
+            raise TypeError("pendente deve ser numérico")
+        self.__pendente = float(value)
+
+    @property
+    def pago(self):
+        return self.__pago
+
+    @pago.setter
+    def pago(self, value):
+        if not isinstance(value, (int, float)):
+            raise TypeError("pago deve ser numérico")
+        self.__pago = float(value)
+
+    @property
+    def ultimo_pagamento(self):
+        return self.__ultimo_pagamento
+
+    @property
+    def valor_ultimo_pagamento(self):
+        return self.__valor_ultimo_pagamento
+
+    def creditar(self, valor):
+        self.__pendente += valor
+
+    def registrar_pagamento(self, data, valor):
+        # Arredondado para não acumular resíduos de ponto flutuante no pendente.
+        self.__pendente = max(0.0, round(self.__pendente - valor, 6))
+        self.__pago += valor
+        if self.__ultimo_pagamento is None or data >= self.__ultimo_pagamento:
+            if data == self.__ultimo_pagamento:
+                self.__valor_ultimo_pagamento += valor
+            else:
+                self.__valor_ultimo_pagamento = float(valor)
+            self.__ultimo_pagamento = data
+
+    def __getstate__(self):
+        return (self.__afiliado_id, self.__pendente, self.__pago, self.__ultimo_pagamento,
+                self.__valor_ultimo_pagamento)
+
+    def __setstate__(self, estado):
+        (self.__afiliado_id, self.__pendente, self.__pago, self.__ultimo_pagamento,
+         self.__valor_ultimo_pagamento) = estado
+
+class SaldoAfiliadoDAO(DAO):
+    entidade = SaldoAfiliado
+    campos = 'qddnd'
+    colunas = ('afiliado', 'pendente', 'pago', 'ultimo_pagamento', 'valor_ultimo_pagamento')
+    conversoes = {'ultimo_pagamento': (date.toordinal, date.fromordinal)}
+
+    def __init__(self, escrita_assincrona=False, concorrente=False, codec=None, limite_cache=None,
+                 resolvedor=None):
+        super().__init__('saldo_afiliado.pkl', escrita_assincrona, concorrente, codec, limite_cache, resolvedor)
+
+    @staticmethod
+    def para_registro(saldo):
+        ultimo = saldo.ultimo_pagamento.toordinal() if saldo.ultimo_pagamento is not None else None
+        return (saldo.afiliado_id, saldo.pendente, saldo.pago, ultimo, saldo.valor_ultimo_pagamento)
+
+    @staticmethod
+    def de_registro(saldo, registro):
+        afiliado_id, pendente, pago, ultimo, valor_ultimo = registro
+        saldo.__setstate__((afiliado_id, pendente, pago, date.fromordinal(ultimo) if ultimo is not None else None,
+                            valor_ultimo))
+
+    def add(self, saldo: SaldoAfiliado):
+        if((saldo is not None) and isinstance(saldo, SaldoAfiliado)):
+            super().add(saldo.afiliado_id, saldo)
+
+    def update(self, saldo: SaldoAfiliado):
+        if((saldo is not None) and isinstance(saldo, SaldoAfiliado)):
+            super().update(saldo.afiliado_id, saldo)
+
+    def get(self, key:int):
+        if isinstance(key, int):
+            return super().get(key)
+
+    def remove(self, key:int):
+        if(isinstance(key, int)):
+            return super().remove(key)
+
 class TelaPagamento:
     def __init__(self):
         self.__window = None
+        self.__janelas = Janelas()
+        self.__progresso = TelaProgresso()
 
     def init_components(self):
+        self.__window = self.__janelas.abrir('menu', self.__montar_menu)
+
+    def __montar_menu(self):
         sg.ChangeLookAndFeel('DarkBlue14')
         layout = [
             [sg.Text('Escolha uma opção', font=('Helvetica', 14), expand_x=True, justification='center', pad=(5, 10))],
@@ -1409,15 +4642,15 @@ class TelaPagamento:
             [sg.Radio('Listar Comissões', "RD1", default=False, key='2', font=('Helvetica', 12), pad=(10, 5))],
             [sg.Radio('Processar Pagamento das Comissões', "RD1", default=False, key='3', font=('Helvetica', 12), pad=(10, 5))],
             [sg.Radio('Listar Pagamentos Efetuados', "RD1", default=False, key='4', font=('Helvetica', 12), pad=(10, 5))],
+            [sg.Radio('Consultar Saldo de Afiliado', "RD1", default=False, key='5', font=('Helvetica', 12), pad=(10, 5))],
             [sg.HorizontalSeparator()],
             [sg.Push(), sg.Button('Confirmar', size=(10,1), button_color=('white', 'green')),
             sg.Button('Cancelar', size=(10,1), button_color=('white', 'firebrick3')), sg.Push()]
         ]
-        self.__window = sg.Window('Menu Pagamento').Layout(layout)
+        return sg.Window('Menu Pagamento').Layout(layout)
 
     def close(self):
-        if self.__window:
-            self.__window.Close()
+        self.__janelas.esconder('menu')
         self.__window = None
 
     def mostrar_menu(self):
@@ -1450,42 +4683,80 @@ class TelaPagamento:
         
         return id, data, afiliado_id, valorPago
 
+    @Instrumentacao.dialogo
     def mostrar_comissao(self, lista_comissoes):
         texto = "=== Lista de Comissões ===\n\n"
         for info in lista_comissoes:
             texto += f"Recebedor: {info['recebedor']} | Valor: R${info['valor']:.2f} | Venda: {info['venda']} | Tipo: {info['tipo']} | Vendedor: {info['vendedor']}\n"
 
+        self.__janelas.ler('comissoes', self.__montar_comissoes, {'texto': texto})
+
+    def __montar_comissoes(self):
         layout = [
-            [sg.Multiline(texto, size=(60, len(lista_comissoes) + 6), disabled=True)],
+            [sg.Multiline('', size=(60, 25), disabled=True, key='texto')],
             [sg.Button("Fechar")]
         ]
+        return sg.Window("Lista de Comissões", layout)
 
-        window = sg.Window("Lista de Comissões", layout)
-        window.read()
-        window.close()
-
+    @Instrumentacao.dialogo
     def mostrar_pagamento(self, lista_pagamentos):
         texto = "=== Lista de Pagamentos ===\n\n"
         for info in lista_pagamentos:
             texto += f"ID Pagamento: {info['id']} | Data: {info['data']} | Afiliado: {info['afiliado']} | Valor Pago: R${info['valorPago']:.2f}\n"
 
+        self.__janelas.ler('pagamentos', self.__montar_pagamentos, {'texto': texto})
+
+    def __montar_pagamentos(self):
         layout = [
-            [sg.Multiline(texto, size=(70, len(lista_pagamentos) + 6), disabled=True)],
+            [sg.Multiline('', size=(70, 25), disabled=True, key='texto')],
             [sg.Button("Fechar")]
         ]
-
-        window = sg.Window("Lista de Pagamentos", layout)
-        window.read()
-        window.close()
+        return sg.Window("Lista de Pagamentos", layout)
+
+    @Instrumentacao.dialogo
+    def ler_afiliado_saldo(self):
+        return sg.popup_get_text('ID do afiliado:', title='Saldo do Afiliado')
+
+    @Instrumentacao.dialogo
+    def mostrar_saldo(self, info):
+        self.__janelas.ler('saldo', self.__montar_saldo, {
+            'afiliado': f"Afiliado: {info['afiliado']}",
+            'pendente': f"R${info['pendente']:.2f}",
+            'pago': f"R${info['pago']:.2f}",
+            'ultimo': f"{info['ultimo_pagamento']} (R${info['valor_ultimo_pagamento']:.2f})"
+                      if info['ultimo_pagamento'] else "Nenhum"
+        })
+
+    def __montar_saldo(self):
+        layout = [
+            [sg.Text('', key='afiliado', size=(40, 1), font=('Helvetica', 14))],
+            [sg.HorizontalSeparator()],
+            [sg.Text('Comissões pendentes:', size=(22, 1)), sg.Text('', key='pendente', size=(25, 1))],
+            [sg.Text('Total pago:', size=(22, 1)), sg.Text('', key='pago', size=(25, 1))],
+            [sg.Text('Último pagamento:', size=(22, 1)), sg.Text('', key='ultimo', size=(25, 1))],
+            [sg.Push(), sg.Button("Fechar"), sg.Push()]
+        ]
+        return sg.Window("Saldo do Afiliado", layout)
  
+    def acompanhar(self, titulo, operacao):
+        return self.__progresso.acompanhar(titulo, operacao)
+
+    @Instrumentacao.dialogo
     def popup(self, mensagem):
         sg.popup(mensagem)
 class ControllerPagamento:
+    COMISSAO_DIRETA = 0.05
+    COMISSAO_INDIRETA = 0.01
+
     def __init__(self, tela, controller_venda):
         self.__tela = tela
         self.__controller_venda = controller_venda
-        self.__pagamento_DAO = PagamentoDAO()
+        resolvedor = controller_venda.venda_DAO.resolvedor
+        self.__pagamento_DAO = PagamentoDAO(escrita_assincrona=True, concorrente=True, resolvedor=resolvedor)
+        self.__saldo_DAO = SaldoAfiliadoDAO(escrita_assincrona=True, concorrente=True, resolvedor=resolvedor)
         self.__listaComissoes = []
+        if not self.__saldo_DAO.consultar(limite=1, campos=('afiliado',)):
+            self.__recalcular_saldos()
 
     @property
     def listaComissoes(self):
@@ -1504,6 +4775,10 @@ class ControllerPagamento:
     def pagamento_DAO(self):
         return self.__pagamento_DAO
 
+    @property
+    def saldo_DAO(self):
+        return self.__saldo_DAO
+
     @pagamento_DAO.setter
     def pagamento_DAO(self, pagamento_DAO):
         if not isinstance(pagamento_DAO, PagamentoDAO):
@@ -1527,6 +4802,8 @@ class ControllerPagamento:
                     self.__processar_pagamentos()
                 elif opc['4'] == True:
                     self.__listar_pagamentos()
+                elif opc['5'] == True:
+                    self.__consultar_saldo()
                 else:
                     self.__tela.opcao_invalida()
                 self.__tela.init_components()
@@ -1534,34 +4811,125 @@ class ControllerPagamento:
                 self.__tela.close()
                 break
 
+    @Instrumentacao.instrumentar('pagamento.gerar_comissoes')
     def __gerar_comissoes(self):
-        self.__listaComissoes.clear()
-        venda_dao = self.__controller_venda.venda_DAO
-        
-        for venda in venda_dao.get_all():
-            if venda.pagamento_afiliado == 'realizado':
-                continue
-
-            total = venda.total
-            afiliado = venda.afiliado
-            afiliado_parent = afiliado.parent
-
-            comissao_direta = total * 0.05
-            comissao_indireta = total * 0.01 if afiliado_parent is not None else 0
+        try:
+            self.__tela.acompanhar("Gerando comissões", self.__calcular_comissoes)
+        except OperacaoCanceladaException:
+            self.__tela.popup("Geração de comissões cancelada; nada foi alterado.")
+            return
+        self.__tela.popup("Comissões geradas com sucesso!")
 
-            if afiliado_parent:
-                comissao_parent = Comissao(afiliado, afiliado_parent,
-                                           venda, 'indireto', comissao_indireta)
-                self.__listaComissoes.append(comissao_parent)
-            
-            comissao = Comissao(afiliado, afiliado, venda, 'direto', comissao_direta)
-            self.__listaComissoes.append(comissao)
+    def __calcular_comissoes(self, progresso):
+        venda_dao = self.__controller_venda.venda_DAO
+        # A lista nova só substitui a atual no fim: cancelar no meio não perde nada.
+        lista = []
+        creditos = {}
+        # Sem partições em outros processos: as comissões precisam das próprias vendas
+        # (que são alteradas logo abaixo), e o cálculo em si é só uma multiplicação.
+        progresso.etapa("Selecionando vendas")
+        vendas = venda_dao.consultar({'pagamento_afiliado': {'não realizado', 'aguardando confirmação'}})
+        for posicao, venda in enumerate(vendas, 1):
+            progresso.avancar(posicao, len(vendas), "Calculando comissões")
+            comissoes = self.__comissoes(venda)
+            lista.extend(comissoes)
+            # Vendas já aguardando confirmação tiveram a comissão creditada antes.
+            if venda.pagamento_afiliado == 'não realizado':
+                for c in comissoes:
+                    creditos[c.recebedor.id] = creditos.get(c.recebedor.id, 0.0) + c.valor
+
+        progresso.etapa("Gravando comissões", cancelavel=False)
+        with venda_dao.agrupar_escritas():
+            for posicao, c in enumerate(lista, 1):
+                progresso.avancar(posicao, len(lista), "Gravando comissões")
+                c.venda.pagamento_afiliado = 'aguardando confirmação'
+                venda_dao.update(c.venda)
+        self.__atualizar_saldos(creditos, {})
+        self.__listaComissoes[:] = lista
+
+    @staticmethod
+    def __comissoes(venda):
+        total = venda.total
+        afiliado = venda.afiliado
+        afiliado_parent = afiliado.parent
+
+        comissao_direta = total * ControllerPagamento.COMISSAO_DIRETA
+        comissao_indireta = total * ControllerPagamento.COMISSAO_INDIRETA if afiliado_parent is not None else 0
+
+        comissoes = []
+        if afiliado_parent:
+            comissoes.append(Comissao(afiliado, afiliado_parent, venda, 'indireto', comissao_indireta))
+        comissoes.append(Comissao(afiliado, afiliado, venda, 'direto', comissao_direta))
+        return comissoes
+
+    def __atualizar_saldos(self, creditos, pagamentos, data=None):
+        # Créditos e pagamentos entram como diferenças sobre o saldo gravado mais recente,
+        # na mesma transação: outro processo atualizando o mesmo afiliado não perde a sua.
+        with self.__saldo_DAO.transacao():
+            for afiliado_id in creditos.keys() | pagamentos.keys():
+                saldo = self.__saldo_DAO.get(afiliado_id)
+                novo = saldo is None
+                if novo:
+                    saldo = SaldoAfiliado(afiliado_id)
+                saldo.creditar(creditos.get(afiliado_id, 0.0))
+                if afiliado_id in pagamentos:
+                    saldo.registrar_pagamento(data, pagamentos[afiliado_id])
+                if novo:
+                    self.__saldo_DAO.add(saldo)
+                else:
+                    self.__saldo_DAO.update(saldo)
 
-        for c in self.__listaComissoes:
-            c.venda.pagamento_afiliado = 'aguardando confirmação'
-            venda_dao.update(c.venda)
-        self.__tela.popup("Comissões geradas com sucesso!")
+    def __recalcular_saldos(self):
+        # Monta o livro de saldos a partir do histórico (dados anteriores ao livro). Tudo
+        # acontece na transação: se outro processo montou o livro antes, nada é refeito.
+        with self.__saldo_DAO.transacao():
+            if self.__saldo_DAO.consultar(limite=1, campos=('afiliado',)):
+                return
+            creditos = {}
+            venda_dao = self.__controller_venda.venda_DAO
+            for venda in venda_dao.consultar({'pagamento_afiliado': 'aguardando confirmação'}):
+                for c in self.__comissoes(venda):
+                    creditos[c.recebedor.id] = creditos.get(c.recebedor.id, 0.0) + c.valor
+            saldos = {}
+            for pagamento in self.__pagamento_DAO.consultar(ordem=('data', 'id'),
+                                                            campos=('data', 'afiliado', 'valorPago')):
+                saldo = saldos.setdefault(pagamento['afiliado'], SaldoAfiliado(pagamento['afiliado']))
+                saldo.registrar_pagamento(pagamento['data'], pagamento['valorPago'])
+            for afiliado_id, valor in creditos.items():
+                saldos.setdefault(afiliado_id, SaldoAfiliado(afiliado_id)).creditar(valor)
+            for saldo in saldos.values():
+                self.__saldo_DAO.add(saldo)
+
+    def saldo(self, afiliado_id: int):
+        saldo = self.__saldo_DAO.get(afiliado_id)
+        return saldo if saldo is not None else SaldoAfiliado(afiliado_id)
+
+    @Instrumentacao.instrumentar('pagamento.consultar_saldo')
+    def __consultar_saldo(self):
+        try:
+            id_str = self.__tela.ler_afiliado_saldo()
+            if not id_str:
+                return
+            try:
+                afiliado_id = int(id_str)
+            except ValueError:
+                raise DadoInvalidoException("ID Afiliado", id_str, "Deve ser um número inteiro")
+            afiliado = self.__controller_venda.controller_afiliado.afiliado_DAO.get(afiliado_id)
+            if afiliado is None:
+                raise EntidadeNaoEncontradaException("Afiliado", afiliado_id)
+            saldo = self.saldo(afiliado_id)
+            self.__tela.mostrar_saldo({
+                'afiliado': f"{afiliado.nome} (ID: {afiliado.id})",
+                'pendente': saldo.pendente,
+                'pago': saldo.pago,
+                'ultimo_pagamento': saldo.ultimo_pagamento,
+                'valor_ultimo_pagamento': saldo.valor_ultimo_pagamento
+            })
+        except Exception as e:
+            Instrumentacao.falha()
+            self.__tela.popup(f"Erro ao consultar saldo: {e}")
 
+    @Instrumentacao.instrumentar('pagamento.listar_comissoes')
     def __listar_comissoes(self):
         if not self.__listaComissoes:
             self.__tela.popup("Nenhuma comissão gerada.")
@@ -1578,25 +4946,48 @@ class ControllerPagamento:
             lista_comissoes.append(info)
         self.__tela.mostrar_comissao(lista_comissoes)
 
+    @Instrumentacao.instrumentar('pagamento.processar_pagamentos')
     def __processar_pagamentos(self):
-        venda_dao = self.__controller_venda.venda_DAO
-        next_id = max((p.id for p in self.__pagamento_DAO.get_all()), default=0) + 1
-        
-        for com in list(self.__listaComissoes):
-            pag = Pagamento(
-                next_id,
-                date.today(),
-                com.recebedor,
-                com.valor
-            )
-            self.__pagamento_DAO.add(pag)
-            com.venda.pagamento_afiliado = 'realizado'
-            venda_dao.update(com.venda)
-            next_id += 1
-
-        self.__listaComissoes.clear()
+        try:
+            self.__tela.acompanhar("Processando pagamentos", self.__pagar_comissoes)
+        except OperacaoCanceladaException:
+            self.__tela.popup("Processamento interrompido; as comissões restantes continuam pendentes.")
+            return
         self.__tela.popup("Pagamentos processados com sucesso!")
 
+    def __pagar_comissoes(self, progresso):
+        venda_dao = self.__controller_venda.venda_DAO
+        hoje = date.today()
+        pagos = {}
+        comissoes = list(self.__listaComissoes)
+        # Um único bloco de ids para todos os pagamentos da rodada.
+        ids = iter(self.__pagamento_DAO.reservar_ids(len(comissoes)) if comissoes else ())
+        processadas = 0
+        anterior = None
+        try:
+            with self.__pagamento_DAO.agrupar_escritas(), venda_dao.agrupar_escritas():
+                for com in comissoes:
+                    # Só para entre vendas: as comissões de uma mesma venda são pagas juntas.
+                    if com.venda is not anterior:
+                        progresso.avancar(processadas, len(comissoes), "Registrando pagamentos")
+                        anterior = com.venda
+                    pag = Pagamento(
+                        next(ids),
+                        hoje,
+                        com.recebedor,
+                        com.valor
+                    )
+                    self.__pagamento_DAO.add(pag)
+                    com.venda.pagamento_afiliado = 'realizado'
+                    venda_dao.update(com.venda)
+                    pagos[com.recebedor.id] = pagos.get(com.recebedor.id, 0.0) + com.valor
+                    processadas += 1
+        finally:
+            # Interrompido ou não, o que foi pago sai da lista e entra no saldo.
+            del self.__listaComissoes[:processadas]
+            self.__atualizar_saldos({}, pagos, hoje)
+
+    @Instrumentacao.instrumentar('pagamento.listar_pagamentos')
     def __listar_pagamentos(self):
         pagamentos = self.__pagamento_DAO.get_all()
         if not pagamentos:
@@ -1642,7 +5033,17 @@ class Relatorio:
             raise TypeError("afiliado deve ser do tipo Afiliado ou None")
         self.__afiliado = value
 
+    def __filtros(self):
+        filtros = {'data': Intervalo(*self.periodo)}
+        if self.afiliado is not None:
+            filtros['afiliado'] = self.afiliado.id
+        return filtros
+
+    # Recebem a lista de entidades ou o próprio DAO; com o DAO, o filtro é feito
+    # pela consulta, usando os índices de data e afiliado.
     def gerarRelatorioVendas(self, vendas):
+        if isinstance(vendas, DAO):
+            return vendas.consultar(self.__filtros(), ordem='id')
         data_inicio, data_fim = self.periodo
         vendas_filtradas = []
         for venda in vendas:
@@ -1652,6 +5053,8 @@ class Relatorio:
         return vendas_filtradas
 
     def gerarRelatorioFinanceiro(self, pagamentos):
+        if isinstance(pagamentos, DAO):
+            return pagamentos.consultar(self.__filtros(), ordem='id')
         data_inicio, data_fim = self.periodo
         pagamentos_filtrados = []
         for pagamento in pagamentos:
@@ -1660,32 +5063,379 @@ class Relatorio:
                     pagamentos_filtrados.append(pagamento)
         return pagamentos_filtrados
 
+class CacheRelatorios:
+    # Guarda o resultado dos relatórios por (tipo, data inicial, data final, afiliado).
+    # Cada resultado só é descartado quando muda uma venda/pagamento que está nele ou
+    # cuja data cai no período, ou o nome de um afiliado/produto que aparece nele.
+    MAXIMO = 64
+
+    def __init__(self, venda_DAO, pagamento_DAO, afiliado_DAO, produto_DAO=None):
+        self.__entradas = OrderedDict()
+        self.__trava = threading.Lock()
+        self.__versao = 0
+        self.__tipos = {venda_DAO: 'vendas', pagamento_DAO: 'financeiro'}
+        for dao in (venda_DAO, pagamento_DAO, afiliado_DAO, produto_DAO):
+            if dao is not None:
+                dao.adicionar_ouvinte(self.__alterado)
+
+    def obter(self, chave):
+        with self.__trava:
+            entrada = self.__entradas.get(chave)
+            if entrada is None:
+                Instrumentacao.contar('relatorio.cache_falhas')
+                return None, self.__versao
+            self.__entradas.move_to_end(chave)
+            Instrumentacao.contar('relatorio.cache_acertos')
+            return list(entrada['linhas']), self.__versao
+
+    def guardar(self, chave, versao, linhas, ids, afiliados, produtos=None):
+        with self.__trava:
+            # Algo mudou enquanto o relatório era gerado: o resultado pode já estar velho.
+            if versao != self.__versao:
+                return
+            self.__entradas[chave] = {'linhas': list(linhas), 'ids': set(ids),
+                                      'afiliados': dict(afiliados), 'produtos': dict(produtos or {})}
+            while len(self.__entradas) > self.MAXIMO:
+                self.__entradas.popitem(last=False)
+
+    def limpar(self):
+        with self.__trava:
+            self.__versao += 1
+            self.__entradas.clear()
+
+    def __alterado(self, dao, chave, valores):
+        tipo = self.__tipos.get(dao)
+        with self.__trava:
+            self.__versao += 1
+            for entrada_chave, entrada in list(self.__entradas.items()):
+                if self.__afeta(tipo, dao, entrada_chave, entrada, chave, valores):
+                    del self.__entradas[entrada_chave]
+
+    @staticmethod
+    def __afeta(tipo, dao, entrada_chave, entrada, chave, valores):
+        tipo_entrada, data_inicial, data_final, afiliado_id = entrada_chave
+        if tipo is None:
+            # Afiliado ou produto: só importa se o nome mostrado no relatório mudou.
+            nomes = entrada['afiliados'] if dao.entidade is Afiliado else entrada['produtos']
+            if chave is None:
+                return bool(nomes)
+            return chave in nomes and (valores is None or valores['nome'] != nomes[chave])
+        if tipo != tipo_entrada:
+            return False
+        if chave is None or chave in entrada['ids']:
+            return True
+        return (valores is not None and data_inicial <= valores['data'] <= data_final
+                and (afiliado_id is None or valores['afiliado'] == afiliado_id))
+
+class RelatorioRede:
+    # Totais de vendas de cada afiliado e de toda a sua rede (descendentes via parent)
+    # num período. A árvore é percorrida uma vez em pós-ordem, somando cada subárvore
+    # no pai. O resultado fica guardado por período e é ajustado pelas mudanças
+    # avisadas pelos DAOs; exclusões e mudanças de parent descartam o que foi guardado.
+    MAXIMO = 16
+
+    def __init__(self, venda_DAO, afiliado_DAO, arquivo_vendas=None):
+        self.__venda_DAO = venda_DAO
+        self.__afiliado_DAO = afiliado_DAO
+        self.__arquivo_vendas = arquivo_vendas
+        self.__periodos = OrderedDict()
+        self.__rede = None
+        self.__trava = threading.Lock()
+        self.__versao = 0
+        venda_DAO.adicionar_ouvinte(self.__venda_alterada)
+        afiliado_DAO.adicionar_ouvinte(self.__afiliado_alterado)
+
+    def calcular(self, data_inicial: date, data_final: date, afiliado_id: int = None, progresso=None):
+        if data_inicial > data_final:
+            raise DadoInvalidoException("Datas", "inicial maior que final")
+        chave = (data_inicial, data_final)
+        with self.__trava:
+            entrada = self.__periodos.get(chave)
+            versao = self.__versao
+            if entrada is not None:
+                self.__periodos.move_to_end(chave)
+                Instrumentacao.contar('relatorio_rede.cache_acertos')
+                return self.__linhas(entrada, afiliado_id)
+        Instrumentacao.contar('relatorio_rede.cache_falhas')
+        entrada = self.__montar(data_inicial, data_final, progresso if progresso is not None else Progresso())
+        with self.__trava:
+            # Algo mudou durante a montagem: devolve o resultado sem guardá-lo.
+            if versao == self.__versao:
+                rede = entrada.pop('rede')
+                if self.__rede is None:
+                    self.__rede = rede
+                self.__periodos[chave] = entrada
+                while len(self.__periodos) > self.MAXIMO:
+                    self.__periodos.popitem(last=False)
+            return self.__linhas(entrada, afiliado_id)
+
+    def limpar(self):
+        with self.__trava:
+            self.__versao += 1
+            self.__periodos.clear()
+            self.__rede = None
+
+    @staticmethod
+    def __linhas(entrada, afiliado_id):
+        linhas = entrada['linhas']
+        if afiliado_id is None:
+            return [dict(linha) for linha in linhas]
+        inicio = entrada['posicoes'].get(afiliado_id)
+        if inicio is None:
+            raise EntidadeNaoEncontradaException("Afiliado", afiliado_id)
+        # Em pré-ordem a rede de um afiliado é o trecho seguinte com nível maior.
+        nivel = linhas[inicio]['nivel']
+        fim = inicio + 1
+        while fim < len(linhas) and linhas[fim]['nivel'] > nivel:
+            fim += 1
+        return [dict(linha) for linha in linhas[inicio:fim]]
+
+    def __montar(self, data_inicial, data_final, progresso):
+        progresso.etapa("Lendo a rede de afiliados")
+        rede = {linha['id']: (linha['nome'], linha['parent'])
+                for linha in self.__afiliado_DAO.consultar(campos=('id', 'nome', 'parent'))}
+        proprias = {}
+        vendas = {}
+        progresso.etapa("Consultando vendas")
+        consultadas = self.__venda_DAO.consultar({'data': Intervalo(data_inicial, data_final)},
+                                                 campos=('id', 'afiliado', 'total'))
+        for posicao, venda in enumerate(consultadas, 1):
+            progresso.avancar(posicao, len(consultadas), "Somando vendas")
+            vendas[venda['id']] = (venda['afiliado'], venda['total'])
+            quantidade, total = proprias.get(venda['afiliado'], (0, 0.0))
+            proprias[venda['afiliado']] = (quantidade + 1, total + venda['total'])
+        if self.__arquivo_vendas is not None:
+            progresso.etapa("Somando vendas arquivadas")
+            for posicao, venda in enumerate(self.__arquivo_vendas.registros(data_inicial, data_final)):
+                if posicao % 1000 == 0:
+                    progresso.verificar()
+                quantidade, total = proprias.get(venda['afiliado_id'], (0, 0.0))
+                proprias[venda['afiliado_id']] = (quantidade + 1, total + venda['total'])
+
+        filhos = {}
+        raizes = []
+        for id, (_, parent) in sorted(rede.items()):
+            if parent is None or parent not in rede:
+                raizes.append(id)
+            else:
+                filhos.setdefault(parent, []).append(id)
+
+        linhas, posicoes = [], {}
+        # Afiliados fora das árvores (ciclo de parent) entram como raízes ao final.
+        for raiz in raizes + sorted(rede):
+            if raiz in posicoes:
+                continue
+            progresso.avancar(len(posicoes), len(rede), "Somando as redes")
+            pilha = [(raiz, None, 0, False)]
+            while pilha:
+                id, pai, nivel, saida = pilha.pop()
+                if saida:
+                    if pai is not None:
+                        linha, linha_pai = linhas[posicoes[id]], linhas[posicoes[pai]]
+                        linha_pai['vendas_rede'] += linha['vendas_rede']
+                        linha_pai['total_rede'] += linha['total_rede']
+                    continue
+                if id in posicoes:
+                    continue
+                quantidade, total = proprias.get(id, (0, 0.0))
+                posicoes[id] = len(linhas)
+                linhas.append({'id': id, 'nome': rede[id][0], 'parent': pai, 'nivel': nivel,
+                               'vendas': quantidade, 'total': total,
+                               'vendas_rede': quantidade, 'total_rede': total})
+                pilha.append((id, pai, nivel, True))
+                for filho in reversed(filhos.get(id, ())):
+                    if filho not in posicoes:
+                        pilha.append((filho, id, nivel + 1, False))
+
+        return {'linhas': linhas, 'posicoes': posicoes, 'vendas': vendas, 'rede': rede}
+
+    @staticmethod
+    def __somar(entrada, afiliado_id, quantidade, total):
+        posicoes, linhas = entrada['posicoes'], entrada['linhas']
+        if afiliado_id not in posicoes:
+            return False
+        linha = linhas[posicoes[afiliado_id]]
+        linha['vendas'] += quantidade
+        linha['total'] += total
+        while linha is not None:
+            linha['vendas_rede'] += quantidade
+            linha['total_rede'] += total
+            linha = linhas[posicoes[linha['parent']]] if linha['parent'] is not None else None
+        return True
+
+    def __venda_alterada(self, dao, chave, valores):
+        with self.__trava:
+            self.__versao += 1
+            for periodo, entrada in list(self.__periodos.items()):
+                anterior = entrada['vendas'].get(chave) if chave is not None else None
+                if chave is None or (valores is None and anterior is not None):
+                    # Exclusão (ou arquivamento) e releitura: mais simples montar de novo.
+                    del self.__periodos[periodo]
+                    continue
+                if valores is None:
+                    continue
+                data_inicial, data_final = periodo
+                atual = None
+                if data_inicial <= valores['data'] <= data_final:
+                    atual = (valores['afiliado'], valores['total'])
+                if atual == anterior:
+                    continue
+                ok = True
+                if anterior is not None:
+                    del entrada['vendas'][chave]
+                    ok = self.__somar(entrada, anterior[0], -1, -anterior[1])
+                if ok and atual is not None:
+                    entrada['vendas'][chave] = atual
+                    ok = self.__somar(entrada, atual[0], 1, atual[1])
+                if not ok:
+                    del self.__periodos[periodo]
+
+    def __afiliado_alterado(self, dao, chave, valores):
+        with self.__trava:
+            self.__versao += 1
+            rede = self.__rede
+            if chave is not None and valores is not None and rede is not None and chave in rede:
+                nome, parent = rede[chave]
+                if valores['parent'] == parent:
+                    # Só o nome (ou as vendas) mudou: a estrutura da rede continua valendo.
+                    if valores['nome'] != nome:
+                        rede[chave] = (valores['nome'], parent)
+                        for entrada in self.__periodos.values():
+                            posicao = entrada['posicoes'].get(chave)
+                            if posicao is not None:
+                                entrada['linhas'][posicao]['nome'] = valores['nome']
+                    return
+            self.__periodos.clear()
+            self.__rede = None
+
+class RankingVendas:
+    # Os N primeiros afiliados e produtos de um período. Os totais por afiliado vêm do
+    # RelatorioRede (já guardados por período); os de produto saem de uma única
+    # passada pelas vendas do período. A seleção usa heapq.nlargest, sem ordenar todos os grupos.
+    CRITERIOS_AFILIADOS = ('receita', 'comissao')
+    CRITERIOS_PRODUTOS = ('quantidade', 'receita')
+
+    def __init__(self, venda_DAO, produto_DAO, relatorio_rede, arquivo_vendas=None):
+        self.__venda_DAO = venda_DAO
+        self.__produto_DAO = produto_DAO
+        self.__relatorio_rede = relatorio_rede
+        self.__arquivo_vendas = arquivo_vendas
+        self.__produtos = None
+        self.__trava = threading.Lock()
+        self.__versao = 0
+        venda_DAO.adicionar_ouvinte(self.__venda_alterada)
+
+    @staticmethod
+    def __validar(quantidade, criterio, criterios):
+        if not isinstance(quantidade, int) or quantidade <= 0:
+            raise DadoInvalidoException("Quantidade", quantidade, "Deve ser um inteiro positivo")
+        if criterio not in criterios:
+            raise DadoInvalidoException("Critério", criterio, f"Use um de {criterios}")
+
+    @staticmethod
+    def __classificar(valores, quantidade):
+        return heapq.nlargest(quantidade, ((valor, chave) for chave, valor in valores.items() if valor),
+                              key=lambda item: item[0])
+
+    @Instrumentacao.instrumentar('relatorio.ranking_afiliados')
+    def afiliados(self, data_inicial: date, data_final: date, quantidade: int = 10, criterio: str = 'receita'):
+        self.__validar(quantidade, criterio, self.CRITERIOS_AFILIADOS)
+        linhas = self.__relatorio_rede.calcular(data_inicial, data_final)
+        nomes = {linha['id']: linha['nome'] for linha in linhas}
+        valores = {}
+        for linha in linhas:
+            if criterio == 'receita':
+                valores[linha['id']] = linha['total']
+            else:
+                valores[linha['id']] = valores.get(linha['id'], 0.0) + linha['total'] * ControllerPagamento.COMISSAO_DIRETA
+                if linha['parent'] is not None:
+                    valores[linha['parent']] = (valores.get(linha['parent'], 0.0)
+                                                + linha['total'] * ControllerPagamento.COMISSAO_INDIRETA)
+        return [{'posicao': posicao, 'id': id, 'nome': nomes[id], 'valor': valor}
+                for posicao, (valor, id) in enumerate(self.__classificar(valores, quantidade), 1)]
+
+    @Instrumentacao.instrumentar('relatorio.ranking_produtos')
+    def produtos(self, data_inicial: date, data_final: date, quantidade: int = 10, criterio: str = 'quantidade'):
+        self.__validar(quantidade, criterio, self.CRITERIOS_PRODUTOS)
+        if data_inicial > data_final:
+            raise DadoInvalidoException("Datas", "inicial maior que final")
+        valores, nomes = self.__totais_produtos(data_inicial, data_final)
+        resultado = []
+        for posicao, (valor, codigo) in enumerate(self.__classificar(valores[criterio], quantidade), 1):
+            produto = self.__produto_DAO.get(codigo)
+            nome = produto.detalhes.nome if produto is not None else nomes.get(codigo, codigo)
+            resultado.append({'posicao': posicao, 'codigo': codigo, 'nome': nome, 'valor': valor})
+        return resultado
+
+    def __totais_produtos(self, data_inicial, data_final):
+        # Quantidade e receita saem da mesma passada; o último período fica guardado
+        # até alguma venda mudar, já que os dois critérios costumam ser pedidos juntos.
+        with self.__trava:
+            if self.__produtos is not None and self.__produtos[0] == (data_inicial, data_final, self.__versao):
+                return self.__produtos[1], self.__produtos[2]
+            versao = self.__versao
+        quantidades, receitas, nomes = {}, {}, {}
+        for venda in self.__venda_DAO.consultar({'data': Intervalo(data_inicial, data_final)},
+                                                campos=('produto', 'quantidade', 'total')):
+            codigo = venda['produto']
+            quantidades[codigo] = quantidades.get(codigo, 0) + venda['quantidade']
+            receitas[codigo] = receitas.get(codigo, 0.0) + venda['total']
+        if self.__arquivo_vendas is not None:
+            for venda in self.__arquivo_vendas.registros(data_inicial, data_final):
+                codigo = venda['produto_codigo']
+                quantidades[codigo] = quantidades.get(codigo, 0) + venda['quantidade']
+                receitas[codigo] = receitas.get(codigo, 0.0) + venda['total']
+                nomes.setdefault(codigo, venda['produto'])
+        valores = {'quantidade': quantidades, 'receita': receitas}
+        with self.__trava:
+            self.__produtos = ((data_inicial, data_final, versao), valores, nomes)
+        return valores, nomes
+
+    def limpar(self):
+        with self.__trava:
+            self.__versao += 1
+            self.__produtos = None
+
+    def __venda_alterada(self, dao, chave, valores):
+        self.limpar()
+
 class TelaRelatorio:
     def __init__(self):
         self.__window = None
+        self.__janelas = Janelas()
+        self.__progresso = TelaProgresso()
 
     def init_components(self):
+        self.__window = self.__janelas.abrir('menu', self.__montar_menu)
+
+    def __montar_menu(self):
         sg.theme('DarkBlue14')
         layout = [
             [sg.Text('Escolha uma opção', font=('Helvetica', 14), expand_x=True, justification='center', pad=(5, 10))],
             [sg.Radio('Gerar Relatório de Vendas', "RD1", default=False, key='1', font=('Helvetica', 12), pad=(10, 5))],
             [sg.Radio('Gerar Relatório de Pagamentos', "RD1", default=False, key='2', font=('Helvetica', 12), pad=(10, 5))],
+            [sg.Radio('Gerar Relatório de Rede', "RD1", default=False, key='3', font=('Helvetica', 12), pad=(10, 5))],
+            [sg.Radio('Gerar Rankings', "RD1", default=False, key='4', font=('Helvetica', 12), pad=(10, 5))],
             [sg.HorizontalSeparator()],
             [sg.Push(), sg.Button('Confirmar', size=(10,1), button_color=('white', 'green')),
             sg.Button('Voltar', size=(10,1), button_color=('white', 'firebrick3')), sg.Push()]
         ]
-        self.__window = sg.Window('Menu de Relatórios').Layout(layout)
+        return sg.Window('Menu de Relatórios').Layout(layout)
 
     def close(self):
-        if self.__window:
-            self.__window.Close()
+        self.__janelas.esconder('menu')
         self.__window = None
 
     def mostrar_menu(self):
         botao, opc = self.__window.Read()
         return botao, opc
 
+    @Instrumentacao.dialogo
     def ler_dados(self):
+        botao, values = self.__janelas.ler('parametros', self.__montar_parametros)
+        return None if botao == 'Cancelar' else values
+
+    def __montar_parametros(self):
         layout = [
             [sg.Text('Gerar Relatório', font=('Helvetica', 16), expand_x=True, justification='center', pad=(5, 10))],
             [sg.Text('Data Inicial (AAAA-MM-DD)', size=(22, 1), font=('Helvetica', 11)), sg.InputText(key='data_inicial', size=(35, 1))],
@@ -1697,12 +5447,28 @@ class TelaRelatorio:
             sg.Button('Cancelar', size=(12, 1), button_color=('white', 'firebrick3')), 
             sg.Push()]
         ]
+        return sg.Window('Parâmetros do Relatório', layout)
 
-        window = sg.Window('Parâmetros do Relatório', layout)
-        botao, values = window.read()
-        window.close()
+    @Instrumentacao.dialogo
+    def ler_dados_ranking(self):
+        botao, values = self.__janelas.ler('parametros_ranking', self.__montar_parametros_ranking)
         return None if botao == 'Cancelar' else values
 
+    def __montar_parametros_ranking(self):
+        layout = [
+            [sg.Text('Gerar Rankings', font=('Helvetica', 16), expand_x=True, justification='center', pad=(5, 10))],
+            [sg.Text('Data Inicial (AAAA-MM-DD)', size=(22, 1), font=('Helvetica', 11)), sg.InputText(key='data_inicial', size=(35, 1))],
+            [sg.Text('Data Final (AAAA-MM-DD)', size=(22, 1), font=('Helvetica', 11)), sg.InputText(key='data_final', size=(35, 1))],
+            [sg.Text('Quantidade (N)', size=(22, 1), font=('Helvetica', 11)), sg.InputText('10', key='quantidade', size=(35, 1))],
+            [sg.HorizontalSeparator(pad=(5, 15))],
+            [sg.Push(), 
+            sg.Button('Confirmar', size=(12, 1), button_color=('white', 'green')), 
+            sg.Button('Cancelar', size=(12, 1), button_color=('white', 'firebrick3')), 
+            sg.Push()]
+        ]
+        return sg.Window('Parâmetros dos Rankings', layout)
+
+    @Instrumentacao.dialogo
     def mostrar_relatorio_vendas(self, vendas):
         texto = "=== Relatório de Vendas ===\n\n"
         if not vendas:
@@ -1713,15 +5479,9 @@ class TelaRelatorio:
                          f"Produto: {venda['produto']} | Quantidade: {venda['quantidade']} | "
                          f"Total: R${venda['total']:.2f}\n")
 
-        layout = [
-            [sg.Multiline(texto, size=(100, min(25, len(vendas)+6)), disabled=True)],
-            [sg.Button("Fechar")]
-        ]
-
-        window = sg.Window("Relatório de Vendas", layout)
-        window.read()
-        window.close()
+        self.__janelas.ler('vendas', partial(self.__montar_texto, "Relatório de Vendas", 100), {'texto': texto})
 
+    @Instrumentacao.dialogo
     def mostrar_relatorio_financeiro(self, pagamentos):
         texto = "=== Relatório Financeiro ===\n\n"
         if not pagamentos:
@@ -1732,15 +5492,48 @@ class TelaRelatorio:
                          f"Afiliado: {pagamento['afiliado']} | "
                          f"Valor Pago: R${pagamento['valorPago']:.2f}\n")
 
+        self.__janelas.ler('financeiro', partial(self.__montar_texto, "Relatório Financeiro", 100), {'texto': texto})
+
+    @Instrumentacao.dialogo
+    def mostrar_relatorio_rede(self, linhas):
+        texto = "=== Relatório de Rede ===\n\n"
+        if not linhas:
+            texto += "Nenhum afiliado cadastrado.\n"
+        else:
+            for linha in linhas:
+                texto += (f"{'    ' * linha['nivel']}{linha['nome']} (ID: {linha['id']}) | "
+                         f"Próprias: {linha['vendas']} / R${linha['total']:.2f} | "
+                         f"Rede: {linha['vendas_rede']} / R${linha['total_rede']:.2f}\n")
+
+        self.__janelas.ler('rede', partial(self.__montar_texto, "Relatório de Rede", 100, ('Courier', 9)),
+                           {'texto': texto})
+
+    @Instrumentacao.dialogo
+    def mostrar_rankings(self, rankings):
+        texto = ""
+        for titulo, linhas in rankings.items():
+            texto += f"=== {titulo} ===\n"
+            if not linhas:
+                texto += "Nenhuma venda no período.\n"
+            for linha in linhas:
+                identificador = linha['id'] if 'id' in linha else linha['codigo']
+                valor = f"{linha['valor']}" if isinstance(linha['valor'], int) else f"R${linha['valor']:.2f}"
+                texto += f"{linha['posicao']:>3}. {linha['nome']} ({identificador}) | {valor}\n"
+            texto += "\n"
+
+        self.__janelas.ler('rankings', partial(self.__montar_texto, "Rankings", 90, ('Courier', 9)), {'texto': texto})
+
+    def __montar_texto(self, titulo, largura, fonte=None):
         layout = [
-            [sg.Multiline(texto, size=(100, min(25, len(pagamentos)+6)), disabled=True)],
+            [sg.Multiline('', size=(largura, 25), disabled=True, key='texto', font=fonte)],
             [sg.Button("Fechar")]
         ]
+        return sg.Window(titulo, layout)
 
-        window = sg.Window("Relatório Financeiro", layout)
-        window.read()
-        window.close()
+    def acompanhar(self, titulo, operacao):
+        return self.__progresso.acompanhar(titulo, operacao)
 
+    @Instrumentacao.dialogo
     def mostrar_mensagem_popup(self, mensagem):
         sg.popup(mensagem)
 
@@ -1751,6 +5544,27 @@ class ControllerRelatorio:
         self.__controller_venda = controller_venda
         self.__controller_pagamento = controller_pagamento
         self.__controller_afiliado = controller_afiliado
+        self.__cache = CacheRelatorios(controller_venda.venda_DAO, controller_pagamento.pagamento_DAO,
+                                       controller_afiliado.afiliado_DAO,
+                                       controller_venda.controller_produto.produto_DAO)
+        self.__relatorio_rede = RelatorioRede(controller_venda.venda_DAO, controller_afiliado.afiliado_DAO,
+                                              controller_venda.arquivo_vendas)
+        self.__ranking = RankingVendas(controller_venda.venda_DAO, controller_venda.controller_produto.produto_DAO,
+                                       self.__relatorio_rede, controller_venda.arquivo_vendas)
+
+    @property
+    def relatorio_rede(self):
+        return self.__relatorio_rede
+
+    @property
+    def ranking(self):
+        return self.__ranking
+
+    def limpar(self):
+        # Descarta os resultados guardados; o próximo relatório é calculado do zero.
+        self.__cache.limpar()
+        self.__relatorio_rede.limpar()
+        self.__ranking.limpar()
 
     def executar(self):
         self.__tela.init_components()
@@ -1762,6 +5576,10 @@ class ControllerRelatorio:
                     self.gerar_relatorio_vendas()
                 elif opc['2'] == True:
                     self.gerar_relatorio_financeiro()
+                elif opc['3'] == True:
+                    self.gerar_relatorio_rede()
+                elif opc['4'] == True:
+                    self.gerar_rankings()
                 else:
                     self.__tela.mostrar_mensagem_popup("Opção inválida!")
                 self.__tela.init_components()
@@ -1769,6 +5587,7 @@ class ControllerRelatorio:
                 self.__tela.close()
                 break
 
+    @Instrumentacao.instrumentar('relatorio.gerar_relatorio_vendas')
     def gerar_relatorio_vendas(self):
         try:
             dados = self.__tela.ler_dados()
@@ -1803,24 +5622,75 @@ class ControllerRelatorio:
                 if not afiliado:
                     raise EntidadeNaoEncontradaException("Afiliado", afiliado_id)
 
-            vendas_filtradas = []
-            for venda in self.__controller_venda.venda_DAO.get_all():
-                if data_inicial <= venda.data <= data_final:
-                    if afiliado is None or venda.afiliado.id == afiliado.id:
-                        vendas_filtradas.append({
-                            'id': venda.id,
-                            'data': str(venda.data),
-                            'afiliado': venda.afiliado.nome,
-                            'produto': venda.produto.detalhes.nome,
-                            'quantidade': venda.quantidade,
-                            'total': venda.total
-                        })
+            chave = ('vendas', data_inicial, data_final, afiliado_id)
+            vendas_filtradas, versao = self.__cache.obter(chave)
+            if vendas_filtradas is not None:
+                self.__tela.mostrar_relatorio_vendas(vendas_filtradas)
+                return
 
+            vendas_filtradas = self.__tela.acompanhar(
+                "Gerando relatório de vendas",
+                lambda progresso: self.__linhas_vendas(progresso, chave, versao, afiliado))
             self.__tela.mostrar_relatorio_vendas(vendas_filtradas)
 
+        except OperacaoCanceladaException:
+            self.__tela.mostrar_mensagem_popup("Relatório cancelado.")
         except Exception as e:
+            Instrumentacao.falha()
             self.__tela.mostrar_mensagem_popup(f"Erro ao gerar relatório de vendas: {e}")
 
+    def __linhas_vendas(self, progresso, chave, versao, afiliado):
+        _, data_inicial, data_final, afiliado_id = chave
+        vendas_filtradas = []
+        afiliados, produtos = {}, {}
+        filtros = {'data': Intervalo(data_inicial, data_final)}
+        if afiliado_id is not None:
+            filtros['afiliado'] = afiliado_id
+        paralelo = ProcessamentoParalelo.padrao()
+        particionado = paralelo.vale_a_pena(self.__controller_venda.venda_DAO, filtros)
+        progresso.etapa("Lendo vendas arquivadas")
+        for venda in self.__controller_venda.arquivo_vendas.registros(data_inicial, data_final, afiliado_id):
+            vendas_filtradas.append({
+                'id': venda['id'],
+                'data': str(venda['data']),
+                'afiliado': venda['afiliado'],
+                'produto': venda['produto'],
+                'quantidade': venda['quantidade'],
+                'total': venda['total']
+            })
+        if particionado:
+            self.__controller_venda.venda_DAO.flush()
+            self.__controller_afiliado.afiliado_DAO.flush()
+            self.__controller_venda.controller_produto.produto_DAO.flush()
+            parciais = paralelo.executar(ProcessamentoParalelo.particao_vendas,
+                                         paralelo.particionar_por_data(filtros), progresso)
+            # Cada partição já vem ordenada por id; basta intercalar.
+            vendas_filtradas.extend(heapq.merge(*(linhas for linhas, _, _ in parciais), key=lambda v: v['id']))
+            for _, nomes_afiliados, nomes_produtos in parciais:
+                afiliados.update(nomes_afiliados)
+                produtos.update(nomes_produtos)
+        else:
+            relatorio = Relatorio((data_inicial, data_final), afiliado)
+            progresso.etapa("Consultando vendas")
+            vendas = relatorio.gerarRelatorioVendas(self.__controller_venda.venda_DAO)
+            for posicao, venda in enumerate(vendas, 1):
+                progresso.avancar(posicao, len(vendas), "Montando relatório")
+                vendas_filtradas.append({
+                    'id': venda.id,
+                    'data': str(venda.data),
+                    'afiliado': venda.afiliado.nome,
+                    'produto': venda.produto.detalhes.nome,
+                    'quantidade': venda.quantidade,
+                    'total': venda.total
+                })
+                afiliados[venda.afiliado.id] = venda.afiliado.nome
+                produtos[venda.produto.codigo] = venda.produto.detalhes.nome
+
+        self.__cache.guardar(chave, versao, vendas_filtradas, (v['id'] for v in vendas_filtradas),
+                             afiliados, produtos)
+        return vendas_filtradas
+
+    @Instrumentacao.instrumentar('relatorio.gerar_relatorio_financeiro')
     def gerar_relatorio_financeiro(self):
         try:
             dados = self.__tela.ler_dados()
@@ -1855,22 +5725,205 @@ class ControllerRelatorio:
                 if not afiliado:
                     raise EntidadeNaoEncontradaException("Afiliado", afiliado_id)
 
-            pagamentos_filtrados = []
-            for pagamento in self.__controller_pagamento.pagamento_DAO.get_all():
-                if data_inicial <= pagamento.data <= data_final:
-                    if afiliado is None or pagamento.afiliado.id == afiliado.id:
-                        pagamentos_filtrados.append({
-                            'id': pagamento.id,
-                            'data': str(pagamento.data),
-                            'afiliado': f"{pagamento.afiliado.nome} (ID: {pagamento.afiliado.id})",
-                            'valorPago': pagamento.valorPago
-                        })
+            chave = ('financeiro', data_inicial, data_final, afiliado_id)
+            pagamentos_filtrados, versao = self.__cache.obter(chave)
+            if pagamentos_filtrados is not None:
+                self.__tela.mostrar_relatorio_financeiro(pagamentos_filtrados)
+                return
 
+            pagamentos_filtrados = self.__tela.acompanhar(
+                "Gerando relatório financeiro",
+                lambda progresso: self.__linhas_financeiro(progresso, chave, versao, afiliado))
             self.__tela.mostrar_relatorio_financeiro(pagamentos_filtrados)
 
+        except OperacaoCanceladaException:
+            self.__tela.mostrar_mensagem_popup("Relatório cancelado.")
         except Exception as e:
+            Instrumentacao.falha()
             self.__tela.mostrar_mensagem_popup(f"Erro ao gerar relatório financeiro: {e}")
 
+    def __linhas_financeiro(self, progresso, chave, versao, afiliado):
+        _, data_inicial, data_final, afiliado_id = chave
+        pagamentos_filtrados = []
+        afiliados = {}
+        filtros = {'data': Intervalo(data_inicial, data_final)}
+        if afiliado_id is not None:
+            filtros['afiliado'] = afiliado_id
+        paralelo = ProcessamentoParalelo.padrao()
+        particionado = paralelo.vale_a_pena(self.__controller_pagamento.pagamento_DAO, filtros)
+        if particionado:
+            self.__controller_pagamento.pagamento_DAO.flush()
+            self.__controller_afiliado.afiliado_DAO.flush()
+            parciais = paralelo.executar(ProcessamentoParalelo.particao_financeiro,
+                                         paralelo.particionar_por_data(filtros), progresso)
+            pagamentos_filtrados.extend(heapq.merge(*(linhas for linhas, _ in parciais), key=lambda p: p['id']))
+            for _, nomes_afiliados in parciais:
+                afiliados.update(nomes_afiliados)
+        else:
+            relatorio = Relatorio((data_inicial, data_final), afiliado)
+            progresso.etapa("Consultando pagamentos")
+            pagamentos = relatorio.gerarRelatorioFinanceiro(self.__controller_pagamento.pagamento_DAO)
+            for posicao, pagamento in enumerate(pagamentos, 1):
+                progresso.avancar(posicao, len(pagamentos), "Montando relatório")
+                pagamentos_filtrados.append({
+                    'id': pagamento.id,
+                    'data': str(pagamento.data),
+                    'afiliado': f"{pagamento.afiliado.nome} (ID: {pagamento.afiliado.id})",
+                    'valorPago': pagamento.valorPago
+                })
+                afiliados[pagamento.afiliado.id] = pagamento.afiliado.nome
+
+        self.__cache.guardar(chave, versao, pagamentos_filtrados, (p['id'] for p in pagamentos_filtrados),
+                             afiliados)
+        return pagamentos_filtrados
+
+    @Instrumentacao.instrumentar('relatorio.gerar_relatorio_rede')
+    def gerar_relatorio_rede(self):
+        try:
+            dados = self.__tela.ler_dados()
+            if dados is None:
+                return
+
+            data_inicial_str = dados['data_inicial']
+            data_final_str = dados['data_final']
+            afiliado_id_str = dados['afiliado_id']
+
+            if not data_inicial_str or not data_final_str:
+                raise CampoObrigatorioException("Data inicial e final")
+
+            try:
+                data_inicial = date.fromisoformat(data_inicial_str)
+                data_final = date.fromisoformat(data_final_str)
+            except ValueError:
+                raise DadoInvalidoException("Data", "formato inválido", "Use AAAA-MM-DD")
+
+            afiliado_id = None
+            if afiliado_id_str:
+                try:
+                    afiliado_id = int(afiliado_id_str)
+                except ValueError:
+                    raise DadoInvalidoException("ID Afiliado", afiliado_id_str, "Deve ser um número inteiro")
+
+            linhas = self.__tela.acompanhar(
+                "Gerando relatório de rede",
+                lambda progresso: self.__relatorio_rede.calcular(data_inicial, data_final, afiliado_id, progresso))
+            self.__tela.mostrar_relatorio_rede(linhas)
+
+        except OperacaoCanceladaException:
+            self.__tela.mostrar_mensagem_popup("Relatório cancelado.")
+        except Exception as e:
+            Instrumentacao.falha()
+            self.__tela.mostrar_mensagem_popup(f"Erro ao gerar relatório de rede: {e}")
+
+    @Instrumentacao.instrumentar('relatorio.gerar_rankings')
+    def gerar_rankings(self):
+        try:
+            dados = self.__tela.ler_dados_ranking()
+            if dados is None:
+                return
+
+            if not dados['data_inicial'] or not dados['data_final']:
+                raise CampoObrigatorioException("Data inicial e final")
+
+            try:
+                data_inicial = date.fromisoformat(dados['data_inicial'])
+                data_final = date.fromisoformat(dados['data_final'])
+            except ValueError:
+                raise DadoInvalidoException("Data", "formato inválido", "Use AAAA-MM-DD")
+
+            try:
+                quantidade = int(dados['quantidade'] or 10)
+            except ValueError:
+                raise DadoInvalidoException("Quantidade", dados['quantidade'], "Deve ser um número inteiro")
+
+            periodo = (data_inicial, data_final, quantidade)
+            consultas = (
+                ('Afiliados por receita', self.__ranking.afiliados, 'receita'),
+                ('Afiliados por comissão', self.__ranking.afiliados, 'comissao'),
+                ('Produtos por quantidade', self.__ranking.produtos, 'quantidade'),
+                ('Produtos por receita', self.__ranking.produtos, 'receita')
+            )
+
+            def classificar(progresso):
+                rankings = {}
+                for posicao, (titulo, consulta, criterio) in enumerate(consultas):
+                    progresso.avancar(posicao, len(consultas), titulo)
+                    rankings[titulo] = consulta(*periodo, criterio=criterio)
+                return rankings
+
+            self.__tela.mostrar_rankings(self.__tela.acompanhar("Gerando rankings", classificar))
+
+        except OperacaoCanceladaException:
+            self.__tela.mostrar_mensagem_popup("Rankings cancelados.")
+        except Exception as e:
+            Instrumentacao.falha()
+            self.__tela.mostrar_mensagem_popup(f"Erro ao gerar rankings: {e}")
+
+class TelaDiagnostico:
+    def __init__(self):
+        self.__janelas = Janelas()
+
+    def mostrar_diagnostico(self, texto):
+        botao, _ = self.__janelas.ler('diagnostico', self.__montar_diagnostico, {'texto': texto})
+        return botao
+
+    def __montar_diagnostico(self):
+        layout = [
+            [sg.Text('Diagnóstico de Desempenho', font=('Helvetica', 16), expand_x=True, justification='center', pad=(5, 10))],
+            [sg.Multiline('', size=(130, 25), disabled=True, key='texto', font=('Courier', 9))],
+            [sg.Push(),
+            sg.Button('Atualizar', size=(12, 1)),
+            sg.Button('Exportar JSON', size=(14, 1)),
+            sg.Button('Exportar Prometheus', size=(18, 1)),
+            sg.Button('Limpar', size=(10, 1)),
+            sg.Button('Fechar', size=(10, 1), button_color=('white', 'firebrick3')),
+            sg.Push()]
+        ]
+        return sg.Window('Diagnóstico', layout)
+
+    def selecionar_arquivo_exportacao(self, nome_padrao, extensao):
+        return sg.popup_get_file('Salvar como', save_as=True, default_path=nome_padrao,
+                                 file_types=((extensao.upper(), f'*.{extensao}'),))
+
+    def mostrar_mensagem_popup(self, mensagem):
+        sg.popup(mensagem)
+
+class ControllerDiagnostico:
+    def __init__(self, tela, resolvedor):
+        self.__tela = tela
+        self.__resolvedor = resolvedor
+
+    def executar(self):
+        while True:
+            botao = self.__tela.mostrar_diagnostico(self.__resumo())
+            if botao == 'Exportar JSON':
+                self.__exportar('diagnostico.json', 'json', Instrumentacao.exportar_json())
+            elif botao == 'Exportar Prometheus':
+                self.__exportar('diagnostico.prom', 'prom', Instrumentacao.exportar_prometheus())
+            elif botao == 'Limpar':
+                Instrumentacao.limpar()
+            elif botao != 'Atualizar':
+                break
+
+    def __resumo(self):
+        linhas = [Instrumentacao.resumo(), "", "=== Caches dos DAOs ===", ""]
+        for nome, c in sorted(DAO.estatisticas_caches(self.__resolvedor.daos()).items()):
+            taxa = f"{c['taxa_acertos'] * 100:.1f}%" if c['taxa_acertos'] is not None else "-"
+            linhas.append(f"{nome} | Limite: {c['limite'] or 'sem limite'} | Montados: {c['montados']}/{c['registros']} | "
+                          f"Acertos: {c['acertos']} | Falhas: {c['falhas']} | Taxa: {taxa} | Despejos: {c['despejos']}")
+        return "\n".join(linhas)
+
+    def __exportar(self, nome_padrao, extensao, conteudo):
+        try:
+            caminho = self.__tela.selecionar_arquivo_exportacao(nome_padrao, extensao)
+            if not caminho:
+                return
+            with open(caminho, 'w', encoding='utf-8') as arquivo:
+                arquivo.write(conteudo)
+            self.__tela.mostrar_mensagem_popup(f"Diagnóstico exportado para {caminho}")
+        except Exception as e:
+            self.__tela.mostrar_mensagem_popup(f"Erro ao exportar diagnóstico: {e}")
+
 class ControllerSistema:
     def __init__(self):
         self.__window = None
@@ -1880,9 +5933,11 @@ class ControllerSistema:
         tela__venda = TelaVenda()
         tela__pagamento = TelaPagamento()
         tela__relatorio = TelaRelatorio()
+        tela__diagnostico = TelaDiagnostico()
         
-        self.__controller_produto = ControllerProduto(tela__produto)
-        self.__controller_afiliado = ControllerAfiliado(tela__afiliado)
+        resolvedor = Resolvedor(concorrente=True)
+        self.__controller_produto = ControllerProduto(tela__produto, resolvedor)
+        self.__controller_afiliado = ControllerAfiliado(tela__afiliado, resolvedor)
         
         self.__controller_venda = ControllerVenda(
             tela__venda, 
@@ -1902,9 +5957,24 @@ class ControllerSistema:
             self.__controller_afiliado
         )
         
+        self.__controller_diagnostico = ControllerDiagnostico(tela__diagnostico, resolvedor)
+
         # Configurar dependência adicional para o ControllerProduto
         self.__controller_produto.set_controller_venda(self.__controller_venda)
 
+        # AFILIADOS_EVENTOS: destinos, separados por vírgula, dos eventos de alteração
+        # dos DAOs (arquivo .jsonl, unix:/caminho ou tcp:host:porta).
+        self.__assinantes = [AssinanteEventos.criar(destino.strip())
+                             for destino in os.environ.get('AFILIADOS_EVENTOS', '').split(',') if destino.strip()]
+        for dao in self.__daos():
+            for assinante in self.__assinantes:
+                dao.assinar(assinante)
+
+    def __daos(self):
+        return (self.__controller_produto.produto_DAO, self.__controller_afiliado.afiliado_DAO,
+                self.__controller_venda.venda_DAO, self.__controller_pagamento.pagamento_DAO,
+                self.__controller_pagamento.saldo_DAO)
+
     @property
     def controller_produto(self):
         return self.__controller_produto
@@ -1935,12 +6005,14 @@ class ControllerSistema:
             [sg.Radio('Gerenciar Vendas', "RD1", key='3', font=('Helvetica', 12), pad=(10, 5))],
             [sg.Radio('Gerenciar Pagamentos', "RD1", key='4', font=('Helvetica', 12), pad=(10, 5))],
             [sg.Radio('Gerenciar Relatório', "RD1", key='5', font=('Helvetica', 12), pad=(10, 5))],
+            [sg.Radio('Diagnóstico', "RD1", key='6', font=('Helvetica', 12), pad=(10, 5))],
+            [sg.Radio('Ativar/desativar modo de perfil', "RD1", key='7', font=('Helvetica', 12), pad=(10, 5))],
             [sg.HorizontalSeparator()],
             [sg.Push(), sg.Button('Confirmar', size=(10,1), button_color=('white', 'green')),
             sg.Button('Cancelar', size=(10,1), button_color=('white', 'firebrick3')), sg.Push()]
         ]
 
-        self.__window = sg.Window('Sistema Financeiro de Afiliados', layout, size=(500, 320), finalize=True)
+        self.__window = sg.Window('Sistema Financeiro de Afiliados', layout, size=(500, 380), finalize=True)
 
     def executar(self):
         while True:
@@ -1956,10 +6028,32 @@ class ControllerSistema:
                     self.__controller_pagamento.executar()
                 elif key['5'] == True:
                     self.__controller_relatorio.executar()
+                elif key['6'] == True:
+                    self.__controller_diagnostico.executar()
+                elif key['7'] == True:
+                    self.__alternar_perfil()
             elif button == 'Cancelar':
+                self.__persistir_pendencias()
                 break
             else:
                 sg.popup("opção invalida!")
 
-sistema = ControllerSistema()
-sistema.executar()
\ No newline at end of file
+    def __alternar_perfil(self):
+        if Perfilador.ativo():
+            Perfilador.desativar()
+            sg.popup("Modo de perfil desativado.")
+        else:
+            Perfilador.ativar()
+            sg.popup(f"Modo de perfil ativado. Cada ação gera um perfil em '{os.path.abspath(Perfilador.diretorio())}'.")
+
+    def __persistir_pendencias(self):
+        self.__controller_produto.produto_DAO.flush()
+        self.__controller_afiliado.afiliado_DAO.flush()
+        self.__controller_venda.venda_DAO.flush()
+        self.__controller_pagamento.pagamento_DAO.flush()
+        for assinante in self.__assinantes:
+            assinante.fechar()
+
+if __name__ == '__main__':
+    sistema = ControllerSistema()
+    sistema.executar()
\ No newline at end of file
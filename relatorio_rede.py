@@ -0,0 +1,32 @@
+import argparse
+import json
+import os
+from datetime import date, timedelta
+
+from index import AfiliadoDAO, VendaDAO, ArquivoVendas, RelatorioRede, Resolvedor
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Totais de vendas por afiliado e por rede (descendentes) num período.")
+    parser.add_argument('--diretorio', default='.', help="diretório dos arquivos .pkl")
+    parser.add_argument('--inicio', type=date.fromisoformat, default=date.today() - timedelta(days=30))
+    parser.add_argument('--fim', type=date.fromisoformat, default=date.today())
+    parser.add_argument('--afiliado', type=int, help="mostra só a rede deste afiliado")
+    parser.add_argument('--json', action='store_true', help="escreve as linhas em JSON em vez de texto")
+    args = parser.parse_args()
+
+    os.chdir(args.diretorio)
+    resolvedor = Resolvedor()
+    rede = RelatorioRede(VendaDAO(resolvedor=resolvedor), AfiliadoDAO(resolvedor=resolvedor), ArquivoVendas())
+    linhas = rede.calcular(args.inicio, args.fim, args.afiliado)
+    if args.json:
+        print(json.dumps(linhas, indent=2, ensure_ascii=False))
+        return
+    for linha in linhas:
+        print(f"{'    ' * linha['nivel']}{linha['nome']} (ID: {linha['id']})  "
+              f"próprias: {linha['vendas']} / {linha['total']:.2f}  "
+              f"rede: {linha['vendas_rede']} / {linha['total_rede']:.2f}")
+
+
+if __name__ == '__main__':
+    main()
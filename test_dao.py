@@ -0,0 +1,141 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import date
+from unittest import mock
+
+from index import (Afiliado, AfiliadoDAO, Codec, DAO, Produto, ProdutoDAO, Resolvedor, Venda, VendaDAO)
+
+DIRETORIO_REPOSITORIO = os.path.dirname(os.path.abspath(__file__))
+
+
+def gravar_afiliados(diretorio, ids):
+    # Roda em outro processo: cada afiliado é uma gravação própria no modo concorrente.
+    dao = AfiliadoDAO(concorrente=True, resolvedor=Resolvedor(diretorio, concorrente=True))
+    for id in ids:
+        dao.add(Afiliado(id, f"Afiliado {id}", f"afiliado{id}@exemplo.com"))
+    dao.flush()
+
+
+class TesteDAO(unittest.TestCase):
+    def setUp(self):
+        self.diretorio = tempfile.mkdtemp(prefix='teste-dao-')
+
+    def tearDown(self):
+        shutil.rmtree(self.diretorio, ignore_errors=True)
+
+    def abrir(self, concorrente=False, codec=None, limite_cache=None):
+        resolvedor = Resolvedor(self.diretorio, concorrente=concorrente)
+        return (AfiliadoDAO(concorrente=concorrente, codec=codec, limite_cache=limite_cache, resolvedor=resolvedor),
+                ProdutoDAO(concorrente=concorrente, codec=codec, resolvedor=resolvedor),
+                VendaDAO(concorrente=concorrente, codec=codec, resolvedor=resolvedor))
+
+    def test_codecs_ida_e_volta(self):
+        for nome in Codec.nomes():
+            with self.subTest(codec=nome):
+                registro = (7, 'Ana', 'ana@exemplo.com', None)
+                codec = Codec.criar(nome, AfiliadoDAO.campos)
+                self.assertEqual(codec.decodificar(codec.codificar(registro)), registro)
+
+                afiliado_DAO, produto_DAO, venda_DAO = self.abrir(codec=nome)
+                ana = Afiliado(1, 'Ana', 'ana@exemplo.com')
+                bia = Afiliado(2, 'Bia', 'bia@exemplo.com', ana)
+                caneta = Produto('P1', 'Caneta', 'Azul', 2.5)
+                for afiliado in (ana, bia):
+                    afiliado_DAO.add(afiliado)
+                produto_DAO.add(caneta)
+                venda_DAO.add(Venda(1, date(2024, 1, 2), bia, caneta, 4))
+
+                afiliado_DAO, produto_DAO, venda_DAO = self.abrir(codec=nome)
+                venda = venda_DAO.get(1)
+                self.assertEqual((venda.data, venda.quantidade, venda.total), (date(2024, 1, 2), 4, 10.0))
+                self.assertIs(venda.afiliado, afiliado_DAO.get(2))
+                self.assertIs(venda.produto, produto_DAO.get('P1'))
+                self.assertIs(venda.afiliado.parent, afiliado_DAO.get(1))
+                self.assertEqual(venda.produto.detalhes.nome, 'Caneta')
+                self.assertEqual([v.id for v in afiliado_DAO.get(2).vendas], [1])
+                for arquivo in os.listdir(self.diretorio):
+                    os.remove(os.path.join(self.diretorio, arquivo))
+
+    def test_migra_arquivos_antigos(self):
+        for nome in ('afiliado.pkl', 'produto.pkl', 'venda.pkl'):
+            shutil.copy(os.path.join(DIRETORIO_REPOSITORIO, nome), self.diretorio)
+        afiliado_DAO, produto_DAO, venda_DAO = self.abrir()
+        vendas = {venda.id: (venda.afiliado.id, venda.produto.codigo, venda.total) for venda in venda_DAO.get_all()}
+        self.assertTrue(vendas)
+        for afiliado in afiliado_DAO.get_all():
+            self.assertEqual(sorted(v.id for v in afiliado.vendas),
+                             sorted(id for id in vendas if vendas[id][0] == afiliado.id))
+        # A primeira gravação de cada DAO já usa o formato atual.
+        for dao in (afiliado_DAO, produto_DAO, venda_DAO):
+            dao.update(next(iter(dao.get_all())))
+            with open(os.path.join(self.diretorio, f"{dao.entidade.__name__.lower()}.pkl"), 'rb') as arquivo:
+                self.assertEqual(arquivo.read(len(DAO.MAGICO)), DAO.MAGICO)
+
+        afiliado_DAO, produto_DAO, venda_DAO = self.abrir()
+        for venda in venda_DAO.get_all():
+            self.assertEqual((venda.afiliado.id, venda.produto.codigo, venda.total), vendas.pop(venda.id))
+            self.assertIs(venda.afiliado, afiliado_DAO.get(venda.afiliado.id))
+            self.assertIs(venda.produto, produto_DAO.get(venda.produto.codigo))
+        self.assertEqual(vendas, {})
+
+    def test_queda_entre_diario_e_troca_do_arquivo(self):
+        afiliado_DAO, _, _ = self.abrir(concorrente=True)
+        afiliado_DAO.add(Afiliado(1, 'Ana', 'ana@exemplo.com'))
+        substituir = os.replace
+
+        def cair(origem, destino):
+            if destino.endswith('afiliado.pkl'):
+                raise OSError("queda simulada")
+            substituir(origem, destino)
+
+        # A entrada do diário é gravada; a troca do arquivo de dados, não.
+        with mock.patch('os.replace', side_effect=cair):
+            with self.assertRaises(OSError):
+                afiliado_DAO.add(Afiliado(2, 'Bia', 'bia@exemplo.com'))
+        self.assertEqual(sorted(f for f in os.listdir(self.diretorio) if f.endswith('.tmp')), [])
+
+        reaberto, _, _ = self.abrir(concorrente=True)
+        self.assertEqual(reaberto.get(2).nome, 'Bia')
+        self.assertEqual(reaberto.get(1).nome, 'Ana')
+
+    def test_dois_processos_concorrentes(self):
+        AfiliadoDAO(concorrente=True, resolvedor=Resolvedor(self.diretorio, concorrente=True))
+        contexto = multiprocessing.get_context('spawn')
+        processos = [contexto.Process(target=gravar_afiliados, args=(self.diretorio, range(inicio, inicio + 40)))
+                     for inicio in (1, 1001)]
+        for processo in processos:
+            processo.start()
+        for processo in processos:
+            processo.join(120)
+            self.assertEqual(processo.exitcode, 0)
+
+        afiliado_DAO, _, _ = self.abrir(concorrente=True)
+        self.assertEqual(sorted(a.id for a in afiliado_DAO.get_all()),
+                         list(range(1, 41)) + list(range(1001, 1041)))
+
+    def test_despejo_mantem_objetos_referenciados(self):
+        afiliado_DAO, _, _ = self.abrir()
+        ana = Afiliado(1, 'Ana', 'ana@exemplo.com')
+        afiliado_DAO.add(ana)
+        for id in range(2, 21):
+            afiliado_DAO.add(Afiliado(id, f"Afiliado {id}", f"afiliado{id}@exemplo.com", ana))
+
+        afiliado_DAO, _, _ = self.abrir(limite_cache=3)
+        filha = afiliado_DAO.get(2)
+        mae = filha.parent
+        for id in range(3, 21):
+            afiliado_DAO.get(id)
+        estatisticas = afiliado_DAO.estatisticas_cache()
+        self.assertGreater(estatisticas['despejos'], 0)
+        self.assertLessEqual(estatisticas['montados'], 3)
+        # Despejados, mas ainda referenciados: a mesma chave continua dando o mesmo objeto.
+        self.assertIs(afiliado_DAO.get(1), mae)
+        self.assertIs(afiliado_DAO.get(2), filha)
+        self.assertIs(afiliado_DAO.get(20).parent, mae)
+
+
+if __name__ == '__main__':
+    unittest.main()